@@ -42,7 +42,7 @@ __license__ = """
 __author__ = 'Guido Goldstein'
 __email__ = 'gst-py@a-nugget.de'
 
-from client import MDPClient
+from client import MDPClient, MDPPipelineClient
 from worker import MDPWorker
 from broker import MDPBroker
 
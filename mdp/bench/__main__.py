@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+"""Run the round trip benchmark, see :mod:`mdp.bench.roundtrip`.
+"""
+
+__license__ = """
+    This file is part of MDP.
+
+    MDP is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    MDP is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with MDP.  If not, see <http://www.gnu.org/licenses/>.
+"""
+__author__ = 'Guido Goldstein'
+__email__ = 'gst-py@a-nugget.de'
+
+from mdp.bench.roundtrip import main
+
+main()
+
+### Local Variables:
+### buffer-file-coding-system: utf-8
+### mode: python
+### End:
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""Micro-benchmark for the worker queue implementations of the broker.
+
+Simulates the broker's use of a worker queue: a pool of idle workers,
+requests taking a worker with :func:`get`, replies returning it with
+:func:`put` and workers leaving with :func:`remove`.
+
+Usage::
+
+    python -m mdp.bench.queues [pool size ...]
+"""
+
+__license__ = """
+    This file is part of MDP.
+
+    MDP is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    MDP is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with MDP.  If not, see <http://www.gnu.org/licenses/>.
+"""
+__author__ = 'Guido Goldstein'
+__email__ = 'gst-py@a-nugget.de'
+
+import sys
+import time
+import random
+from collections import deque
+
+from mdp.broker import ServiceQueue, LRUQueue, LIFOQueue, RoundRobinQueue
+
+###
+
+QUEUES = (ServiceQueue, LRUQueue, LIFOQueue, RoundRobinQueue)
+
+###
+
+def run_dispatch(qcls, nworkers, ops):
+    """Time `ops` get/put cycles with `nworkers` idle workers.
+
+    Half of the pool is kept busy, so :func:`put` has to check
+    membership against a half full queue.
+
+    :rtype: float (seconds)
+    """
+    q = qcls()
+    wids = [b'worker-%06d' % i for i in xrange(nworkers)]
+    for wid in wids:
+        q.put(wid)
+    busy = deque(q.get() for _ in xrange(nworkers // 2))
+    start = time.time()
+    for _ in xrange(ops):
+        wid = q.get()
+        q.put(busy.popleft())
+        busy.append(wid)
+    return time.time() - start
+#
+
+def run_churn(qcls, nworkers, ops):
+    """Time `ops` remove/put cycles of random idle workers.
+
+    :rtype: float (seconds)
+    """
+    q = qcls()
+    wids = [b'worker-%06d' % i for i in xrange(nworkers)]
+    for wid in wids:
+        q.put(wid)
+    rnd = random.Random(42)
+    picks = [rnd.choice(wids) for _ in xrange(ops)]
+    start = time.time()
+    for wid in picks:
+        q.remove(wid)
+        q.put(wid)
+    return time.time() - start
+#
+
+def main(argv):
+    sizes = [int(a) for a in argv] or [10, 100, 1000, 10000]
+    ops = 20000
+    print '%-16s %8s %14s %14s' % ('queue', 'workers', 'dispatch/s', 'churn/s')
+    for nworkers in sizes:
+        for qcls in QUEUES:
+            t_disp = run_dispatch(qcls, nworkers, ops)
+            t_churn = run_churn(qcls, nworkers, ops)
+            print '%-16s %8d %14.0f %14.0f' % (qcls.__name__, nworkers,
+                                               ops / t_disp, ops / t_churn)
+    return
+#
+###
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
+
+### Local Variables:
+### buffer-file-coding-system: utf-8
+### mode: python
+### End:
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+
+"""Round trip benchmark of broker, workers and clients.
+
+Starts a broker, M echo workers and N pipelining clients and measures
+request throughput and latency. Sweeps over payload sizes, requests
+in flight per client and worker counts are run as the cartesian
+product of the given values.
+
+With the ipc and tcp transports the broker and the workers run in
+processes of their own and the CPU time and resident memory of the
+broker process are reported. With inproc everything shares one
+process and these figures cover the whole process. The inproc broker
+runs on the loop of the workers and clients, or with `--broker-thread`
+on a loop of its own in a separate thread.
+
+Results are printed as a table and can be written as JSON to compare
+runs across commits.
+
+Usage::
+
+    python -m mdp.bench [--transport tcp] [--payload 16,1024] \\
+        [--concurrency 1,16] [--workers 1,4] [--clients 1] \\
+        [--requests 10000] [--batch 64] [--output results.json]
+"""
+
+__license__ = """
+    This file is part of MDP.
+
+    MDP is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    MDP is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with MDP.  If not, see <http://www.gnu.org/licenses/>.
+"""
+__author__ = 'Guido Goldstein'
+__email__ = 'gst-py@a-nugget.de'
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import threading
+import itertools
+import subprocess
+import multiprocessing
+from functools import partial
+
+import zmq
+from zmq.eventloop.ioloop import IOLoop
+
+from mdp.broker import MDPBroker
+from mdp.worker import MDPWorker
+from mdp.client import MDPPipelineClient
+from mdp.stats import Histogram
+
+###
+
+SERVICE = b'bench.echo'
+
+READY_TIMEOUT = 10.0  #: seconds to wait for all workers to register
+REQUEST_TIMEOUT = 10000  #: ms before a request counts as failed
+
+###
+
+class EchoWorker(MDPWorker):
+
+    """Worker replying with the request.
+    """
+
+    def on_request(self, msg):
+        self.reply(msg)
+        return
+#
+
+def _fresh_loop():
+    """Helper forgetting the IOLoop inherited from the parent process.
+    """
+    if hasattr(IOLoop, 'clear_instance'):
+        IOLoop.clear_instance()
+    return
+#
+
+def run_broker(endpoint, broker_kw):
+    """Run a broker until the process is terminated.
+    """
+    _fresh_loop()
+    context = zmq.Context()
+    broker = MDPBroker(context, endpoint, **broker_kw)
+    IOLoop.instance().start()
+    return
+#
+
+def run_workers(endpoint, nworkers):
+    """Run `nworkers` echo workers until the process is terminated.
+    """
+    _fresh_loop()
+    context = zmq.Context()
+    workers = [EchoWorker(context, endpoint, SERVICE) for _ in xrange(nworkers)]
+    IOLoop.instance().start()
+    return
+#
+
+def proc_usage(pid):
+    """Returns CPU seconds used and resident bytes of the process `pid`.
+
+    Reads `/proc`, returns `(None, None)` where it is not available.
+
+    :rtype: tuple of float and int
+    """
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except (IOError, OSError):
+        return (None, None)
+    # fields start with field 3 (state) of proc(5)
+    cpu = (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+    rss = int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+    return (cpu, rss)
+#
+
+def wait_ready(context, endpoint, nworkers):
+    """Run the IOLoop until `nworkers` workers registered with the broker.
+
+    Asks the broker with `mmi.workers`.
+
+    :rtype: bool
+    """
+    loop = IOLoop.instance()
+    client = MDPPipelineClient(context, endpoint, b'mmi.workers')
+    deadline = time.time() + READY_TIMEOUT
+    state = {'ready': False}
+
+    def ask():
+        client.request([SERVICE], on_reply, 500)
+        return
+
+    def on_reply(msg):
+        if msg and msg[0] == b'200' and int(msg[1]) >= nworkers:
+            state['ready'] = True
+            loop.stop()
+        elif time.time() > deadline:
+            loop.stop()
+        else:
+            loop.add_timeout(time.time() + 0.05, ask)
+        return
+
+    ask()
+    loop.start()
+    client.shutdown()
+    return state['ready']
+#
+
+def run_clients(context, endpoint, nclients, concurrency, nrequests, payload):
+    """Send `nrequests` requests from `nclients` clients and wait for the replies.
+
+    Every client keeps `concurrency` requests in flight.
+
+    :rtype: tuple of elapsed seconds, latency Histogram in µs and
+            number of failed requests.
+    """
+    loop = IOLoop.instance()
+    hist = Histogram()
+    body = b'x' * payload
+    state = {'sent': 0, 'done': 0, 'failed': 0}
+    clients = [MDPPipelineClient(context, endpoint, SERVICE, max_inflight=concurrency)
+               for _ in xrange(nclients)]
+
+    def send(client):
+        if state['sent'] >= nrequests:
+            return
+        state['sent'] += 1
+        client.request([body], partial(on_reply, client, time.time()), REQUEST_TIMEOUT)
+        return
+
+    def on_reply(client, started, msg):
+        if msg is None:
+            state['failed'] += 1
+        else:
+            hist.record((time.time() - started) * 1e6)
+        state['done'] += 1
+        if state['done'] >= nrequests:
+            loop.stop()
+            return
+        send(client)
+        return
+
+    start = time.time()
+    for client in clients:
+        for _ in xrange(concurrency):
+            send(client)
+    loop.start()
+    elapsed = time.time() - start
+    for client in clients:
+        client.shutdown()
+    return (elapsed, hist, state['failed'])
+#
+
+def make_endpoint(transport, port):
+    """Returns the broker endpoint for the transport.
+    """
+    if transport == 'tcp':
+        return 'tcp://127.0.0.1:%d' % port
+    if transport == 'ipc':
+        return 'ipc://%s' % os.path.join(tempfile.gettempdir(),
+                                         'mdp-bench-%d' % os.getpid())
+    return 'inproc://mdp-bench'
+#
+
+def run_one(context, opts, payload, concurrency, nworkers):
+    """Run one benchmark configuration.
+
+    :rtype: dict
+    """
+    endpoint = make_endpoint(opts.transport, opts.port)
+    broker_kw = {'batch': opts.batch}
+    procs = []
+    broker_thread = None
+    if opts.transport == 'inproc':
+        if opts.broker_thread:
+            broker_kw['ioloop'] = IOLoop()
+            broker_thread = threading.Thread(target=broker_kw['ioloop'].start)
+            broker_thread.daemon = True
+        broker = MDPBroker(context, endpoint, **broker_kw)
+        if broker_thread:
+            broker_thread.start()
+        workers = [EchoWorker(context, endpoint, SERVICE) for _ in xrange(nworkers)]
+        broker_pid = os.getpid()
+    else:
+        broker = None
+        workers = []
+        procs.append(multiprocessing.Process(target=run_broker, args=(endpoint, broker_kw)))
+        procs.append(multiprocessing.Process(target=run_workers, args=(endpoint, nworkers)))
+        for proc in procs:
+            proc.daemon = True
+            proc.start()
+        broker_pid = procs[0].pid
+    try:
+        if not wait_ready(context, endpoint, nworkers):
+            raise RuntimeError('workers did not register within %ss' % READY_TIMEOUT)
+        cpu_before, rss = proc_usage(broker_pid)
+        elapsed, hist, failed = run_clients(context, endpoint, opts.clients, concurrency,
+                                            opts.requests, payload)
+        cpu_after, rss = proc_usage(broker_pid)
+    finally:
+        for worker in workers:
+            worker.shutdown()
+        if broker_thread:
+            # the broker sockets belong to the broker thread
+            broker.ioloop.add_callback(broker.shutdown)
+            broker.ioloop.add_callback(broker.ioloop.stop)
+            broker_thread.join()
+        elif broker:
+            broker.shutdown()
+        for proc in procs:
+            proc.terminate()
+            proc.join()
+    broker_cpu = None
+    if cpu_before is not None:
+        broker_cpu = cpu_after - cpu_before
+    return { 'payload': payload,
+             'concurrency': concurrency,
+             'workers': nworkers,
+             'clients': opts.clients,
+             'requests': opts.requests,
+             'failed': failed,
+             'elapsed': elapsed,
+             'throughput': opts.requests / elapsed,
+             'latency_us': hist.snapshot(),
+             'broker_cpu': broker_cpu,
+             'broker_rss': rss,
+             }
+#
+
+def git_revision():
+    """Returns the git commit of the working directory, or `None`.
+    """
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                      stderr=open(os.devnull, 'w'))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.strip()
+#
+
+def _int_list(value):
+    """Helper parsing a comma separated list of integers.
+    """
+    return [int(v) for v in value.split(',')]
+#
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='mdp-bench',
+                                     description='MDP round trip benchmark')
+    parser.add_argument('--transport', choices=('inproc', 'ipc', 'tcp'), default='tcp')
+    parser.add_argument('--port', type=int, default=5580,
+                        help='broker port for the tcp transport')
+    parser.add_argument('--payload', type=_int_list, default=[16],
+                        help='request sizes in bytes, comma separated')
+    parser.add_argument('--concurrency', type=_int_list, default=[1, 16],
+                        help='requests in flight per client, comma separated')
+    parser.add_argument('--workers', type=_int_list, default=[1, 4],
+                        help='worker counts, comma separated')
+    parser.add_argument('--clients', type=int, default=1)
+    parser.add_argument('--requests', type=int, default=10000,
+                        help='requests per run')
+    parser.add_argument('--batch', type=int, default=None,
+                        help='run the broker with a BatchStream of this size')
+    parser.add_argument('--broker-thread', action='store_true',
+                        help='run the inproc broker on its own loop and thread')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    return parser.parse_args(argv)
+#
+
+def main(argv=None):
+    opts = parse_args(sys.argv[1:] if argv is None else argv)
+    context = zmq.Context()
+    results = { 'revision': git_revision(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'pyzmq': zmq.pyzmq_version(),
+                'zmq': zmq.zmq_version(),
+                'transport': opts.transport,
+                'batch': opts.batch,
+                'broker_thread': opts.broker_thread,
+                'broker_process': opts.transport != 'inproc',
+                'runs': [],
+                }
+    print '%8s %6s %7s %10s %9s %9s %9s %8s %8s' % (
+        'payload', 'conc', 'workers', 'req/s', 'p50 us', 'p99 us', 'max us',
+        'cpu s', 'rss MB')
+    for payload, concurrency, nworkers in itertools.product(opts.payload,
+                                                            opts.concurrency,
+                                                            opts.workers):
+        run = run_one(context, opts, payload, concurrency, nworkers)
+        results['runs'].append(run)
+        lat = run['latency_us']
+        print '%8d %6d %7d %10.0f %9d %9d %9d %8s %8s' % (
+            payload, concurrency, nworkers, run['throughput'], lat['p50'], lat['p99'],
+            lat['max'],
+            '%.2f' % run['broker_cpu'] if run['broker_cpu'] is not None else '-',
+            '%.1f' % (run['broker_rss'] / 1048576.0) if run['broker_rss'] else '-')
+        sys.stdout.flush()
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return
+#
+###
+
+if __name__ == '__main__':
+    main()
+
+### Local Variables:
+### buffer-file-coding-system: utf-8
+### mode: python
+### End:
@@ -22,18 +22,62 @@ __author__ = 'Guido Goldstein'
 __email__ = 'gst-py@a-nugget.de'
 
 
+import time
+import struct
+from collections import deque
 from pprint import pprint
 
 import zmq
 from zmq.eventloop.zmqstream import ZMQStream
-from zmq.eventloop.ioloop import PeriodicCallback
+from zmq.eventloop.ioloop import IOLoop, PeriodicCallback
 
-from util import socketid2hex, split_address
+from util import socketid2hex, split_frames, frames_digest, TimerWheel, BatchStream
+from stats import ServiceStats
+from cache import ReplyCache
 
 ###
 
 HB_INTERVAL = 1000  #: in milliseconds
 HB_LIVENESS = 5    #: HBs to miss before connection counts as dead
+HB_TICK = 100      #: resolution of the heartbeat timer wheel in milliseconds
+
+SERVICE_GRACE = 10000  #: ms a service without workers and requests is kept
+
+BACKLOG_REJECT = 'reject'            #: refuse new requests when the backlog is full
+BACKLOG_DROP_OLDEST = 'drop_oldest'  #: evict the oldest queued request
+BACKLOG_DROP_NEWEST = 'drop_newest'  #: silently discard new requests
+
+MDP_BUSY = b'503'  #: status frame sent to clients whose request was refused
+MDP_FAILED = b'500'  #: status frame sent when the redelivery limit was reached
+
+CACHE_BYTES = 64 << 20  #: default size of the reply cache
+CACHE_TTL_HEADER = b'MDP-TTL:'  #: prefix of the reply frame overriding the cache TTL
+
+PRIORITY_LEVELS = 3     #: number of request priorities, 0 is the lowest
+PRIORITY_DEFAULT = 1    #: priority of requests not giving one
+PRIORITY_AGING = 1000   #: ms a queued request waits to count one priority higher
+PRIORITY_SEPARATOR = b'@'       #: separates service name and priority suffix
+PRIORITY_HEADER = b'MDP-PRIO:'  #: prefix of the request frame giving the priority
+
+###
+
+def split_priority(service):
+    """Split the priority suffix from a service name, e.g. `echo@2`.
+
+    Service names ending in :data:`PRIORITY_SEPARATOR` and digits are
+    reserved for this syntax, a worker offering such a service cannot
+    be reached.
+
+    Returns 2-tuple with the service name and the priority, or `None`
+    if the name has no priority suffix.
+
+    :rtype: tuple of str and int
+    """
+    i = service.rfind(PRIORITY_SEPARATOR)
+    if i < 0 or not service[i+1:].isdigit():
+        return (service, None)
+    return (service[:i], int(service[i+1:]))
+#
 
 ###
 
@@ -50,6 +94,11 @@ class MDPBroker(object):
     The broker uses ØMQ XREQ sockets to deal witch clients and workers. These sockets
     are wrapped in pyzmq streams to fit well into IOLoop.
 
+    Messages are received without copying. Only address and header
+    frames are read into strings, request and reply bodies are routed
+    as the `zmq.Frame` objects they were received as. Message parts
+    passed to the `on_*` methods are `zmq.Frame` objects therefore.
+
     .. note::
 
       The workers will *always* be served by the `main_ep` endpoint.
@@ -64,61 +113,247 @@ class MDPBroker(object):
     :param opt_ep:     is an optional 2nd endpoint.
     :type opt_ep:      str
     :param worker_q:   the class to be used for the worker-queue.
+                       Must implement the :class:`ServiceQueue` interface.
+                       Defaults to :class:`LRUQueue`.
     :type worker_q:    class
+    :param backlog_hwm:    default maximum number of requests queued per
+                           service while no worker is available.
+                           `None` means unbounded.
+    :type backlog_hwm:     int
+    :param backlog_policy: default policy applied when a backlog is full.
+                           One of :data:`BACKLOG_REJECT`,
+                           :data:`BACKLOG_DROP_OLDEST` or
+                           :data:`BACKLOG_DROP_NEWEST`.
+    :type backlog_policy:  str
+    :param max_redeliveries: how often a request is redelivered after the
+                             worker handling it died. Set to 0 for
+                             services that must not run a request twice.
+    :type max_redeliveries:  int
+    :param batch:      if set, sockets are wrapped in a :class:`BatchStream`
+                       handling up to `batch` messages per loop iteration
+                       and socket, instead of one ZMQStream callback per
+                       message.
+    :type batch:       int
+    :param ioloop:     the IOLoop running the broker, defaults to the
+                       global one. Any loop providing the IOLoop
+                       interface can be used, so the broker can share a
+                       loop with other services or run on a loop of its
+                       own, e.g. in a separate thread.
+    :type ioloop:      IOLoop
+    :param cache_bytes:  size of the cache of replies of cacheable
+                         services, see :func:`set_cacheable`.
+    :type cache_bytes:   int
+    :param aging:      time in milliseconds after which a queued request
+                       is dispatched as if it had one priority more,
+                       `None` for strict priorities.
+    :type aging:       int
+
+    Clients may give requests a priority between 0 and
+    :data:`PRIORITY_LEVELS` - 1, either by appending it to the service
+    name, e.g. `echo@2`, or by sending a first request frame made of
+    :data:`PRIORITY_HEADER` and the priority, e.g. `MDP-PRIO:2`, which
+    is removed before the request goes to a worker. Requests without
+    priority get :data:`PRIORITY_DEFAULT`. Service names ending in
+    :data:`PRIORITY_SEPARATOR` and digits are therefore reserved.
+    Replies carry the service name as the client sent it, suffix
+    included. Queued requests of higher priority are dispatched first,
+    see :class:`RequestQueue`.
+
+    For every service the broker counts requests, replies and dropped
+    requests and records the time requests wait in the backlog, the
+    time workers take to reply and the total time requests spend in the
+    broker. See :func:`stats` and the `mmi.stats` service.
     """
 
     CLIENT_PROTO = b'MDPC01'  #: Client protocol identifier
     WORKER_PROTO = b'MDPW01'  #: Worker protocol identifier
 
 
-    def __init__(self, context, main_ep, opt_ep=None, worker_q=None):
+    def __init__(self, context, main_ep, opt_ep=None, worker_q=None,
+                 backlog_hwm=None, backlog_policy=BACKLOG_REJECT,
+                 max_redeliveries=1, batch=None, ioloop=None,
+                 cache_bytes=CACHE_BYTES, aging=PRIORITY_AGING):
         """Init MDPBroker instance.
         """
-        socket = context.socket(zmq.XREP)
-        socket.bind(main_ep)
-        self.main_stream = ZMQStream(socket)
-        self.main_stream.on_recv(self.on_message)
+        self.ioloop = ioloop or IOLoop.instance()
+        socket = self._create_socket(context, main_ep)
+        self.main_stream = self._create_stream(socket, batch)
+        self.main_stream.on_recv(self.on_message, copy=False)
         if opt_ep:
-            socket = context.socket(zmq.XREP)
-            socket.bind(opt_ep)
-            self.client_stream = ZMQStream(socket)
-            self.client_stream.on_recv(self.on_message)
+            socket = self._create_socket(context, opt_ep)
+            self.client_stream = self._create_stream(socket, batch)
+            self.client_stream.on_recv(self.on_message, copy=False)
         else:
             self.client_stream = self.main_stream
         self._workers = {}
-        # services contain the worker queue and the request queue
+        self._worker_q = worker_q or LRUQueue
+        self._backlog_cfg = (backlog_hwm, backlog_policy)
+        self._aging = aging
+        # per service overrides of the backlog config
+        self._service_backlog_cfg = {}
+        # names of services with coalescing of identical requests
+        self._coalesce = set()
+        # maps name of cacheable service -> TTL in milliseconds
+        self._cache_ttl = {}
+        self.cache = ReplyCache(cache_bytes)
+        self._max_redeliveries = max_redeliveries
+        # maps service name -> ServiceRep
         self._services = {}
+        # maps service name -> ServiceStats, kept when a service is forgotten
+        self._stats = {}
         self._worker_cmds = { '\x01': self.on_ready,
                               '\x03': self.on_reply,
                               '\x04': self.on_heartbeat,
                               '\x05': self.on_disconnect,
                               }
-        self.hb_check_timer = PeriodicCallback(self.on_timer, HB_INTERVAL)
+        # all heartbeats are driven by this single wheel and timer
+        self._hb_wheel = TimerWheel(HB_TICK, max(1, HB_INTERVAL // HB_TICK))
+        # services without workers, due for garbage collection
+        self._gc_wheel = TimerWheel(HB_TICK, max(1, HB_INTERVAL // HB_TICK))
+        self.hb_check_timer = PeriodicCallback(self.on_timer, HB_TICK, self.ioloop)
         self.hb_check_timer.start()
         return
 
-    def register_worker(self, wid, service):
+    def _create_socket(self, context, endpoint):
+        """Helper creating a socket bound to the endpoint.
+        """
+        socket = context.socket(zmq.XREP)
+        socket.bind(endpoint)
+        return socket
+
+    def _create_stream(self, socket, batch):
+        """Helper wrapping the socket in a stream.
+        """
+        if batch:
+            return BatchStream(socket, self.ioloop, batch)
+        return ZMQStream(socket, self.ioloop)
+
+    def register_worker(self, wid, service, capacity=1):
         """Register the worker id and add it to the given service.
 
-        Does nothing if worker is already known.
+        Does nothing if worker is already known. Requests waiting in
+        the service backlog are dispatched to the new worker.
 
         :param wid:    the worker id.
         :type wid:     str
         :param service:    the service name.
         :type service:     str
+        :param capacity:   number of requests the worker handles concurrently.
+        :type capacity:    int
 
         :rtype: None
         """
         if wid in self._workers:
             return
-        self._workers[wid] = WorkerRep(self.WORKER_PROTO, wid, service, self.main_stream)
+        self._workers[wid] = WorkerRep(self.WORKER_PROTO, wid, service, self.main_stream,
+                                       capacity)
+        self._hb_wheel.add(wid, HB_INTERVAL)
+        srv = self._services.get(service)
+        if srv is None:
+            hwm, policy = self._service_backlog_cfg.get(service, self._backlog_cfg)
+            srv = ServiceRep(service, self._worker_q(),
+                             RequestQueue(hwm, policy, aging=self._aging))
+            srv.stats = self._stats.setdefault(service, ServiceStats())
+            if service in self._coalesce:
+                srv.inflight = {}
+            srv.cache_ttl = self._cache_ttl.get(service)
+            self._services[service] = srv
+        else:
+            self._gc_wheel.remove(service)
+        srv.workers.add(wid)
+        srv.worker_q.put(wid)
+        while srv.requests and srv.worker_q:
+            self.dispatch(srv, srv.requests.get())
+        return
+
+    def set_backlog(self, service, hwm, policy=BACKLOG_REJECT):
+        """Configure the request backlog of the given service.
+
+        Overrides the broker wide defaults given to the constructor.
+        Applies to already known services as well as to services
+        registered later.
+
+        :param service:    the service name.
+        :type service:     str
+        :param hwm:        maximum number of queued requests, `None` for unbounded.
+        :type hwm:         int
+        :param policy:     the overflow policy.
+        :type policy:      str
+
+        :rtype: None
+        """
+        self._service_backlog_cfg[service] = (hwm, policy)
         if service in self._services:
-            wq, wr = self._services[service]
-            wq.put(wid)
+            requests = self._services[service].requests
+            requests.hwm = hwm
+            requests.policy = policy
+        return
+
+    def set_coalescing(self, service, enabled=True):
+        """Enable or disable coalescing of identical requests for a service.
+
+        While a request of a coalescing service is queued or processed,
+        requests with the same message parts are not dispatched but
+        attached to it. The reply, or the error sent instead, goes to
+        all of them. Only use this for services whose replies depend on
+        the request alone, e.g. read-only lookups.
+
+        Requests are matched by a SHA-1 digest of their message parts.
+
+        :param service:    the service name.
+        :type service:     str
+        :param enabled:    if identical requests are coalesced.
+        :type enabled:     bool
+
+        :rtype: None
+        """
+        if enabled:
+            self._coalesce.add(service)
         else:
-            q = ServiceQueue()
-            q.put(wid)
-            self._services[service] = (q, [])
+            self._coalesce.discard(service)
+        srv = self._services.get(service)
+        if srv is not None:
+            if not enabled:
+                srv.inflight = None
+            elif srv.inflight is None:
+                srv.inflight = {}
+        return
+
+    def set_cacheable(self, service, ttl):
+        """Enable or disable caching of the replies of a service.
+
+        Requests of a cacheable service are answered from the broker's
+        cache while a reply to an identical request is stored there,
+        without involving a worker. Only use this for services whose
+        replies depend on the request alone.
+
+        Replies are kept for `ttl` milliseconds. A worker may override
+        this for a reply by sending a first reply frame made of
+        :data:`CACHE_TTL_HEADER` and the TTL in milliseconds, e.g.
+        `MDP-TTL:500`. The frame is removed from the reply, a TTL of 0
+        keeps the reply out of the cache. Replies, error replies
+        included, are cached as sent by the worker.
+
+        The least recently used replies are evicted when the cache
+        exceeds the size given to the constructor. See the `mmi.cache`
+        service for the cache counters.
+
+        :param service:    the service name.
+        :type service:     str
+        :param ttl:        the time to live of the replies in milliseconds,
+                           `None` to disable caching and drop cached replies.
+        :type ttl:         int
+
+        :rtype: None
+        """
+        if ttl is None:
+            self._cache_ttl.pop(service, None)
+            self.cache.purge(service)
+        else:
+            self._cache_ttl[service] = ttl
+        srv = self._services.get(service)
+        if srv is not None:
+            srv.cache_ttl = ttl
         return
 
     def unregister_worker(self, wid):
@@ -126,7 +361,10 @@ class MDPBroker(object):
 
         If the worker id is not registered, nothing happens.
 
-        Will stop all timers for the worker.
+        Will cancel the heartbeat timer of the worker. Requests the
+        worker was processing are redelivered, see :func:`redeliver`.
+        If this was the last worker of its service, the service is
+        scheduled for garbage collection, see :func:`on_service_expired`.
 
         :param wid:    the worker id.
         :type wid:     str
@@ -139,11 +377,39 @@ class MDPBroker(object):
             # not registered, ignore
             return
         wrep.shutdown()
+        self._hb_wheel.remove(wid)
         service = wrep.service
-        if service in self._services:
-            wq, wr = self._services[service]
-            wq.remove(wid)
+        srv = self._services.get(service)
+        if srv is not None:
+            srv.worker_q.remove(wid)
+            srv.workers.discard(wid)
+            if not srv.workers:
+                self._gc_wheel.add(service, SERVICE_GRACE)
         del self._workers[wid]
+        if srv is not None:
+            for req in wrep.requests.values():
+                self.redeliver(srv, req)
+        return
+
+    def redeliver(self, srv, req):
+        """Requeue a request whose worker was lost.
+
+        The request is put in front of the service backlog, ignoring the
+        high-water mark. After `max_redeliveries` attempts the client is
+        sent :data:`MDP_FAILED` instead.
+
+        :param srv:    the service of the request.
+        :type srv:     ServiceRep
+        :param req:    the request.
+        :type req:     RequestRep
+
+        :rtype: None
+        """
+        req.attempts += 1
+        if req.attempts > self._max_redeliveries:
+            self.request_failed(srv, req, MDP_FAILED)
+            return
+        self.dispatch(srv, req, True)
         return
 
     def disconnect(self, wid):
@@ -161,11 +427,45 @@ class MDPBroker(object):
         except KeyError:
             # not registered, ignore
             return
-        to_send = [ wid, self.WORKER_PROTO, b'\x05' ]
+        to_send = [ wid, b'', self.WORKER_PROTO, b'\x05' ]
         self.main_stream.send_multipart(to_send)
         self.unregister_worker(wid)
         return
 
+    def request_failed(self, srv, req, status):
+        """Give up a request and answer it with the `status` frame.
+
+        Requests coalesced with it get the same answer. With `status`
+        set to `None` nobody is answered.
+
+        :param srv:     the service of the request.
+        :type srv:      ServiceRep
+        :param req:     the request.
+        :type req:      RequestRep
+        :param status:  the status frame to send.
+        :type status:   str
+
+        :rtype: None
+        """
+        self._request_done(srv, req)
+        srv.stats.dropped += 1
+        if status is None:
+            return
+        self.client_response(req.rp, req.service, [status])
+        if req.waiters:
+            srv.stats.dropped += len(req.waiters)
+            for rp, name in req.waiters:
+                self.client_response(rp, name, [status])
+        return
+
+    def _request_done(self, srv, req):
+        """Helper ending coalescing onto the request.
+        """
+        if req.key is not None and srv.inflight is not None:
+            if srv.inflight.get(req.key) is req:
+                del srv.inflight[req.key]
+        return
+
     def client_response(self, rp, service, msg):
         """Package and send reply to client.
 
@@ -174,12 +474,11 @@ class MDPBroker(object):
         :param service:  name of service
         :type service:   str
         :param msg:      message parts
-        :type msg:       list of str
+        :type msg:       list of str or zmq.Frame
 
         :rtype: None
         """
-        to_send = rp[:]
-        to_send.extend([b'', self.CLIENT_PROTO, service])
+        to_send = rp + [b'', self.CLIENT_PROTO, service]
         to_send.extend(msg)
         self.client_stream.send_multipart(to_send)
         return
@@ -194,6 +493,9 @@ class MDPBroker(object):
 
         :rtype: None
         """
+        if self.hb_check_timer:
+            self.hb_check_timer.stop()
+            self.hb_check_timer = None
         if self.client_stream == self.main_stream:
             self.client_stream = None
         self.main_stream.on_recv(None)
@@ -212,31 +514,74 @@ class MDPBroker(object):
         return
 
     def on_timer(self):
-        """Method called on timer expiry.
+        """Method called on timer expiry, every HB_TICK milliseconds.
+
+        Advances the heartbeat wheel. Only workers whose heartbeat is due
+        are visited: dead ones are unregistered, the others get a
+        heartbeat and are rescheduled.
 
-        Checks which workers are dead and unregisters them.
+        Also advances the wheel of services due for garbage collection.
 
         :rtype: None
         """
-        for wrep in self._workers.values():
+        for service in self._gc_wheel.advance():
+            self.on_service_expired(service)
+        wheel = self._hb_wheel
+        for wid in wheel.advance():
+            wrep = self._workers.get(wid)
+            if wrep is None:
+                continue
             if not wrep.is_alive():
-                self.unregister_worker(wrep.id)
+                self.unregister_worker(wid)
+                continue
+            wrep.send_hb()
+            wheel.add(wid, HB_INTERVAL)
+        return
+
+    def on_service_expired(self, service):
+        """Method called when the grace period of a service without workers ended.
+
+        Forgets the service if it still has no workers and no queued
+        requests. A service with queued requests is checked again after
+        another grace period.
+
+        :param service:  the service name.
+        :type service:   str
+
+        :rtype: None
+        """
+        srv = self._services.get(service)
+        if srv is None or srv.workers:
+            return
+        if srv.requests:
+            self._gc_wheel.add(service, SERVICE_GRACE)
+            return
+        del self._services[service]
         return
 
     def on_ready(self, rp, msg):
         """Process worker READY command.
 
-        Registers the worker for a service.
+        Registers the worker for a service. An optional frame after the
+        service name holds the number of requests the worker is able to
+        process concurrently (its credit). It defaults to 1.
 
         :param rp:  return address stack
         :type rp:   list of str
         :param msg: message parts
-        :type msg:  list of str
+        :type msg:  list of zmq.Frame
 
         :rtype: None
         """
         ret_id = rp[0]
-        self.register_worker(ret_id, msg[0])
+        capacity = 1
+        if len(msg) > 1:
+            try:
+                capacity = max(1, int(msg[1].bytes))
+            except ValueError:
+                self.disconnect(ret_id)
+                return
+        self.register_worker(ret_id, msg[0].bytes, capacity)
         return
 
     def on_reply(self, rp, msg):
@@ -244,45 +589,85 @@ class MDPBroker(object):
 
         Route the `msg` to the client given by the address(es) in front of `msg`.
 
+        For workers with a capacity above 1 the last address frame is the
+        tag the broker added in :func:`dispatch` to identify the request.
+
         :param rp:  return address stack
         :type rp:   list of str
         :param msg: message parts
-        :type msg:  list of str
+        :type msg:  list of zmq.Frame
 
         :rtype: None
         """
         ret_id = rp[0]
-        wrep = self._workers[ret_id]
-        service = wrep.service
-        # make worker available again
+        wrep = self._workers.get(ret_id)
+        if wrep is None:
+            # reply of an unknown worker, ignore
+            return
         try:
-            wq, wr = self._services[service]
-            cp, msg = split_address(msg)
-            self.client_response(cp, service, msg)
-            wq.put(wrep.id)
-            if wr:
-                proto, rp, msg = wr.pop(0)
-                self.on_client(proto, rp, msg)
+            srv = self._services[wrep.service]
         except KeyError:
             # unknown service
             self.disconnect(ret_id)
+            return
+        cp, i = split_frames(msg)
+        msg = msg[i:]
+        if wrep.capacity > 1:
+            req = wrep.requests.pop(cp.pop(), None)
+        else:
+            req = wrep.requests.pop(None, None)
+        if srv.cache_ttl is not None and req is not None:
+            msg = self._cache_reply(srv, req, msg)
+        self.client_response(cp, req.service if req is not None else srv.name, msg)
+        if req is not None:
+            stats = srv.stats
+            stats.replies += 1
+            if req.key is not None:
+                self._request_done(srv, req)
+                if req.waiters:
+                    stats.replies += len(req.waiters)
+                    for rp, name in req.waiters:
+                        self.client_response(rp, name, msg)
+            now = time.time()
+            stats.service_time.record((now - req.dispatched) * 1e6)
+            stats.residence.record((now - req.received) * 1e6)
+        # make worker available again
+        srv.worker_q.put(wrep.id)
+        if srv.requests:
+            self.dispatch(srv, srv.requests.get())
         return
 
+    def _cache_reply(self, srv, req, msg):
+        """Helper storing the reply of a cacheable service.
+
+        Returns the reply without the TTL header frame.
+        """
+        ttl = srv.cache_ttl
+        if msg and len(msg[0]) <= 32:
+            head = msg[0].bytes
+            if head.startswith(CACHE_TTL_HEADER):
+                msg = msg[1:]
+                try:
+                    ttl = int(head[len(CACHE_TTL_HEADER):])
+                except ValueError:
+                    pass
+        if ttl > 0 and req.key is not None:
+            self.cache.put((srv.name, req.key), msg, ttl)
+        return msg
+
     def on_heartbeat(self, rp, msg):
         """Process worker HEARTBEAT command.
 
         :param rp:  return address stack
         :type rp:   list of str
         :param msg: message parts
-        :type msg:  list of str
+        :type msg:  list of zmq.Frame
 
         :rtype: None
         """
         ret_id = rp[0]
         try:
-            worker = self._workers[ret_id]
-            if worker.is_alive():
-                worker.on_heartbeat()
+            self._workers[ret_id].on_heartbeat()
         except KeyError:
             # ignore HB for unknown worker
             pass
@@ -296,7 +681,7 @@ class MDPBroker(object):
         :param rp:  return address stack
         :type rp:   list of str
         :param msg: message parts
-        :type msg:  list of str
+        :type msg:  list of zmq.Frame
 
         :rtype: None
         """
@@ -307,29 +692,128 @@ class MDPBroker(object):
     def on_mmi(self, rp, service, msg):
         """Process MMI request.
 
-        For now only mmi.service is handled.
+        The following services are handled:
+
+          mmi.service
+            Frame 0 is a service name. Replies `200` if the service has
+            at least one worker, `404` otherwise.
+
+          mmi.services
+            Replies `200` followed by the names of all services having
+            workers.
+
+          mmi.workers
+            With a service name in frame 0, replies `200` followed by
+            the number of workers, the number of idle workers and the
+            number of queued requests of that service, or `404` if
+            the service is unknown. Without a service name, replies
+            `200` followed by the total number of workers.
+
+          mmi.stats
+            With a service name in frame 0, replies `200` followed by
+            pairs of statistic name and value, see :func:`stats_frames`,
+            or `404` if the service is unknown. Without a service name,
+            replies `200` followed by the counters of all services
+            summed up.
+
+          mmi.cache
+            Replies `200` followed by pairs of name and value of the
+            reply cache counters: `hits`, `stale_hits`, `misses`,
+            `evictions`, `expirations`, `entries` and `bytes`.
+
+        Unknown MMI services are answered with `501`.
 
         :param rp:      return address stack
         :type rp:       list of str
         :param service: the protocol id sent
         :type service:  str
         :param msg:     message parts
-        :type msg:      list of str
+        :type msg:      list of zmq.Frame
 
         :rtype: None
         """
         if service == b'mmi.service':
-            s = msg[0]
-            ret = b'404'
-            for wr in self._workers.values():
-                if s == wr.service:
-                    ret = b'200'
-                    break
+            srv = self._services.get(msg[0].bytes) if msg else None
+            if srv is not None and srv.workers:
+                ret = b'200'
+            else:
+                ret = b'404'
             self.client_response(rp, service, [ret])
+        elif service == b'mmi.services':
+            ret = [b'200']
+            ret.extend(name for name, srv in self._services.iteritems() if srv.workers)
+            self.client_response(rp, service, ret)
+        elif service == b'mmi.workers':
+            if not msg:
+                ret = [b'200', str(len(self._workers))]
+            else:
+                srv = self._services.get(msg[0].bytes)
+                if srv is None:
+                    ret = [b'404']
+                else:
+                    ret = [b'200', str(len(srv.workers)), str(len(srv.worker_q)),
+                           str(len(srv.requests))]
+            self.client_response(rp, service, ret)
+        elif service == b'mmi.stats':
+            if msg:
+                stats = self._stats.get(msg[0].bytes)
+                ret = [b'404'] if stats is None else [b'200'] + self.stats_frames(stats)
+            else:
+                ret = [b'200']
+                for name in ServiceStats.COUNTERS:
+                    total = sum(getattr(st, name) for st in self._stats.itervalues())
+                    ret.extend((name, str(total)))
+            self.client_response(rp, service, ret)
+        elif service == b'mmi.cache':
+            ret = [b'200']
+            for name, value in self.cache.counters():
+                ret.extend((name, str(value)))
+            self.client_response(rp, service, ret)
         else:
             self.client_response(rp, service, [b'501'])
         return
 
+    def stats(self, service=None):
+        """Returns a snapshot of the statistics.
+
+        Latencies are given in microseconds. Statistics of services
+        are kept after the service itself is forgotten.
+
+        :param service:  the service name, `None` for all services.
+        :type service:   str
+
+        :rtype: dict mapping service names to :func:`ServiceStats.snapshot`
+                results, or a single snapshot if `service` is given.
+        """
+        if service is not None:
+            stats = self._stats.get(service)
+            return stats.snapshot() if stats is not None else None
+        return dict((name, stats.snapshot()) for name, stats in self._stats.iteritems())
+
+    def stats_frames(self, stats):
+        """Returns the statistics of a service as message parts.
+
+        The parts alternate between name and value: the counters
+        `requests`, `replies`, `dropped`, `coalesced` and `cached`, then for each
+        of the histograms `queue_wait`, `service_time` and `residence`
+        the values `count`, `mean`, `max` and the percentiles, named
+        e.g. `queue_wait.p99`. All values are integers, latencies in
+        microseconds.
+
+        :param stats:  the statistics of the service.
+        :type stats:   ServiceStats
+
+        :rtype: list of str
+        """
+        ret = []
+        snap = stats.snapshot()
+        for name in stats.COUNTERS:
+            ret.extend((name, str(snap[name])))
+        for name in stats.HISTOGRAMS:
+            for key, value in sorted(snap[name].iteritems()):
+                ret.extend(('%s.%s' % (name, key), str(int(value))))
+        return ret
+
     def on_client(self, proto, rp, msg):
         """Method called on client message.
 
@@ -344,11 +828,18 @@ class MDPBroker(object):
         .. note::
 
            If currently no worker is available for a known service,
-           the message is queued for later delivery.
+           the message is queued for later delivery. When the service
+           backlog is full, the configured overflow policy decides
+           which request is refused. Refused requests are answered with
+           :data:`MDP_BUSY`, except under :data:`BACKLOG_DROP_NEWEST`.
 
-        If a worker is available for the requested service, the
-        message is repackaged and sent to the worker. The worker in
-        question is removed from the pool of available workers.
+        The priority of the request is taken from a service name suffix
+        or a priority frame, see :class:`MDPBroker`.
+
+        Requests of cacheable services are answered from the reply
+        cache if possible, see :func:`set_cacheable`.
+
+        Known services are handled by :func:`dispatch`.
 
         If the service name starts with `mmi.`, the message is passed to
         the internal MMI_ handler.
@@ -360,35 +851,112 @@ class MDPBroker(object):
         :param rp:    return address stack
         :type rp:     list of str
         :param msg:   message parts
-        :type msg:    list of str
+        :type msg:    list of zmq.Frame
 
         :rtype: None
         """
 ##         print 'client message:'
 ##         pprint(msg)
-        service = msg.pop(0)
+        service = msg[0].bytes
+        msg = msg[1:]
         if service.startswith(b'mmi.'):
             self.on_mmi(rp, service, msg)
             return
+        # replies carry the service name as sent by the client
+        sent = service
+        service, priority = split_priority(service)
+        if msg and len(msg[0]) <= 16:
+            head = msg[0].bytes
+            if head.startswith(PRIORITY_HEADER):
+                msg = msg[1:]
+                try:
+                    priority = int(head[len(PRIORITY_HEADER):])
+                except ValueError:
+                    pass
         try:
-            wq, wr = self._services[service]
-            wid = wq.get()
-            if not wid:
-                # no worker ready
-                # queue message
-                msg.insert(0, service)
-                wr.append((proto, rp, msg))
-                return
-            wrep = self._workers[wid]
-            to_send = [ wrep.id, b'', self.WORKER_PROTO, b'\x02']
-            to_send.extend(rp)
-            to_send.append(b'')
-            to_send.extend(msg)
-            self.main_stream.send_multipart(to_send)
+            srv = self._services[service]
         except KeyError:
             # unknwon service
             # ignore request
             print 'broker has no service "%s"' % service
+            return
+        srv.stats.requests += 1
+        req = RequestRep(proto, rp, msg, sent)
+        if priority is not None:
+            req.priority = priority
+        if srv.cache_ttl is not None:
+            req.key = frames_digest(msg)
+            reply = self.cache.get((service, req.key))
+            if reply is not None:
+                srv.stats.cached += 1
+                srv.stats.replies += 1
+                self.client_response(rp, sent, reply)
+                return
+        if srv.inflight is not None:
+            key = req.key or frames_digest(msg)
+            leader = srv.inflight.get(key)
+            if leader is not None:
+                if leader.waiters is None:
+                    leader.waiters = []
+                leader.waiters.append((rp, sent))
+                srv.stats.coalesced += 1
+                return
+            req.key = key
+            srv.inflight[key] = req
+        self.dispatch(srv, req)
+        return
+
+    def dispatch(self, srv, req, front=False):
+        """Send request to an available worker or queue it.
+
+        If a worker is available for the service, the message is
+        repackaged and sent to the worker. The worker remembers the
+        request until it replies. It is removed from the pool of
+        available workers once all its credit is used up.
+
+        Requests to workers with a capacity above 1 get a tag appended
+        to the return address, so replies can be matched to requests.
+
+        :param srv:    the service requested.
+        :type srv:     ServiceRep
+        :param req:    the request.
+        :type req:     RequestRep
+        :param front:  queue the request in front of the backlog.
+        :type front:   bool
+
+        :rtype: None
+        """
+        wid = srv.worker_q.get()
+        if not wid:
+            # no worker ready
+            # queue message
+            if front:
+                srv.requests.put_front(req, req.priority)
+                return
+            refused = srv.requests.put(req, req.priority)
+            if refused:
+                if srv.requests.policy == BACKLOG_DROP_NEWEST:
+                    self.request_failed(srv, refused, None)
+                else:
+                    self.request_failed(srv, refused, MDP_BUSY)
+            return
+        req.dispatched = time.time()
+        srv.stats.queue_wait.record((req.dispatched - req.received) * 1e6)
+        wrep = self._workers[wid]
+        wrep.sent_traffic = True
+        to_send = [ wrep.id, b'', self.WORKER_PROTO, b'\x02']
+        to_send.extend(req.rp)
+        if wrep.capacity > 1:
+            tag = wrep.next_tag()
+            to_send.append(tag)
+            wrep.requests[tag] = req
+            if len(wrep.requests) < wrep.capacity:
+                srv.worker_q.put(wid)
+        else:
+            wrep.requests[None] = req
+        to_send.append(b'')
+        to_send.extend(req.msg)
+        self.main_stream.send_multipart(to_send)
         return
 
     def on_worker(self, proto, rp, msg):
@@ -401,19 +969,24 @@ class MDPBroker(object):
         calls the appropriate method. If the command is unknown the
         message is ignored and a DISCONNECT is sent.
 
+        Any message from a known worker counts as a heartbeat.
+
         :param proto: the protocol id sent
         :type proto:  str
         :param rp:  return address stack
         :type rp:   list of str
         :param msg: message parts
-        :type msg:  list of str
+        :type msg:  list of zmq.Frame
 
         :rtype: None
         """
-        cmd = msg.pop(0)
+        cmd = msg[0].bytes
+        wrep = self._workers.get(rp[0])
+        if wrep is not None:
+            wrep.on_heartbeat()
         if cmd in self._worker_cmds:
             fnc = self._worker_cmds[cmd]
-            fnc(rp, msg)
+            fnc(rp, msg[1:])
         else:
             # ignore unknown command
             # DISCONNECT worker
@@ -428,17 +1001,17 @@ class MDPBroker(object):
         ignored.
 
         :param msg: message parts
-        :type msg:  list of str
+        :type msg:  list of zmq.Frame
 
         :rtype: None
         """
-        rp, msg = split_address(msg)
+        rp, i = split_frames(msg)
         # dispatch on first frame after path
-        t = msg.pop(0)
+        t = msg[i].bytes
         if t.startswith(b'MDPW'):
-            self.on_worker(t, rp, msg)
+            self.on_worker(t, rp, msg[i+1:])
         elif t.startswith(b'MDPC'):
-            self.on_client(t, rp, msg)
+            self.on_client(t, rp, msg[i+1:])
         else:
             print 'Broker unknown Protocol: "%s"' % t
         return
@@ -448,8 +1021,8 @@ class WorkerRep(object):
 
     """Helper class to represent a worker in the broker.
 
-    Instances of this class are used to track the state of the attached worker
-    and carry the timers for incomming and outgoing heartbeats.
+    Instances of this class are used to track the state of the attached worker.
+    Heartbeats are driven by the broker, see :func:`MDPBroker.on_timer`.
 
     :param proto:    the worker protocol id.
     :type wid:       str
@@ -459,27 +1032,44 @@ class WorkerRep(object):
     :type service:   str
     :param stream:   the ZMQStream used to send messages
     :type stream:    ZMQStream
+    :param capacity: number of requests the worker handles concurrently.
+    :type capacity:  int
     """
 
-    def __init__(self, proto, wid, service, stream):
+    def __init__(self, proto, wid, service, stream, capacity=1):
         self.proto = proto
         self.id = wid
         self.service = service
         self.curr_liveness = HB_LIVENESS
         self.stream = stream
         self.last_hb = 0
-        self.hb_out_timer = PeriodicCallback(self.send_hb, HB_INTERVAL)
-        self.hb_out_timer.start()
+        # set when a message other than a heartbeat went to the worker
+        self.sent_traffic = False
+        self.capacity = capacity
+        # maps request tag -> RequestRep for all requests in process
+        # (the tag is None for workers with a capacity of 1)
+        self.requests = {}
+        self._tag = 0
         return
 
+    def next_tag(self):
+        """Returns a new tag to identify a request sent to this worker.
+        """
+        self._tag += 1
+        return struct.pack('!Q', self._tag)
+
     def send_hb(self):
         """Called on every HB_INTERVAL.
 
         Decrements the current liveness by one.
 
-        Sends heartbeat to worker.
+        Sends heartbeat to worker, unless other messages were sent
+        during the last interval.
         """
         self.curr_liveness -= 1
+        if self.sent_traffic:
+            self.sent_traffic = False
+            return
         msg = [ self.id, b'', self.proto, chr(4) ]
         self.stream.send_multipart(msg)
         return
@@ -499,20 +1089,183 @@ class WorkerRep(object):
 
     def shutdown(self):
         """Cleanup worker.
-
-        Stops timer.
         """
-        self.hb_out_timer.stop()
-        self.hb_out_timer = None
         self.stream = None
         return
 #
 
+class ServiceRep(object):
+
+    """Helper class to represent a service in the broker.
+
+    :param name:       the service name.
+    :type name:        str
+    :param worker_q:   queue of idle workers.
+    :type worker_q:    ServiceQueue
+    :param requests:   queue of requests waiting for a worker.
+    :type requests:    RequestQueue
+    """
+
+    def __init__(self, name, worker_q, requests):
+        self.name = name
+        self.worker_q = worker_q
+        self.requests = requests
+        # ids of all registered workers, idle or busy
+        self.workers = set()
+        # the ServiceStats, set by the broker
+        self.stats = None
+        # maps request digest -> RequestRep if coalescing is enabled
+        self.inflight = None
+        # TTL of cached replies in milliseconds if the service is cacheable
+        self.cache_ttl = None
+        return
+#
+
+class RequestRep(object):
+
+    """Helper class to represent a client request in the broker.
+
+    :param proto:    the client protocol id.
+    :type proto:     str
+    :param rp:       return address stack of the client.
+    :type rp:        list of str
+    :param msg:      the request message parts.
+    :type msg:       list of str or zmq.Frame
+    :param service:  the service name as sent by the client.
+    :type service:   str
+    """
+
+    __slots__ = ('proto', 'rp', 'msg', 'service', 'attempts', 'received',
+                 'dispatched', 'key', 'waiters', 'priority')
+
+    def __init__(self, proto, rp, msg, service):
+        self.proto = proto
+        self.rp = rp
+        self.msg = msg
+        self.service = service
+        # number of times the request was redelivered
+        self.attempts = 0
+        # time the broker received the request and last sent it to a worker
+        self.received = time.time()
+        self.dispatched = 0
+        # digest of the message if coalescing or caching, and return addresses
+        # and service names of requests coalesced with this one
+        self.key = None
+        self.waiters = None
+        self.priority = PRIORITY_DEFAULT
+        return
+#
+
+class RequestQueue(object):
+
+    """Bounded queue of requests waiting for a worker of a service.
+
+    Requests are queued by priority, FIFO within each priority. The
+    request dispatched next is the first one of the highest priority,
+    where waiting `aging` milliseconds counts as one priority more, so
+    requests of low priority are not starved.
+
+    When `hwm` is reached, a request of the lowest priority present,
+    the new one included, is refused: the oldest one under
+    :data:`BACKLOG_DROP_OLDEST`, the newest one otherwise.
+
+    :param hwm:      maximum number of queued requests, `None` for unbounded.
+    :type hwm:       int
+    :param policy:   what to do when `hwm` is reached.
+    :type policy:    str
+    :param levels:   number of priorities.
+    :type levels:    int
+    :param aging:    waiting time in milliseconds counting as one priority,
+                     `None` for strict priorities.
+    :type aging:     int
+    """
+
+    def __init__(self, hwm=None, policy=BACKLOG_REJECT, levels=PRIORITY_LEVELS,
+                 aging=PRIORITY_AGING):
+        """Initialize queue instance.
+        """
+        # one FIFO of (time queued, request) per priority
+        self.q = [deque() for _ in xrange(levels)]
+        self.hwm = hwm
+        self.policy = policy
+        self.aging = aging / 1000.0 if aging else None
+        self._len = 0
+        return
+
+    def __len__(self):
+        return self._len
+
+    def _level(self, priority):
+        """Helper returning the FIFO of the priority.
+        """
+        return self.q[max(0, min(priority, len(self.q) - 1))]
+
+    def put(self, req, priority=PRIORITY_DEFAULT):
+        """Queue the given request.
+
+        Returns the request refused due to the overflow policy, which
+        is either `req` itself or an evicted request. Returns `None` if
+        nothing was refused.
+        """
+        level = self._level(priority)
+        if self.hwm is not None and self._len >= self.hwm:
+            lowest = next(q for q in self.q if q or q is level)
+            if lowest is level:
+                if self.policy != BACKLOG_DROP_OLDEST or not level:
+                    return req
+                level.append((time.time(), req))
+                return level.popleft()[1]
+            # evict in favour of the request of higher priority
+            level.append((time.time(), req))
+            if self.policy == BACKLOG_DROP_OLDEST:
+                return lowest.popleft()[1]
+            return lowest.pop()[1]
+        level.append((time.time(), req))
+        self._len += 1
+        return None
+
+    def put_front(self, req, priority=PRIORITY_DEFAULT):
+        """Queue the given request in front of all others of its priority.
+
+        Used for requests that were already accepted once, so the
+        high-water mark is not applied.
+        """
+        level = self._level(priority)
+        level.appendleft((level[0][0] if level else time.time(), req))
+        self._len += 1
+        return
+
+    def get(self):
+        if not self._len:
+            return None
+        best = None
+        if self.aging:
+            now = time.time()
+            score = None
+            for i, q in enumerate(self.q):
+                if q:
+                    s = i + (now - q[0][0]) / self.aging
+                    if score is None or s >= score:
+                        best, score = q, s
+        else:
+            for q in self.q:
+                if q:
+                    best = q
+        self._len -= 1
+        return best.popleft()[1]
+#
+
 class ServiceQueue(object):
 
     """Class defining the Queue interface for workers for a service.
 
     The methods on this class are the only ones used by the broker.
+
+    This is the simple list based reference implementation. Every
+    operation is O(n) in the number of queued workers, so it should
+    only be used for small pools. See :class:`LRUQueue`,
+    :class:`LIFOQueue` and :class:`RoundRobinQueue` for O(1)
+    implementations.
     """
 
     def __init__(self):
@@ -550,6 +1303,147 @@ class ServiceQueue(object):
             return None
         return self.q.pop(0)
 #
+
+class LRUQueue(ServiceQueue):
+
+    """Worker queue handing out the least recently used worker first.
+
+    Uses a deque for ordering and a dict for membership. Removed
+    workers are not searched for in the deque; their entries are
+    invalidated and skipped by :func:`get`. All operations are O(1)
+    (amortized for :func:`get`).
+    """
+
+    def __init__(self):
+        """Initialize queue instance.
+        """
+        self.q = deque()
+        # maps worker id -> sequence number of its valid entry in q
+        self._members = {}
+        self._seq = 0
+        return
+
+    def __contains__(self, wid):
+        return wid in self._members
+
+    def __len__(self):
+        return len(self._members)
+
+    def remove(self, wid):
+        self._members.pop(wid, None)
+        self._compact()
+        return
+
+    def put(self, wid, *args, **kwargs):
+        if wid in self._members:
+            return
+        self._seq += 1
+        self._members[wid] = self._seq
+        self.q.append((wid, self._seq))
+        return
+
+    def get(self):
+        members = self._members
+        while self.q:
+            wid, seq = self._pop()
+            if members.get(wid) == seq:
+                del members[wid]
+                return wid
+        return None
+
+    def _pop(self):
+        """Helper removing the next entry from the underlying container.
+        """
+        return self.q.popleft()
+
+    def _compact(self):
+        """Helper dropping invalidated entries once they dominate the queue.
+
+        Keeps memory bounded when workers are removed while idle.
+        """
+        if len(self.q) > 2 * len(self._members) + 16:
+            members = self._members
+            self.q = deque(e for e in self.q if members.get(e[0]) == e[1])
+        return
+#
+
+class LIFOQueue(LRUQueue):
+
+    """Worker queue handing out the most recently used worker first.
+
+    Keeps a small set of workers busy and their caches warm while the
+    remaining workers stay idle. All operations are O(1).
+    """
+
+    def _pop(self):
+        return self.q.pop()
+#
+
+class RoundRobinQueue(ServiceQueue):
+
+    """Worker queue serving idle workers in rounds.
+
+    Every idle worker is handed out at most once per round. A worker
+    coming back while the current round is still in progress has to
+    wait for the next round, even if it is the fastest one. This
+    keeps the load evenly spread when worker speeds differ. All
+    operations are O(1) (amortized for :func:`get`).
+    """
+
+    def __init__(self):
+        """Initialize queue instance.
+        """
+        self._round = 0
+        self._rounds = (deque(), deque())
+        # maps worker id -> (round entered, sequence number)
+        self._members = {}
+        # maps worker id -> last round the worker was handed out in
+        self._served = {}
+        self._seq = 0
+        return
+
+    def __contains__(self, wid):
+        return wid in self._members
+
+    def __len__(self):
+        return len(self._members)
+
+    def remove(self, wid):
+        self._members.pop(wid, None)
+        self._served.pop(wid, None)
+        if len(self._rounds[0]) + len(self._rounds[1]) > 2 * len(self._members) + 16:
+            members = self._members
+            self._rounds = tuple(deque(e for e in q if members.get(e[0]) == e[1:])
+                                 for q in self._rounds)
+        return
+
+    def put(self, wid, *args, **kwargs):
+        if wid in self._members:
+            return
+        rnd = self._round
+        if self._served.get(wid) == rnd:
+            rnd += 1
+        self._seq += 1
+        self._members[wid] = (rnd, self._seq)
+        self._rounds[rnd & 1].append((wid, rnd, self._seq))
+        return
+
+    def get(self):
+        members = self._members
+        for _ in (0, 1):
+            q = self._rounds[self._round & 1]
+            while q:
+                wid, rnd, seq = q.popleft()
+                if members.get(wid) == (rnd, seq):
+                    del members[wid]
+                    self._served[wid] = self._round
+                    return wid
+            if not members:
+                return None
+            # current round exhausted, start the next one
+            self._round += 1
+        return None
+#
 ###
 
 ### Local Variables:
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+"""Module containing the reply caches used by brokers and clients.
+
+A :class:`ReplyCache` maps request keys, see :func:`request_key`, to
+the reply message parts. Entries expire after their time to live and
+the least recently used entries are evicted when the cache exceeds its
+byte or entry budget.
+
+An entry may be kept for some time after it expired, so a stale reply
+can be served while a fresh one is fetched.
+
+A :class:`ClientCache` adds the per service configuration used by the
+clients, see :class:`mdp.client.MDPClient` and
+:func:`mdp.client.mdp_request`.
+"""
+
+__license__ = """
+    This file is part of MDP.
+
+    MDP is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    MDP is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with MDP.  If not, see <http://www.gnu.org/licenses/>.
+"""
+__author__ = 'Guido Goldstein'
+__email__ = 'gst-py@a-nugget.de'
+
+import time
+from collections import OrderedDict
+
+from util import frames_digest
+
+###
+
+ENTRY_OVERHEAD = 64  #: bytes accounted per entry in addition to the reply
+
+CLIENT_CACHE_ENTRIES = 10000    #: default entry limit of a ClientCache
+CLIENT_CACHE_BYTES = 16 << 20   #: default size of a ClientCache
+
+###
+
+def request_key(service, msg):
+    """Returns the cache key of a request to `service` with the parts `msg`.
+
+    :param service: the service name.
+    :type service:  str
+    :param msg:     the request parts.
+    :type msg:      list of str or zmq.Frame
+
+    :rtype: tuple of the service name and the digest of the parts
+    """
+    return (service, frames_digest(msg))
+#
+
+class ReplyCache(object):
+
+    """LRU cache of replies with time to live and byte budget.
+
+    Replies are stored as given, lists of `zmq.Frame` objects are not
+    copied. The size of an entry is the length of its parts plus
+    :data:`ENTRY_OVERHEAD`.
+
+    :param max_bytes:    maximum size of all entries.
+    :type max_bytes:     int
+    :param max_entries:  maximum number of entries, `None` for no limit.
+    :type max_entries:   int
+
+    :ivar hits:         lookups answered with a fresh entry.
+    :ivar stale_hits:   lookups answered with an expired entry.
+    :ivar misses:       lookups without entry.
+    :ivar evictions:    entries removed to stay within the budget.
+    :ivar expirations:  entries removed because they expired.
+    """
+
+    COUNTERS = ('hits', 'stale_hits', 'misses', 'evictions', 'expirations')
+
+    def __init__(self, max_bytes, max_entries=None):
+        """Initialize the cache.
+        """
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        # maps key -> [reply, size, expires, keep_until], oldest first
+        self._entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        return
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, key, now=None):
+        """Returns 2-tuple of the reply and if it is fresh, or `None`.
+
+        Expired entries are returned as not fresh until their stale
+        time is over, then they are removed.
+
+        :rtype: tuple of list and bool
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        if now is None:
+            now = time.time()
+        if entry[3] <= now:
+            self.nbytes -= entry[1]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        # most recently used
+        self._entries[key] = entry
+        if entry[2] <= now:
+            self.stale_hits += 1
+            return (entry[0], False)
+        self.hits += 1
+        return (entry[0], True)
+
+    def get(self, key, now=None):
+        """Returns the fresh reply stored for `key`, or `None`.
+        """
+        ret = self.lookup(key, now)
+        if ret is None or not ret[1]:
+            return None
+        return ret[0]
+
+    def put(self, key, reply, ttl, stale=0):
+        """Store a reply.
+
+        :param key:    the request key.
+        :type key:     str
+        :param reply:  the reply parts.
+        :type reply:   list of str or zmq.Frame
+        :param ttl:    time in milliseconds the reply is fresh.
+        :type ttl:     int
+        :param stale:  time in milliseconds the reply is kept after it
+                       expired.
+        :type stale:   int
+
+        :rtype: None
+        """
+        size = ENTRY_OVERHEAD + sum(len(p) for p in reply)
+        if size > self.max_bytes:
+            return
+        self.remove(key)
+        expires = time.time() + ttl / 1000.0
+        self._entries[key] = [reply, size, expires, expires + stale / 1000.0]
+        self.nbytes += size
+        entries = self._entries
+        while self.nbytes > self.max_bytes or (self.max_entries and
+                                               len(entries) > self.max_entries):
+            old_key, old = entries.popitem(last=False)
+            self.nbytes -= old[1]
+            self.evictions += 1
+        return
+
+    def remove(self, key):
+        """Remove the entry for `key`, if any.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+        return
+
+    def purge(self, service):
+        """Remove all entries of `service`.
+
+        Expects keys as returned by :func:`request_key`.
+        """
+        for key in [k for k in self._entries if k[0] == service]:
+            self.remove(key)
+        return
+
+    def clear(self):
+        """Remove all entries.
+        """
+        self._entries.clear()
+        self.nbytes = 0
+        return
+
+    def counters(self):
+        """Returns a list of (name, value) of the counters and the size.
+
+        :rtype: list of tuple
+        """
+        ret = [(name, getattr(self, name)) for name in self.COUNTERS]
+        ret.append(('entries', len(self._entries)))
+        ret.append(('bytes', self.nbytes))
+        return ret
+#
+
+class ClientCache(object):
+
+    """Cache of replies shared by the clients of an application.
+
+    Only replies of services configured with :func:`set_ttl` are
+    cached. The cache holds the reply bodies, without protocol and
+    service frames, so the same instance can be given to
+    :class:`mdp.client.MDPClient` and :func:`mdp.client.mdp_request`.
+
+    With a stale time set, an expired reply is still returned for that
+    long while the client fetches a fresh one (stale-while-revalidate).
+
+    :param max_entries:  maximum number of cached replies.
+    :type max_entries:   int
+    :param max_bytes:    maximum size of all cached replies.
+    :type max_bytes:     int
+    """
+
+    def __init__(self, max_entries=CLIENT_CACHE_ENTRIES, max_bytes=CLIENT_CACHE_BYTES):
+        """Initialize the ClientCache.
+        """
+        self.replies = ReplyCache(max_bytes, max_entries)
+        # maps service name -> (ttl, stale) in milliseconds
+        self._ttl = {}
+        return
+
+    def set_ttl(self, service, ttl, stale=0):
+        """Configure caching of the replies of a service.
+
+        :param service:  the service name.
+        :type service:   str
+        :param ttl:      time in milliseconds a reply is fresh, `None` to
+                         disable caching and drop the cached replies.
+        :type ttl:       int
+        :param stale:    time in milliseconds an expired reply is still
+                         returned while a fresh one is fetched.
+        :type stale:     int
+
+        :rtype: None
+        """
+        if ttl is None:
+            self._ttl.pop(service, None)
+            self.replies.purge(service)
+        else:
+            self._ttl[service] = (ttl, stale)
+        return
+
+    def key(self, service, msg):
+        """Returns the key of the request, `None` if the service is not cached.
+
+        :rtype: tuple
+        """
+        if service not in self._ttl:
+            return None
+        return request_key(service, msg)
+
+    def lookup(self, key):
+        """Returns 2-tuple of a copy of the reply and if it is fresh, or `None`.
+
+        See :func:`ReplyCache.lookup`.
+
+        :rtype: tuple of list and bool
+        """
+        hit = self.replies.lookup(key)
+        if hit is None:
+            return None
+        return (list(hit[0]), hit[1])
+
+    def put(self, key, reply):
+        """Store the reply body of the request with `key`.
+
+        :param key:    the key returned by :func:`key`.
+        :type key:     tuple
+        :param reply:  the reply body.
+        :type reply:   list of str
+
+        :rtype: None
+        """
+        cfg = self._ttl.get(key[0])
+        if cfg is not None:
+            self.replies.put(key, list(reply), cfg[0], cfg[1])
+        return
+#
+###
+
+### Local Variables:
+### buffer-file-coding-system: utf-8
+### mode: python
+### End:
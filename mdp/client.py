@@ -24,16 +24,30 @@ __license__ = """
 __author__ = 'Guido Goldstein'
 __email__ = 'gst-py@a-nugget.de'
 
+import os
+import math
+import time
+import struct
+import threading
+from collections import deque
 from exceptions import UserWarning
+from functools import partial
 
 import zmq
 from zmq.eventloop.zmqstream import ZMQStream
-from zmq.eventloop.ioloop import IOLoop, DelayedCallback
+from zmq.eventloop.ioloop import IOLoop
+
+from util import Deadlines, DeadlineManager
+from pool import BrokerPool
+from broker import MDP_BUSY, MDP_FAILED
 
 ###
 
 PROTO_VERSION = b'MDPC01'
 
+#: replies of the broker itself, never cached
+_BROKER_STATUS = ([MDP_BUSY], [MDP_FAILED])
+
 ###
 
 class InvalidStateError(RuntimeError):
@@ -59,32 +73,75 @@ class MDPClient(object):
     Objects of this class are ment to be integrated into the
     asynchronous IOLoop of pyzmq.
 
+    If a :class:`BrokerPool` is given instead of an endpoint, each
+    request goes to the broker chosen by the pool and the client
+    reconnects as needed. After a timeout the socket is replaced, so
+    the next request can be sent right away, usually to another broker.
+
+    With a :class:`mdp.cache.ClientCache` configured for the service, requests
+    answered from the cache are not sent. The cached reply is passed to
+    :func:`on_message` from the IOLoop. A stale reply is refreshed in
+    the background while the socket is idle; a request needing the
+    socket during that time replaces it, giving up the refresh.
+
     :param context:  the ZeroMQ context to create the socket in.
     :type context:   zmq.Context
-    :param endpoint: the enpoint to connect to.
-    :type endpoint:  str
+    :param endpoint: the enpoint to connect to, or a pool of brokers.
+    :type endpoint:  str or BrokerPool
     :param service:  the service the client should use
     :type service:   str
+    :param cache:    the reply cache to use, if any.
+    :type cache:     ClientCache
     """
 
     _proto_version = b'MDPC01'
 
-    def __init__(self, context, endpoint, service):
+    def __init__(self, context, endpoint, service, cache=None):
         """Initialize the MDPClient.
         """
-        socket = context.socket(zmq.REQ)
-        ioloop = IOLoop.instance()
+        self.context = context
         self.service = service
-        self.endpoint = endpoint
-        self.stream = ZMQStream(socket, ioloop)
-        self.stream.on_recv(self._on_message)
+        self.endpoint = None
+        self.stream = None
+        self.pool = None
         self.can_send = True
         self._proto_prefix = [ PROTO_VERSION, service]
         self._tmo = None
         self.timed_out = False
+        # broker of the outstanding request and the time it was sent
+        self._broker = None
+        self._sent_at = 0
+        self.cache = cache
+        # cache key of the outstanding request and if it is a refresh
+        self._key = None
+        self._refreshing = False
+        if isinstance(endpoint, BrokerPool):
+            self.pool = endpoint
+        else:
+            self._connect(endpoint)
+        return
+
+    def _connect(self, endpoint):
+        """Helper creating the socket and the stream connected to `endpoint`.
+        """
+        socket = self.context.socket(zmq.REQ)
+        ioloop = IOLoop.instance()
+        self.endpoint = endpoint
+        self.stream = ZMQStream(socket, ioloop)
+        self.stream.on_recv(self._on_message)
         socket.connect(endpoint)
         return
 
+    def _close_stream(self):
+        """Helper closing the stream and the socket.
+        """
+        self.stream.socket.setsockopt(zmq.LINGER, 0)
+        self.stream.socket.close()
+        self.stream.close()
+        self.stream = None
+        self.endpoint = None
+        return
+
     def shutdown(self):
         """Method to deactivate the client connection completely.
 
@@ -94,12 +151,17 @@ class MDPClient(object):
 
         :rtype: None
         """
+        if self._tmo:
+            DeadlineManager.instance().cancel(self._tmo)
+            self._tmo = None
+        if self._broker:
+            self.pool.cancel(self._broker)
+            self._broker = None
+        self._key = None
+        self._refreshing = False
         if not self.stream:
             return
-        self.stream.socket.setsockopt(zmq.LINGER, 0)
-        self.stream.socket.close()
-        self.stream.close()
-        self.stream = None
+        self._close_stream()
         return
 
     def request(self, msg, timeout=None):
@@ -114,13 +176,68 @@ class MDPClient(object):
         """
         if not self.can_send:
             raise InvalidStateError()
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(self.service, msg)
+            hit = self.cache.lookup(key) if key is not None else None
+            if hit is not None:
+                reply, fresh = hit
+                if not fresh and not self._refreshing:
+                    self._send(msg)
+                    self._key = key
+                    self._refreshing = True
+                self.can_send = False
+                IOLoop.instance().add_callback(partial(self._on_cached, reply))
+                return
+        if self._refreshing:
+            self._cancel_refresh()
+        self._send(msg)
+        self._key = key
+        self.can_send = False
+        if timeout:
+            self._start_timeout(timeout)
+        return
+
+    def _send(self, msg):
+        """Helper sending the request to the broker.
+        """
+        if self.pool:
+            broker = self.pool.acquire()
+            if broker.endpoint != self.endpoint:
+                if self.stream:
+                    self._close_stream()
+                self._connect(broker.endpoint)
+            self._broker = broker
+            self._sent_at = time.time()
         # prepare full message
         to_send = self._proto_prefix[:]
         to_send.extend(msg)
         self.stream.send_multipart(to_send)
-        self.can_send = False
-        if timeout:
-            self._start_timeout(timeout)
+        return
+
+    def _cancel_refresh(self):
+        """Helper giving up the outstanding refresh of a cached reply.
+
+        The REQ socket waits for the reply, so it is replaced.
+        """
+        self._refreshing = False
+        self._key = None
+        endpoint = self.endpoint
+        self._close_stream()
+        if self._broker:
+            self.pool.cancel(self._broker)
+            self._broker = None
+        else:
+            self._connect(endpoint)
+        return
+
+    def _on_cached(self, reply):
+        """Helper passing a reply from the cache to :func:`on_message`.
+        """
+        self.can_send = True
+        to_send = self._proto_prefix[:]
+        to_send.extend(reply)
+        self.on_message(to_send)
         return
 
     def _on_timeout(self):
@@ -128,17 +245,26 @@ class MDPClient(object):
         """
         self.timed_out = True
         self._tmo = None
+        self._key = None
+        if self._broker:
+            self.pool.release(self._broker, None)
+            self._broker = None
+            # the REQ socket waits for the lost reply, replace it
+            self._close_stream()
+            self.can_send = True
         self.on_timeout()
         return
 
     def _start_timeout(self, timeout):
         """Helper for starting the timeout.
 
+        Uses the shared :class:`DeadlineManager` instead of a timer of
+        its own.
+
         :param timeout:  the time to wait in milliseconds.
         :type timeout:   int
         """
-        self._tmo = DelayedCallback(self._on_timeout, timeout)
-        self._tmo.start()
+        self._tmo = DeadlineManager.instance().add_timeout(timeout, self._on_timeout)
         return
 
     def _on_message(self, msg):
@@ -149,8 +275,20 @@ class MDPClient(object):
         """
         if self._tmo:
             # disable timout
-            self._tmo.stop()
+            DeadlineManager.instance().cancel(self._tmo)
             self._tmo = None
+        if self._broker:
+            self.pool.release(self._broker, time.time() - self._sent_at)
+            self._broker = None
+        if self._key is not None:
+            body = msg[2:]
+            if body not in _BROKER_STATUS:
+                self.cache.put(self._key, body)
+            self._key = None
+        if self._refreshing:
+            # the client did not wait for this reply
+            self._refreshing = False
+            return
         # setting state before invoking on_message, so we can request from there
         self.can_send = True
         self.on_message(msg)
@@ -170,42 +308,481 @@ class MDPClient(object):
         """
         pass
 #
-###
 
-from zmq.core.poll import select
+class MDPPipelineClient(object):
+
+    """Class for the MDP client side allowing many outstanding requests.
+
+    Asynchronous encapsulation of a zmq.XREQ socket. Each request gets
+    an id which is sent as a return address frame in front of the
+    MDP frames. The broker handles it like any other address frame and
+    sends it back with the reply, so replies can be matched to their
+    requests in any order. No changes to broker or workers are needed.
+
+    Requests go to `service`, unless another service is passed to
+    :func:`request`.
+
+    The reply to a request is passed to the callback given to
+    :func:`request`, or to :func:`on_message` if there is none. On
+    timeout the callback is called with `None`, or :func:`on_timeout`.
+    Timeouts are handled by the shared :class:`DeadlineManager`.
+
+    At most `max_inflight` requests are sent without a reply. Further
+    requests are held back until replies or timeouts free a slot.
 
-def mdp_request(socket, service, msg, timeout=None):
+    :param context:      the ZeroMQ context to create the socket in.
+    :type context:       zmq.Context
+    :param endpoint:     the enpoint to connect to.
+    :type endpoint:      str
+    :param service:      the default service of the requests.
+    :type service:       str
+    :param max_inflight: maximum number of outstanding requests.
+    :type max_inflight:  int
+    """
+
+    _proto_version = b'MDPC01'
+
+    def __init__(self, context, endpoint, service, max_inflight=1000):
+        """Initialize the MDPPipelineClient.
+        """
+        socket = context.socket(zmq.XREQ)
+        ioloop = IOLoop.instance()
+        self.service = service
+        self.endpoint = endpoint
+        self.max_inflight = max_inflight
+        self.stream = ZMQStream(socket, ioloop)
+        self.stream.on_recv(self._on_message)
+        self._last_id = 0
+        # maps request id -> [callback, timeout]
+        self._inflight = {}
+        # requests held back by max_inflight
+        self._waiting = deque()
+        socket.connect(endpoint)
+        return
+
+    def __len__(self):
+        """Returns the number of requests not answered yet.
+        """
+        return len(self._inflight) + len(self._waiting)
+
+    def shutdown(self):
+        """Method to deactivate the client connection completely.
+
+        Will delete the stream and the underlying socket. Outstanding
+        requests are dropped without calling their callbacks.
+
+        .. warning:: The instance MUST not be used after :func:`shutdown` has been called.
+
+        :rtype: None
+        """
+        if not self.stream:
+            return
+        deadlines = DeadlineManager.instance()
+        for cb, tmo in self._inflight.itervalues():
+            if tmo:
+                deadlines.cancel(tmo)
+        self._inflight = {}
+        self._waiting.clear()
+        self.stream.socket.setsockopt(zmq.LINGER, 0)
+        self.stream.socket.close()
+        self.stream.close()
+        self.stream = None
+        return
+
+    def request(self, msg, callback=None, timeout=None, service=None):
+        """Send the given message.
+
+        :param msg:      message parts to send.
+        :type msg:       list of str
+        :param callback: called with the reply parts, or `None` on timeout.
+        :type callback:  callable
+        :param timeout:  time to wait in milliseconds.
+        :type timeout:   int
+        :param service:  the service to send the request to, defaults
+                         to the one given to the constructor.
+        :type service:   str
+
+        :rtype: str, the request id
+        """
+        if not isinstance(msg, list):
+            msg = [msg]
+        self._last_id += 1
+        rid = struct.pack('!Q', self._last_id)
+        service = service or self.service
+        if len(self._inflight) >= self.max_inflight:
+            self._waiting.append((rid, service, msg, callback, timeout))
+        else:
+            self._send(rid, service, msg, callback, timeout)
+        return rid
+
+    def _send(self, rid, service, msg, callback, timeout):
+        """Helper sending a request and starting its timeout.
+        """
+        to_send = [rid, b'', PROTO_VERSION, service]
+        to_send.extend(msg)
+        self.stream.send_multipart(to_send)
+        tmo = None
+        if timeout:
+            tmo = DeadlineManager.instance().add_timeout(timeout, partial(self._on_timeout, rid))
+        self._inflight[rid] = [callback, tmo]
+        return
+
+    def _send_waiting(self):
+        """Helper sending held back requests while slots are free.
+        """
+        while self._waiting and len(self._inflight) < self.max_inflight:
+            self._send(*self._waiting.popleft())
+        return
+
+    def _on_timeout(self, rid):
+        """Helper called after timeout of request `rid`.
+        """
+        entry = self._inflight.pop(rid, None)
+        if entry is None:
+            return
+        callback = entry[0]
+        if callback:
+            callback(None)
+        else:
+            self.on_timeout(rid)
+        self._send_waiting()
+        return
+
+    def _on_message(self, msg):
+        """Helper method called on message receive.
+
+        Replies to unknown or timed out requests are dropped.
+
+        :param msg:   list of message parts.
+        :type msg:    list of str
+        """
+        # frames: request id, empty, protocol, service, reply...
+        entry = self._inflight.pop(msg[0], None)
+        if entry is None:
+            return
+        callback, tmo = entry
+        if tmo:
+            DeadlineManager.instance().cancel(tmo)
+        if callback:
+            callback(msg[4:])
+        else:
+            self.on_message(msg[0], msg[4:])
+        self._send_waiting()
+        return
+
+    def on_message(self, rid, msg):
+        """Public method called when a reply without callback arrived.
+
+        .. note:: Does nothing. Should be overloaded!
+        """
+        pass
+
+    def on_timeout(self, rid):
+        """Public method called when a request without callback timed out.
+
+        .. note:: Does nothing. Should be overloaded!
+        """
+        pass
+#
+###
+
+def mdp_request(socket, service, msg, timeout=None, cache=None):
     """Synchronous MDP request.
 
     This function sends a request to the given service and
     waits for a reply.
 
     If timeout is set and no reply received in the given time
-    the function will return `None`.
+    the function will return `None`. The REQ socket cannot be used
+    any more then, see :class:`MDPSyncClient` for a client replacing
+    it automatically.
+
+    If a :class:`BrokerPool` is passed instead of a socket, the request
+    goes to the broker chosen by the pool, using the pool's socket for
+    that broker. After a timeout the socket is replaced.
+
+    With a :class:`mdp.cache.ClientCache` configured for the service, a fresh
+    cached reply is returned without sending the request. There is no
+    background to refresh a stale reply in, so the request is sent and
+    the stale reply only returned if no answer arrives in time.
 
-    :param socket:    zmq REQ socket to use.
-    :type socket:     zmq.Socket
+    :param socket:    zmq REQ socket to use, or a pool of brokers.
+    :type socket:     zmq.Socket or BrokerPool
     :param service:   service id to send the msg to.
     :type service:    str
     :param msg:       list of message parts to send.
     :type msg:        list of str
     :param timeout:   time to wait for answer in seconds.
     :type timeout:    float
+    :param cache:     the reply cache to use, if any.
+    :type cache:      ClientCache
 
     :rtype list of str:
     """
+    key = cache.key(service, msg) if cache is not None else None
+    if key is not None:
+        hit = cache.lookup(key)
+        if hit is not None and hit[1]:
+            return [service] + hit[0]
+        ret = mdp_request(socket, service, msg, timeout)
+        if ret is None:
+            if hit is not None:
+                return [service] + hit[0]
+            return None
+        if ret[1:] not in _BROKER_STATUS:
+            cache.put(key, ret[1:])
+        return ret
+    if isinstance(socket, BrokerPool):
+        pool = socket
+        broker = pool.acquire()
+        started = time.time()
+        ret = mdp_request(pool.socket(broker), service, msg, timeout)
+        if ret is None:
+            pool.close_socket(broker)
+            pool.release(broker, None)
+        else:
+            pool.release(broker, time.time() - started)
+        return ret
     if not timeout or timeout < 0.0:
         timeout = None
     to_send = [PROTO_VERSION, service]
     to_send.extend(msg)
     socket.send_multipart(to_send)
     ret = None
-    rlist, _, _ = select([socket], [], [], timeout)
-    if rlist and rlist[0] == socket:
+    if socket.poll(timeout * 1000 if timeout else None):
         ret = socket.recv_multipart()
         ret.pop(0) # remove service from reply
     return ret
 #
+
+def mdp_request_many(socket, requests, timeout=None, max_inflight=None):
+    """Synchronous MDP requests, sent without waiting for each reply.
+
+    The requests are sent through an XREQ socket with a request id in
+    front, like :class:`MDPPipelineClient` does. Replies are matched to
+    their request by the id and returned in the order of `requests`, in
+    the same form :func:`mdp_request` returns them. Requests without a
+    reply within `timeout` seconds after they were sent get `None`.
+
+    Replies arriving for requests of earlier calls are dropped, so the
+    socket can be used again even after timeouts.
+
+    :param socket:       zmq XREQ socket to use.
+    :type socket:        zmq.Socket
+    :param requests:     2-tuples of service and list of message parts.
+    :type requests:      list of tuple
+    :param timeout:      time to wait for each answer in seconds.
+    :type timeout:       float
+    :param max_inflight: maximum number of requests sent without reply.
+    :type max_inflight:  int
+
+    :rtype: list of (list of str or None)
+    """
+    results = [None] * len(requests)
+    if not timeout or timeout < 0.0:
+        timeout = None
+    max_inflight = max_inflight or len(requests)
+    # ids are unique across calls, so stale replies are not mistaken
+    prefix = os.urandom(4)
+    # maps request id -> [index, deadline handle]
+    pending = {}
+    deadlines = Deadlines()
+    todo = iter(xrange(len(requests)))
+    done = False
+    while True:
+        while not done and len(pending) < max_inflight:
+            i = next(todo, None)
+            if i is None:
+                done = True
+                break
+            service, msg = requests[i]
+            rid = prefix + struct.pack('!Q', i)
+            to_send = [rid, b'', PROTO_VERSION, service]
+            to_send.extend(msg)
+            socket.send_multipart(to_send)
+            tmo = None
+            if timeout:
+                tmo = deadlines.add(time.time() + timeout, partial(pending.pop, rid, None))
+            pending[rid] = [i, tmo]
+        if not pending:
+            break
+        wait = None
+        next_deadline = deadlines.next_deadline()
+        if next_deadline is not None:
+            # poll takes whole milliseconds, round up to not wake up early
+            wait = max(1, int(math.ceil((next_deadline - time.time()) * 1000)))
+        if socket.poll(wait):
+            while True:
+                try:
+                    msg = socket.recv_multipart(zmq.NOBLOCK)
+                except zmq.ZMQError, e:
+                    if e.errno == zmq.EAGAIN:
+                        break
+                    raise
+                # frames: request id, empty, protocol, service, reply...
+                entry = pending.pop(msg[0], None)
+                if entry is None:
+                    continue
+                i, tmo = entry
+                if tmo:
+                    deadlines.cancel(tmo)
+                results[i] = msg[3:]
+        deadlines.run()
+    return results
+#
+
+class MDPSyncClient(object):
+
+    """Synchronous MDP client for code not running an IOLoop.
+
+    Sockets are kept in a pool and reused by later calls, so a request
+    costs no socket setup. Calls may be made from several threads at
+    once, each call uses a socket of its own.
+
+    Requests without reply in time are retried Lazy Pirate style: the
+    socket, whose state is unknown now, is closed and the request is
+    sent again through a fresh one, at most `retries` times.
+
+    :param context:   the ZeroMQ context to create the sockets in.
+    :type context:    zmq.Context
+    :param endpoint:  the broker endpoint, or a pool of brokers.
+    :type endpoint:   str or BrokerPool
+    :param timeout:   default time to wait for a reply in seconds.
+    :type timeout:    float
+    :param retries:   default number of times a request is sent again.
+    :type retries:    int
+    :param max_inflight: maximum number of requests :func:`request_many`
+                      sends without reply.
+    :type max_inflight:  int
+    """
+
+    def __init__(self, context, endpoint, timeout=2.5, retries=3, max_inflight=1000):
+        """Initialize the MDPSyncClient.
+        """
+        self.context = context
+        self.pool = endpoint if isinstance(endpoint, BrokerPool) else None
+        self.endpoint = None if self.pool else endpoint
+        self.timeout = timeout
+        self.retries = retries
+        self.max_inflight = max_inflight
+        # maps (socket type, endpoint) -> list of idle sockets
+        self._idle = {}
+        self._lock = threading.Lock()
+        return
+
+    def _checkout(self, kind, endpoint):
+        """Helper returning an idle socket, creating one if there is none.
+        """
+        with self._lock:
+            idle = self._idle.get((kind, endpoint))
+            if idle:
+                return idle.pop()
+        socket = self.context.socket(kind)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(endpoint)
+        return socket
+
+    def _checkin(self, kind, endpoint, socket):
+        """Helper putting a socket back into the pool.
+        """
+        with self._lock:
+            self._idle.setdefault((kind, endpoint), []).append(socket)
+        return
+
+    def _attempt(self, kind, call, count):
+        """Helper running `call` on a pooled socket with retries.
+
+        `call` gets the socket and returns a list of results, `None`
+        for the failed ones; failed items are passed to the next attempt.
+        `count` is the number of items.
+        """
+        results = [None] * count
+        todo = range(count)
+        for _ in xrange(self.retries + 1):
+            broker = None
+            endpoint = self.endpoint
+            if self.pool:
+                broker = self.pool.acquire()
+                endpoint = broker.endpoint
+            socket = self._checkout(kind, endpoint)
+            started = time.time()
+            ret = call(socket, todo)
+            failed = []
+            for i, r in zip(todo, ret):
+                if r is None:
+                    failed.append(i)
+                else:
+                    results[i] = r
+            if failed:
+                socket.close()
+            else:
+                self._checkin(kind, endpoint, socket)
+            if broker:
+                if failed:
+                    self.pool.release(broker, None)
+                else:
+                    self.pool.release(broker, (time.time() - started) / len(todo))
+            if not failed:
+                break
+            todo = failed
+        return results
+
+    def request(self, service, msg, timeout=None):
+        """Send a request and wait for the reply.
+
+        :param service:   service id to send the msg to.
+        :type service:    str
+        :param msg:       list of message parts to send.
+        :type msg:        list of str
+        :param timeout:   time to wait for each attempt in seconds.
+        :type timeout:    float
+
+        :rtype: list of str as returned by :func:`mdp_request`, or
+                `None` if all attempts timed out.
+        """
+        timeout = timeout or self.timeout
+
+        def call(socket, todo):
+            return [mdp_request(socket, service, msg, timeout)]
+
+        return self._attempt(zmq.REQ, call, 1)[0]
+
+    def request_many(self, requests, timeout=None):
+        """Send many requests and wait for all replies.
+
+        See :func:`mdp_request_many`. Requests without reply are retried.
+
+        :param requests:  2-tuples of service and list of message parts.
+        :type requests:   list of tuple
+        :param timeout:   time to wait for each reply in seconds.
+        :type timeout:    float
+
+        :rtype: list of replies in the order of `requests`, `None` for
+                requests for which all attempts timed out.
+        """
+        if not requests:
+            return []
+        timeout = timeout or self.timeout
+
+        def call(socket, todo):
+            return mdp_request_many(socket, [requests[i] for i in todo], timeout,
+                                    self.max_inflight)
+
+        return self._attempt(zmq.XREQ, call, len(requests))
+
+    def shutdown(self):
+        """Close all pooled sockets.
+
+        :rtype: None
+        """
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for sockets in idle.itervalues():
+            for socket in sockets:
+                socket.close()
+        return
+#
 ###
 
 ### Local Variables:
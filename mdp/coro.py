@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+
+"""Module providing future and coroutine based MDP APIs.
+
+Instead of subclassing and callbacks, requests return futures and
+code waiting for them is written as generator based coroutines::
+
+    @coroutine
+    def fetch(client):
+        reply = yield client.request(b'echo', [b'hello'], timeout=1000)
+        replies = yield [client.request(b'echo', [b'%d' % i]) for i in range(10)]
+        raise Return(replies)
+
+A coroutine yields futures, or lists of futures to wait for all of them,
+and is resumed in the IOLoop with their results. Its value is given by
+raising :class:`Return`. Calling a coroutine returns a future of that
+value.
+
+If a future a coroutine waits for is cancelled, e.g. by
+:func:`MDPAsyncClient.shutdown`, :class:`CancelledError` is raised in
+the coroutine.
+
+Coroutines fit the `handle` method of :class:`mdp.worker.MDPAsyncWorker`,
+so a worker can run many of them concurrently.
+
+The futures are :class:`concurrent.futures.Future` instances, which on
+Python 2 requires the `futures` package.
+"""
+
+__license__ = """
+    This file is part of MDP.
+
+    MDP is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    MDP is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with MDP.  If not, see <http://www.gnu.org/licenses/>.
+"""
+__author__ = 'Guido Goldstein'
+__email__ = 'gst-py@a-nugget.de'
+
+import types
+from functools import partial, wraps
+
+from concurrent.futures import Future, CancelledError
+from zmq.eventloop.ioloop import IOLoop
+
+from client import MDPPipelineClient, RequestTimeout
+
+###
+
+class Return(Exception):
+    """Exception raised by a coroutine to return `value`.
+    """
+
+    def __init__(self, value=None):
+        Exception.__init__(self)
+        self.value = value
+        return
+#
+
+###
+
+def _exception(future):
+    """Helper returning the exception of the done `future`.
+
+    Returns :class:`CancelledError` for a cancelled future instead of
+    raising it.
+    """
+    if future.cancelled():
+        return CancelledError()
+    return future.exception()
+#
+
+def _set_outcome(future, value=None, exc=None):
+    """Helper completing `future` unless it was cancelled.
+    """
+    if future.cancelled():
+        return
+    if exc is not None:
+        future.set_exception(exc)
+    else:
+        future.set_result(value)
+    return
+#
+
+def gather(*futures):
+    """Returns a future of the list of results of all `futures`.
+
+    Fails with the exception of the first future failing, or with
+    :class:`CancelledError` if one is cancelled.
+    """
+    result = Future()
+    values = [None] * len(futures)
+    state = {'pending': len(futures)}
+    if not futures:
+        result.set_result(values)
+        return result
+    ioloop = IOLoop.instance()
+
+    def on_done(i, f):
+        if result.done():
+            return
+        exc = _exception(f)
+        if exc is not None:
+            _set_outcome(result, exc=exc)
+            return
+        values[i] = f.result()
+        state['pending'] -= 1
+        if not state['pending']:
+            _set_outcome(result, values)
+        return
+
+    for i, f in enumerate(futures):
+        done = partial(on_done, i)
+        f.add_done_callback(lambda f, done=done: ioloop.add_callback(partial(done, f)))
+    return result
+#
+
+class _Runner(object):
+
+    """Helper driving a coroutine generator.
+    """
+
+    def __init__(self, gen, future):
+        self.gen = gen
+        self.future = future
+        return
+
+    def run(self, value=None, exc=None):
+        """Resume the generator until it waits for a pending future or ends.
+        """
+        while True:
+            try:
+                if exc is not None:
+                    yielded = self.gen.throw(exc)
+                else:
+                    yielded = self.gen.send(value)
+            except StopIteration:
+                _set_outcome(self.future)
+                return
+            except Return, e:
+                _set_outcome(self.future, e.value)
+                return
+            except Exception, e:
+                _set_outcome(self.future, exc=e)
+                return
+            if isinstance(yielded, (list, tuple)):
+                yielded = gather(*yielded)
+            if not yielded.done():
+                ioloop = IOLoop.instance()
+                yielded.add_done_callback(
+                    lambda f: ioloop.add_callback(partial(self._resume, f)))
+                return
+            value, exc = None, _exception(yielded)
+            if exc is None:
+                value = yielded.result()
+        return
+
+    def _resume(self, future):
+        """Helper called in the IOLoop when the awaited future is done.
+        """
+        exc = _exception(future)
+        if exc is None:
+            self.run(future.result())
+        else:
+            self.run(exc=exc)
+        return
+#
+
+def coroutine(func):
+    """Decorator turning a generator function into a coroutine.
+
+    The decorated function returns a future of the value the coroutine
+    returns with :class:`Return`, or of the exception it raises.
+    Functions which are no generators are allowed as well.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        future = Future()
+        try:
+            result = func(*args, **kwargs)
+        except Return, e:
+            future.set_result(e.value)
+            return future
+        except Exception, e:
+            future.set_exception(e)
+            return future
+        if isinstance(result, types.GeneratorType):
+            _Runner(result, future).run()
+        else:
+            future.set_result(result)
+        return future
+    return wrapper
+#
+###
+
+class MDPAsyncClient(object):
+
+    """MDP client returning futures of the replies.
+
+    Requests to any service can be sent through one client, and any
+    number of requests may be outstanding. Requests are sent by a
+    :class:`MDPPipelineClient`, at most `max_inflight` at a time.
+
+    :param context:      the ZeroMQ context to create the socket in.
+    :type context:       zmq.Context
+    :param endpoint:     the broker endpoint to connect to.
+    :type endpoint:      str
+    :param max_inflight: maximum number of requests sent without reply.
+    :type max_inflight:  int
+    """
+
+    def __init__(self, context, endpoint, max_inflight=1000):
+        """Initialize the MDPAsyncClient.
+        """
+        self._client = MDPPipelineClient(context, endpoint, None, max_inflight)
+        # futures of the outstanding requests
+        self._pending = set()
+        return
+
+    def __len__(self):
+        """Returns the number of requests not answered yet.
+        """
+        return len(self._pending)
+
+    def request(self, service, msg, timeout=None):
+        """Send a request.
+
+        :param service:  the service to send the request to.
+        :type service:   str
+        :param msg:      message parts to send.
+        :type msg:       list of str
+        :param timeout:  time to wait in milliseconds.
+        :type timeout:   int
+
+        :rtype: Future of the reply parts, failing with
+                :class:`RequestTimeout` on timeout.
+        """
+        future = Future()
+        self._pending.add(future)
+        self._client.request(msg, partial(self._on_reply, future, service), timeout,
+                             service)
+        return future
+
+    def _on_reply(self, future, service, msg):
+        """Helper called with the reply, or `None` on timeout.
+        """
+        self._pending.discard(future)
+        if msg is None:
+            _set_outcome(future, exc=RequestTimeout('no reply from %r' % service))
+        else:
+            _set_outcome(future, msg)
+        return
+
+    def shutdown(self):
+        """Close the connection and cancel all outstanding requests.
+
+        .. warning:: The instance MUST not be used after :func:`shutdown` has been called.
+
+        :rtype: None
+        """
+        self._client.shutdown()
+        pending = self._pending
+        self._pending = set()
+        for future in pending:
+            future.cancel()
+        return
+#
+###
+
+### Local Variables:
+### buffer-file-coding-system: utf-8
+### mode: python
+### End:
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+"""Module containing a MDP broker able to forward requests to peer brokers.
+
+Brokers peering with each other publish the number of idle workers and
+queued requests per service. A broker without an idle worker for a
+requested service forwards the request to the peer with the most idle
+workers for it. The reply is routed back through the original broker.
+
+Each peering broker needs two endpoints: its request endpoint, which
+is the normal broker endpoint peers send requests to, and a state
+endpoint it publishes its load on.
+
+For the MDP specification see: http://rfc.zeromq.org/spec:7
+"""
+
+__license__ = """
+    This file is part of MDP.
+
+    MDP is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    MDP is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with MDP.  If not, see <http://www.gnu.org/licenses/>.
+"""
+__author__ = 'Guido Goldstein'
+__email__ = 'gst-py@a-nugget.de'
+
+import time
+
+import zmq
+from zmq.eventloop.zmqstream import ZMQStream
+from zmq.eventloop.ioloop import PeriodicCallback
+
+from broker import MDPBroker, split_priority
+from util import split_frames
+
+###
+
+STATE_INTERVAL = 1000  #: ms between two load publications
+STATE_EXPIRY = 3       #: publications missed before a peer's state is ignored
+
+PEER_PREFIX = b'mdp-peer:'  #: identity prefix of the sockets forwarding to peers
+
+###
+
+class PeeringBroker(MDPBroker):
+
+    """MDP broker forwarding requests to peer brokers.
+
+    A client request is forwarded if no local worker is idle for the
+    service (or the service is unknown locally) and a peer announced
+    idle workers for it. The peer with the most idle workers is chosen.
+    If no peer has an idle worker but the service is unknown locally,
+    the request goes to the peer with the shortest backlog. Requests
+    received from peers are never forwarded again, so requests cannot
+    loop.
+
+    Forwarded requests are sent through an XREQ socket with the client
+    return address in front, the same way a pipelining client sends its
+    request ids. The peer handles them like any other request and the
+    reply comes back with the return address, so no state is kept for
+    forwarded requests.
+
+    :param context:    the context to use for socket creation.
+    :type context:     zmq.Context
+    :param main_ep:    the primary endpoint for workers and clients.
+    :type main_ep:     str
+    :param name:       the name of this broker, unique among its peers.
+    :type name:        str
+    :param state_ep:   the endpoint to publish the load of this broker on.
+    :type state_ep:    str
+    :param peers:      maps peer names to (request endpoint, state endpoint).
+    :type peers:       dict
+
+    All other keyword arguments are passed to :class:`MDPBroker`.
+    """
+
+    def __init__(self, context, main_ep, name, state_ep, peers, **kwargs):
+        """Init PeeringBroker instance.
+        """
+        MDPBroker.__init__(self, context, main_ep, **kwargs)
+        self.name = name
+        socket = context.socket(zmq.PUB)
+        socket.bind(state_ep)
+        self.state_pub = ZMQStream(socket, self.ioloop)
+        socket = context.socket(zmq.SUB)
+        socket.setsockopt(zmq.SUBSCRIBE, b'')
+        self.state_sub = ZMQStream(socket, self.ioloop)
+        self.state_sub.on_recv(self.on_peer_state)
+        self.peer_streams = {}
+        for peer, (request_ep, peer_state_ep) in peers.iteritems():
+            self.state_sub.connect(peer_state_ep)
+            socket = context.socket(zmq.XREQ)
+            socket.setsockopt(zmq.IDENTITY, PEER_PREFIX + name)
+            socket.connect(request_ep)
+            stream = ZMQStream(socket, self.ioloop)
+            stream.on_recv(self.on_peer_reply, copy=False)
+            self.peer_streams[peer] = stream
+        # maps peer name -> (time received, {service: [idle, backlog]})
+        self._peer_state = {}
+        self.state_timer = PeriodicCallback(self.publish_state, STATE_INTERVAL,
+                                            self.ioloop)
+        self.state_timer.start()
+        return
+
+    def shutdown(self):
+        """Shutdown broker and peer connections.
+
+        .. warning:: The instance MUST not be used after :func:`shutdown` has been called.
+
+        :rtype: None
+        """
+        if self.state_timer:
+            self.state_timer.stop()
+            self.state_timer = None
+        for stream in [self.state_pub, self.state_sub] + self.peer_streams.values():
+            stream.on_recv(None)
+            stream.socket.setsockopt(zmq.LINGER, 0)
+            stream.socket.close()
+            stream.close()
+        self.peer_streams = {}
+        self._peer_state = {}
+        MDPBroker.shutdown(self)
+        return
+
+    def publish_state(self):
+        """Publish the idle workers and queued requests of all services.
+
+        The message consists of the broker name followed by triples of
+        service name, number of idle workers and number of queued
+        requests.
+
+        :rtype: None
+        """
+        to_send = [self.name]
+        for name, srv in self._services.iteritems():
+            if srv.workers or srv.requests:
+                to_send.extend((name, str(len(srv.worker_q)), str(len(srv.requests))))
+        self.state_pub.send_multipart(to_send)
+        return
+
+    def on_peer_state(self, msg):
+        """Process the load published by a peer.
+
+        :param msg: message parts
+        :type msg:  list of str
+
+        :rtype: None
+        """
+        peer = msg[0]
+        if peer not in self.peer_streams:
+            return
+        services = {}
+        for i in xrange(1, len(msg) - 2, 3):
+            services[msg[i]] = [int(msg[i+1]), int(msg[i+2])]
+        self._peer_state[peer] = (time.time(), services)
+        return
+
+    def choose_peer(self, service, local):
+        """Returns the peer to forward a request for `service` to, or `None`.
+
+        :param service:  the service name.
+        :type service:   str
+        :param local:    if the service is known locally.
+        :type local:     bool
+
+        :rtype: str
+        """
+        oldest = time.time() - STATE_EXPIRY * STATE_INTERVAL / 1000.0
+        best = None
+        best_idle = 0
+        best_backlog = None
+        for peer, (received, services) in self._peer_state.iteritems():
+            if received < oldest or service not in services:
+                continue
+            idle, backlog = services[service]
+            if idle > best_idle:
+                best, best_idle = peer, idle
+            elif not best_idle and not local and (best_backlog is None or backlog < best_backlog):
+                best, best_backlog = peer, backlog
+        if best is not None:
+            # account for the request until the next publication
+            counts = self._peer_state[best][1][service]
+            if counts[0]:
+                counts[0] -= 1
+            else:
+                counts[1] += 1
+        return best
+
+    def on_client(self, proto, rp, msg):
+        """Method called on client message.
+
+        Forwards the request to a peer if no local worker is idle and a
+        peer is better suited, see :func:`choose_peer`. Otherwise the
+        request is handled by :func:`MDPBroker.on_client`.
+
+        :param proto: the protocol id sent
+        :type proto:  str
+        :param rp:    return address stack
+        :type rp:     list of str
+        :param msg:   message parts
+        :type msg:    list of zmq.Frame
+
+        :rtype: None
+        """
+        service = msg[0].bytes
+        if not service.startswith(b'mmi.') and not rp[0].startswith(PEER_PREFIX):
+            # the request is forwarded as sent, with its priority
+            service = split_priority(service)[0]
+            srv = self._services.get(service)
+            if srv is None or not srv.worker_q:
+                peer = self.choose_peer(service, srv is not None)
+                if peer is not None:
+                    to_send = rp + [b'', proto]
+                    to_send.extend(msg)
+                    self.peer_streams[peer].send_multipart(to_send)
+                    return
+        MDPBroker.on_client(self, proto, rp, msg)
+        return
+
+    def on_peer_reply(self, msg):
+        """Route the reply to a forwarded request back to the client.
+
+        :param msg: message parts
+        :type msg:  list of zmq.Frame
+
+        :rtype: None
+        """
+        # client return address, empty, protocol, service, reply...
+        cp, i = split_frames(msg)
+        self.client_response(cp, msg[i+1].bytes, msg[i+2:])
+        return
+#
+###
+
+### Local Variables:
+### buffer-file-coding-system: utf-8
+### mode: python
+### End:
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+"""Module containing a pool of broker endpoints with failover.
+
+A :class:`BrokerPool` spreads the requests of a client over several
+brokers. It chooses a broker for each request and learns from the
+outcome: brokers failing to answer in time are ejected for a while and
+probed with a single request before they are used again.
+
+Clients accept a pool in place of their endpoint, see
+:class:`mdp.client.MDPClient` and :func:`mdp.client.mdp_request`.
+"""
+
+__license__ = """
+    This file is part of MDP.
+
+    MDP is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    MDP is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with MDP.  If not, see <http://www.gnu.org/licenses/>.
+"""
+__author__ = 'Guido Goldstein'
+__email__ = 'gst-py@a-nugget.de'
+
+import time
+import threading
+
+import zmq
+
+###
+
+POOL_LEAST_OUTSTANDING = 'least_outstanding'  #: prefer the broker with fewest open requests
+POOL_ROUND_ROBIN = 'round_robin'              #: use the brokers in turn
+
+LATENCY_ALPHA = 0.2  #: weight of a new sample in the latency average
+
+###
+
+class BrokerRep(object):
+
+    """Helper class to represent a broker in the pool.
+
+    :param endpoint:  the broker endpoint.
+    :type endpoint:   str
+    """
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        # requests sent and neither answered nor timed out
+        self.outstanding = 0
+        # consecutive failures
+        self.failures = 0
+        # moving average of the reply time in seconds, None before the first reply
+        self.latency = None
+        # time before which the broker is not used, 0 if in service
+        self.ejected_until = 0
+        # set while the single probe request of an ejected broker is out
+        self.probing = False
+        return
+#
+
+class BrokerPool(object):
+
+    """Pool of broker endpoints used by a client.
+
+    :func:`acquire` returns the broker for the next request and
+    :func:`release` reports its outcome. A broker failing `max_failures`
+    times in a row, or whose average latency exceeds `max_latency`, is
+    ejected. After the backoff time it gets a single probe request; on
+    success it is back in service, otherwise it is ejected again with
+    twice the backoff, up to `max_backoff`.
+
+    If all brokers are ejected, the one due for a probe first is used.
+
+    The pool also keeps the REQ sockets of the synchronous
+    :func:`mdp.client.mdp_request`, one per broker. They are created in
+    `context`.
+
+    The pool may be shared by threads, e.g. through a
+    :class:`mdp.client.MDPSyncClient`. Its sockets may not: like any
+    ZeroMQ socket, a socket returned by :func:`socket` must only be used
+    by one thread at a time.
+
+    :param endpoints:    the broker endpoints.
+    :type endpoints:     list of str
+    :param policy:       :data:`POOL_LEAST_OUTSTANDING` or :data:`POOL_ROUND_ROBIN`.
+    :type policy:        str
+    :param max_failures: consecutive failures before a broker is ejected.
+    :type max_failures:  int
+    :param backoff:      initial ejection time in milliseconds.
+    :type backoff:       int
+    :param max_backoff:  maximum ejection time in milliseconds.
+    :type max_backoff:   int
+    :param max_latency:  average reply time in milliseconds above which a
+                         broker is ejected, `None` to disable.
+    :type max_latency:   int
+    :param context:      the context for the sockets of the synchronous
+                         path, defaults to the global one.
+    :type context:       zmq.Context
+    """
+
+    def __init__(self, endpoints, policy=POOL_LEAST_OUTSTANDING, max_failures=1,
+                 backoff=1000, max_backoff=30000, max_latency=None, context=None):
+        """Initialize the BrokerPool.
+        """
+        if not endpoints:
+            raise ValueError('no broker endpoints given')
+        self.brokers = [BrokerRep(ep) for ep in endpoints]
+        self.policy = policy
+        self.max_failures = max_failures
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_latency = max_latency
+        self.context = context or zmq.Context.instance()
+        self._next = 0
+        # maps endpoint -> REQ socket of the synchronous path
+        self._sockets = {}
+        # reentrant, release ejects and eject closes the socket
+        self._lock = threading.RLock()
+        return
+
+    def acquire(self):
+        """Returns the broker to send the next request to.
+
+        The broker counts the request as outstanding until it is passed
+        to :func:`release`.
+
+        :rtype: BrokerRep
+        """
+        with self._lock:
+            now = time.time()
+            candidates = []
+            for broker in self.brokers:
+                if not broker.ejected_until:
+                    candidates.append(broker)
+                elif broker.ejected_until <= now and not broker.probing:
+                    # due for a probe, use it right away
+                    broker.probing = True
+                    broker.outstanding += 1
+                    return broker
+            if not candidates:
+                candidates = [min(self.brokers, key=lambda b: b.ejected_until)]
+            if self.policy == POOL_ROUND_ROBIN:
+                self._next = (self._next + 1) % len(candidates)
+                broker = candidates[self._next]
+            else:
+                broker = min(candidates, key=lambda b: (b.outstanding, b.latency))
+            broker.outstanding += 1
+            return broker
+
+    def release(self, broker, latency=None):
+        """Report the outcome of a request sent to `broker`.
+
+        :param broker:   the broker returned by :func:`acquire`.
+        :type broker:    BrokerRep
+        :param latency:  the reply time in seconds, `None` if the request
+                         failed.
+        :type latency:   float
+
+        :rtype: None
+        """
+        with self._lock:
+            broker.outstanding -= 1
+            probe = broker.probing
+            broker.probing = False
+            if latency is None:
+                broker.failures += 1
+                if probe or broker.failures >= self.max_failures:
+                    self.eject(broker)
+                return
+            if broker.latency is None:
+                broker.latency = latency
+            else:
+                broker.latency += LATENCY_ALPHA * (latency - broker.latency)
+            if self.max_latency and broker.latency * 1000 > self.max_latency:
+                self.eject(broker)
+                # start afresh once back in service
+                broker.latency = None
+                return
+            broker.failures = 0
+            broker.ejected_until = 0
+        return
+
+    def cancel(self, broker):
+        """Forget a request sent to `broker` without reporting an outcome.
+
+        :rtype: None
+        """
+        with self._lock:
+            broker.outstanding -= 1
+            broker.probing = False
+        return
+
+    def eject(self, broker):
+        """Take the broker out of service for the current backoff time.
+
+        The backoff doubles with every consecutive ejection.
+
+        :rtype: None
+        """
+        with self._lock:
+            steps = max(0, broker.failures - self.max_failures)
+            delay = min(self.max_backoff, self.backoff * (2 ** min(steps, 30)))
+            broker.ejected_until = time.time() + delay / 1000.0
+            self.close_socket(broker)
+        return
+
+    def socket(self, broker):
+        """Returns the REQ socket of the synchronous path connected to `broker`.
+
+        :rtype: zmq.Socket
+        """
+        with self._lock:
+            socket = self._sockets.get(broker.endpoint)
+            if socket is None:
+                socket = self.context.socket(zmq.REQ)
+                socket.setsockopt(zmq.LINGER, 0)
+                socket.connect(broker.endpoint)
+                self._sockets[broker.endpoint] = socket
+            return socket
+
+    def close_socket(self, broker):
+        """Close the REQ socket of `broker`, e.g. after a timeout left it unusable.
+
+        A new one is created by the next call to :func:`socket`.
+
+        :rtype: None
+        """
+        with self._lock:
+            socket = self._sockets.pop(broker.endpoint, None)
+            if socket is not None:
+                socket.close()
+        return
+
+    def shutdown(self):
+        """Close all sockets of the pool.
+
+        :rtype: None
+        """
+        with self._lock:
+            for socket in self._sockets.itervalues():
+                socket.close()
+            self._sockets = {}
+        return
+#
+###
+
+### Local Variables:
+### buffer-file-coding-system: utf-8
+### mode: python
+### End:
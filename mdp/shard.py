@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+
+"""Module containing a sharded MDP broker spreading the load over several processes.
+
+A front end owns the public endpoint. It hashes service names onto a
+number of shards, each being a complete :class:`MDPBroker` running in
+a process of its own. Clients and workers connect to the front end
+like to a plain broker and do not notice the sharding.
+
+::
+
+    clients, workers
+          |
+       XREP main_ep                    front end (ShardedBroker)
+       XREP backend_ep
+      /     |      \\
+    XREQ   XREQ   XREQ                 shards (ShardBroker), one process each
+
+The shards connect an XREQ socket to the front end, so every message
+they receive starts with the return address of the peer, exactly as
+on a bound XREP socket.
+
+For the MDP specification see: http://rfc.zeromq.org/spec:7
+"""
+
+__license__ = """
+    This file is part of MDP.
+
+    MDP is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    MDP is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with MDP.  If not, see <http://www.gnu.org/licenses/>.
+"""
+__author__ = 'Guido Goldstein'
+__email__ = 'gst-py@a-nugget.de'
+
+import os
+import struct
+import tempfile
+import multiprocessing
+from functools import partial
+from zlib import crc32
+
+import zmq
+from zmq.eventloop.zmqstream import ZMQStream
+from zmq.eventloop.ioloop import IOLoop, PeriodicCallback
+
+from broker import MDPBroker, HB_INTERVAL, HB_LIVENESS, split_priority
+from util import split_frames, TimerWheel, DeadlineManager
+
+###
+
+MMI_TIMEOUT = 1000  #: ms to wait for all shards to answer an aggregated MMI query
+
+#: per service options of the shards and the MDPBroker methods applying them
+SERVICE_OPTIONS = { 'backlog': 'set_backlog',
+                    'coalescing': 'set_coalescing',
+                    'cacheable': 'set_cacheable',
+                    }
+
+###
+
+def _merge_services(results):
+    """Merge the replies of the shards to `mmi.services`.
+    """
+    names = set()
+    for r in results:
+        names.update(r)
+    return list(names)
+#
+
+def _merge_workers(results):
+    """Merge the replies of the shards to `mmi.workers` without arguments.
+    """
+    return [str(sum(int(r[0]) for r in results if r))]
+#
+
+def _merge_counts(results):
+    """Merge the replies of the shards to `mmi.stats` without arguments or `mmi.cache`.
+    """
+    totals = {}
+    names = []
+    for r in results:
+        for i in xrange(0, len(r) - 1, 2):
+            if r[i] not in totals:
+                names.append(r[i])
+                totals[r[i]] = 0
+            totals[r[i]] += int(r[i+1])
+    ret = []
+    for name in names:
+        ret.extend((name, str(totals[name])))
+    return ret
+#
+###
+
+class ShardBroker(MDPBroker):
+
+    """MDP broker running as one shard behind a :class:`ShardedBroker`.
+
+    Instead of binding an XREP socket, the shard connects an XREQ socket
+    with the identity `shard_id` to the backend endpoint of the front
+    end.
+
+    :param context:     the context to use for socket creation.
+    :type context:      zmq.Context
+    :param backend_ep:  the backend endpoint of the front end.
+    :type backend_ep:   str
+    :param shard_id:    the identity of the shard.
+    :type shard_id:     str
+
+    All other keyword arguments are passed to :class:`MDPBroker`.
+    """
+
+    def __init__(self, context, backend_ep, shard_id, **kwargs):
+        """Init ShardBroker instance.
+        """
+        self.shard_id = shard_id
+        MDPBroker.__init__(self, context, backend_ep, **kwargs)
+        return
+
+    def _create_socket(self, context, endpoint):
+        """Helper creating a socket connected to the front end.
+        """
+        socket = context.socket(zmq.XREQ)
+        socket.setsockopt(zmq.IDENTITY, self.shard_id)
+        socket.connect(endpoint)
+        return socket
+#
+
+def configure_services(broker, service_options):
+    """Apply per service options to `broker`.
+
+    :param broker:           the broker to configure.
+    :type broker:            MDPBroker
+    :param service_options:  maps service names to dicts of options, see
+                             :class:`ShardedBroker`.
+    :type service_options:   dict
+
+    :rtype: None
+    """
+    for service, options in service_options.iteritems():
+        for name, value in options.iteritems():
+            method = getattr(broker, SERVICE_OPTIONS[name])
+            if name == 'backlog':
+                method(service, *value)
+            else:
+                method(service, value)
+    return
+#
+
+def run_shard(backend_ep, shard_id, broker_kw, service_options=None):
+    """Run a :class:`ShardBroker` until the process is terminated.
+
+    Meant to be the target of a freshly started process.
+    """
+    if hasattr(IOLoop, 'clear_instance'):
+        # forget the loop inherited from the parent process
+        IOLoop.clear_instance()
+    context = zmq.Context()
+    broker = ShardBroker(context, backend_ep, shard_id, **broker_kw)
+    if service_options:
+        configure_services(broker, service_options)
+    try:
+        IOLoop.instance().start()
+    finally:
+        broker.shutdown()
+    return
+#
+###
+
+class ShardedBroker(object):
+
+    """The front end of a sharded MDP broker.
+
+    Starts `nshards` processes running a :class:`ShardBroker` each and
+    routes messages between them and the peers connected to `main_ep`:
+
+      * client requests go to the shard the service name hashes to,
+        without its priority suffix,
+      * a worker is bound to the shard its service hashes to on READY,
+        all its further messages are sent there,
+      * `mmi.services`, `mmi.workers`, `mmi.stats` (without
+        arguments) and `mmi.cache` are sent to all shards and the
+        replies merged, other MMI queries are routed by the service
+        name given as argument.
+
+    Messages are forwarded without copying their bodies.
+
+    A worker not known to the front end, e.g. after a restart, is sent a
+    DISCONNECT and will reconnect. Workers silent for twice their
+    liveness period are forgotten.
+
+    Shards run in processes, not threads, because Python threads would
+    share one core. The shard processes are forked before the front end
+    creates its sockets. With a pyzmq IOLoop lacking `clear_instance`
+    the ShardedBroker must be created before the global IOLoop is used.
+
+    :param context:     the context to use for socket creation.
+    :type context:      zmq.Context
+    :param main_ep:     the endpoint for workers and clients.
+    :type main_ep:      str
+    :param nshards:     number of shard processes.
+    :type nshards:      int
+    :param backend_ep:  the ipc or tcp endpoint between front end and shards.
+                        Defaults to an ipc endpoint in the temp directory.
+    :type backend_ep:   str
+    :param ioloop:      the IOLoop running the front end, defaults to the
+                        global one. The shards always run on the global
+                        loop of their process.
+    :type ioloop:       IOLoop
+    :param service_options:  per service configuration of the shards,
+                        mapping service names to dicts with the keys
+                        `backlog`, a tuple of the arguments to
+                        :func:`MDPBroker.set_backlog` after the service
+                        name, `coalescing`, passed to
+                        :func:`MDPBroker.set_coalescing`, and `cacheable`,
+                        passed to :func:`MDPBroker.set_cacheable`. The
+                        shards run in processes of their own, so these
+                        methods cannot be called on them directly.
+    :type service_options:   dict
+
+    All other keyword arguments are passed to the :class:`ShardBroker`
+    instances.
+    """
+
+    CLIENT_PROTO = MDPBroker.CLIENT_PROTO
+    WORKER_PROTO = MDPBroker.WORKER_PROTO
+
+    #: return address used by the front end for aggregated MMI queries
+    MMI_ADDRESS = b'\x00mdp-front'
+
+    #: MMI services answered by all shards, with their merge functions
+    MMI_AGGREGATE = { b'mmi.services': _merge_services,
+                      b'mmi.workers': _merge_workers,
+                      b'mmi.stats': _merge_counts,
+                      b'mmi.cache': _merge_counts,
+                      }
+
+    def __init__(self, context, main_ep, nshards, backend_ep=None, ioloop=None,
+                 service_options=None, **broker_kw):
+        """Init ShardedBroker instance.
+        """
+        for options in (service_options or {}).itervalues():
+            unknown = set(options) - set(SERVICE_OPTIONS)
+            if unknown:
+                raise ValueError('unknown service options: %s' % ', '.join(sorted(unknown)))
+        if backend_ep is None:
+            backend_ep = 'ipc://%s' % os.path.join(tempfile.gettempdir(),
+                                                   'mdp-shard-%d' % os.getpid())
+        self.backend_ep = backend_ep
+        self.shards = [b'shard-%d' % i for i in xrange(nshards)]
+        self._procs = []
+        for shard_id in self.shards:
+            proc = multiprocessing.Process(target=run_shard,
+                                           args=(backend_ep, shard_id, broker_kw,
+                                                 service_options))
+            proc.daemon = True
+            proc.start()
+            self._procs.append(proc)
+        self.ioloop = ioloop or IOLoop.instance()
+        socket = context.socket(zmq.XREP)
+        socket.bind(main_ep)
+        self.main_stream = ZMQStream(socket, self.ioloop)
+        self.main_stream.on_recv(self.on_frontend, copy=False)
+        socket = context.socket(zmq.XREP)
+        socket.bind(backend_ep)
+        self.backend_stream = ZMQStream(socket, self.ioloop)
+        self.backend_stream.on_recv(self.on_backend, copy=False)
+        # maps worker id -> shard id
+        self._worker_shard = {}
+        self._worker_wheel = TimerWheel(HB_INTERVAL, 2 * HB_LIVENESS + 1)
+        self._worker_timer = PeriodicCallback(self.on_timer, HB_INTERVAL, self.ioloop)
+        self._worker_timer.start()
+        # maps tag -> [return address, service, pending shards, results, timeout]
+        self._mmi_pending = {}
+        if ioloop is None:
+            self._deadlines = DeadlineManager.instance()
+        else:
+            self._deadlines = DeadlineManager(ioloop)
+        self._mmi_seq = 0
+        return
+
+    def shard_for(self, name):
+        """Returns the id of the shard responsible for the service `name`.
+        """
+        return self.shards[(crc32(name) & 0xffffffff) % len(self.shards)]
+
+    def shutdown(self):
+        """Shutdown front end and shards.
+
+        .. warning:: The instance MUST not be used after :func:`shutdown` has been called.
+
+        :rtype: None
+        """
+        if self._worker_timer:
+            self._worker_timer.stop()
+            self._worker_timer = None
+        for stream in (self.main_stream, self.backend_stream):
+            stream.on_recv(None)
+            stream.socket.setsockopt(zmq.LINGER, 0)
+            stream.socket.close()
+            stream.close()
+        self.main_stream = None
+        self.backend_stream = None
+        for proc in self._procs:
+            proc.terminate()
+            proc.join()
+        self._procs = []
+        self._worker_shard = {}
+        return
+
+    def on_timer(self):
+        """Method called every HB_INTERVAL.
+
+        Forgets workers which have been silent for too long.
+
+        :rtype: None
+        """
+        for wid in self._worker_wheel.advance():
+            self._worker_shard.pop(wid, None)
+        return
+
+    def on_frontend(self, msg):
+        """Route a message from a client or worker to a shard.
+
+        :param msg: message parts
+        :type msg:  list of zmq.Frame
+
+        :rtype: None
+        """
+        rp, i = split_frames(msg)
+        t = msg[i].bytes
+        if t.startswith(b'MDPC'):
+            service = msg[i+1].bytes
+            if len(msg) == i+2 and service in self.MMI_AGGREGATE:
+                self.mmi_aggregate(rp, t, service)
+                return
+            if service.startswith(b'mmi.') and len(msg) > i+2:
+                shard = self.shard_for(msg[i+2].bytes)
+            else:
+                shard = self.shard_for(split_priority(service)[0])
+        elif t.startswith(b'MDPW'):
+            wid = rp[0]
+            cmd = msg[i+1].bytes
+            if cmd == b'\x01':
+                shard = self.shard_for(msg[i+2].bytes)
+                self._worker_shard[wid] = shard
+            else:
+                shard = self._worker_shard.get(wid)
+                if shard is None:
+                    if cmd != b'\x05':
+                        self.main_stream.send_multipart([wid, b'', self.WORKER_PROTO, b'\x05'])
+                    return
+            if cmd == b'\x05':
+                del self._worker_shard[wid]
+                self._worker_wheel.remove(wid)
+            else:
+                self._worker_wheel.add(wid, 2 * HB_LIVENESS * HB_INTERVAL)
+        else:
+            print 'Broker unknown Protocol: "%s"' % t
+            return
+        to_send = [shard]
+        to_send.extend(msg)
+        self.backend_stream.send_multipart(to_send)
+        return
+
+    def on_backend(self, msg):
+        """Route a message from a shard to a client or worker.
+
+        :param msg: message parts
+        :type msg:  list of zmq.Frame
+
+        :rtype: None
+        """
+        # shard id, return address, ..., empty, protocol, ...
+        addr = msg[1]
+        if len(addr) == len(self.MMI_ADDRESS) and addr.bytes == self.MMI_ADDRESS:
+            self.on_mmi_reply(msg)
+            return
+        if len(msg) == 5 and msg[4].bytes == b'\x05' and msg[3].bytes == self.WORKER_PROTO:
+            # shard disconnects worker
+            wid = addr.bytes
+            self._worker_shard.pop(wid, None)
+            self._worker_wheel.remove(wid)
+        self.main_stream.send_multipart(msg[1:])
+        return
+
+    def mmi_aggregate(self, rp, proto, service):
+        """Send the MMI query to all shards.
+
+        The replies are collected by :func:`on_mmi_reply`. After
+        MMI_TIMEOUT the query is answered with the replies received so
+        far.
+
+        :rtype: None
+        """
+        self._mmi_seq += 1
+        tag = struct.pack('!Q', self._mmi_seq)
+        tmo = self._deadlines.add_timeout(MMI_TIMEOUT, partial(self.mmi_finish, tag))
+        self._mmi_pending[tag] = [rp, service, len(self.shards), [], tmo]
+        for shard in self.shards:
+            self.backend_stream.send_multipart([shard, self.MMI_ADDRESS, tag, b'',
+                                                proto, service])
+        return
+
+    def on_mmi_reply(self, msg):
+        """Collect the reply of a shard to an aggregated MMI query.
+
+        :rtype: None
+        """
+        # shard id, MMI_ADDRESS, tag, empty, protocol, service, status, ...
+        tag = msg[2].bytes
+        entry = self._mmi_pending.get(tag)
+        if entry is None:
+            return
+        if msg[6].bytes == b'200':
+            entry[3].append([f.bytes for f in msg[7:]])
+        entry[2] -= 1
+        if not entry[2]:
+            self._deadlines.cancel(entry[4])
+            self.mmi_finish(tag)
+        return
+
+    def mmi_finish(self, tag):
+        """Merge the collected replies and answer the MMI query.
+
+        :rtype: None
+        """
+        entry = self._mmi_pending.pop(tag, None)
+        if entry is None or not self.main_stream:
+            return
+        rp, service, pending, results, tmo = entry
+        to_send = rp + [b'', self.CLIENT_PROTO, service, b'200']
+        to_send.extend(self.MMI_AGGREGATE[service](results))
+        self.main_stream.send_multipart(to_send)
+        return
+#
+###
+
+### Local Variables:
+### buffer-file-coding-system: utf-8
+### mode: python
+### End:
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+"""Module containing the statistics kept by the MDP broker.
+
+Latencies are recorded in :class:`Histogram` instances with a fixed
+set of log-linear buckets, so recording a value costs O(1) and the
+memory used does not grow with the number of values.
+"""
+
+__license__ = """
+    This file is part of MDP.
+
+    MDP is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    MDP is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with MDP.  If not, see <http://www.gnu.org/licenses/>.
+"""
+__author__ = 'Guido Goldstein'
+__email__ = 'gst-py@a-nugget.de'
+
+###
+
+SUB_BITS = 4            #: each power of two is split into 2**SUB_BITS buckets
+SUB_COUNT = 1 << SUB_BITS
+
+#: percentiles reported by :func:`Histogram.snapshot`
+PERCENTILES = (50, 90, 99, 99.9)
+
+###
+
+class Histogram(object):
+
+    """Histogram of non-negative integer values, e.g. latencies in µs.
+
+    Values below 2**(SUB_BITS+1) get a bucket each, larger values share
+    buckets whose width is 1/2**SUB_BITS of their power of two, so the
+    relative error of reported percentiles is below 7%. Values beyond
+    the bucket of `max_value` are counted in an extra overflow bucket
+    and reported as :attr:`max`, which is exact.
+
+    :param max_value:  largest value resolved, defaults to about 67 s in µs.
+    :type max_value:   int
+    """
+
+    def __init__(self, max_value=1 << 26):
+        self._max_shift = max(0, max_value.bit_length() - SUB_BITS - 1)
+        # the last bucket counts the overflow
+        self.counts = [0] * ((self._max_shift + 2) * SUB_COUNT + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        return
+
+    def record(self, value):
+        """Add the value to the histogram.
+
+        :param value: the value, negative values are counted as 0.
+        :type value:  int
+        """
+        value = int(value)
+        if value < 0:
+            value = 0
+        shift = value.bit_length() - SUB_BITS - 1
+        if shift <= 0:
+            idx = value
+        elif shift > self._max_shift:
+            idx = len(self.counts) - 1
+        else:
+            idx = (shift << SUB_BITS) + (value >> shift)
+        self.counts[idx] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        return
+
+    def _bucket_top(self, idx):
+        """Helper returning the largest value counted in bucket `idx`.
+        """
+        shift = max(0, (idx >> SUB_BITS) - 1)
+        return (((idx - (shift << SUB_BITS)) + 1) << shift) - 1
+
+    def percentile(self, p):
+        """Returns the value below or equal to which `p` percent of the values are.
+
+        The value is the upper bound of the bucket holding the
+        percentile, but never more than :attr:`max`. Returns 0 for an
+        empty histogram.
+
+        :param p: the percentile, between 0 and 100.
+        :type p:  float
+
+        :rtype: int
+        """
+        if not self.count:
+            return 0
+        rank = max(1, self.count * p / 100.0)
+        seen = 0
+        last = len(self.counts) - 1
+        for idx, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                if idx == last:
+                    # the overflow bucket
+                    break
+                return min(self._bucket_top(idx), self.max)
+        return self.max
+
+    def mean(self):
+        """Returns the mean of all values, 0 for an empty histogram.
+        """
+        if not self.count:
+            return 0
+        return self.total / float(self.count)
+
+    def snapshot(self):
+        """Returns a dict with count, mean, max and the percentiles.
+
+        The percentiles are keyed by names like `p50` and `p99.9`.
+
+        :rtype: dict
+        """
+        ret = {'count': self.count, 'mean': self.mean(), 'max': self.max}
+        for p in PERCENTILES:
+            ret['p%g' % p] = self.percentile(p)
+        return ret
+#
+
+class ServiceStats(object):
+
+    """Counters and latency histograms of one service.
+
+    All latencies are in microseconds.
+
+    :ivar requests:     number of requests received.
+    :ivar replies:      number of replies sent.
+    :ivar dropped:      number of requests refused or given up.
+    :ivar coalesced:    number of requests attached to an identical one.
+    :ivar cached:       number of requests answered from the reply cache.
+    :ivar queue_wait:   time from receipt of a request to its dispatch.
+    :ivar service_time: time from dispatch of a request to the worker's reply.
+    :ivar residence:    time from receipt of a request to the reply.
+    """
+
+    COUNTERS = ('requests', 'replies', 'dropped', 'coalesced', 'cached')
+    HISTOGRAMS = ('queue_wait', 'service_time', 'residence')
+
+    def __init__(self):
+        self.requests = 0
+        self.replies = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.cached = 0
+        self.queue_wait = Histogram()
+        self.service_time = Histogram()
+        self.residence = Histogram()
+        return
+
+    def snapshot(self):
+        """Returns a dict holding the counters and the histogram snapshots.
+
+        :rtype: dict
+        """
+        ret = {}
+        for name in self.COUNTERS:
+            ret[name] = getattr(self, name)
+        for name in self.HISTOGRAMS:
+            ret[name] = getattr(self, name).snapshot()
+        return ret
+#
+###
+
+### Local Variables:
+### buffer-file-coding-system: utf-8
+### mode: python
+### End:
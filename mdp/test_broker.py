@@ -0,0 +1,699 @@
+# -*- coding: utf-8 -*-
+
+"""Unittests for the MDPBroker helper classes.
+"""
+
+
+__license__ = """
+    This file is part of MDP.
+
+    MDP is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    MDP is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with MDP.  If not, see <http://www.gnu.org/licenses/>.
+"""
+__author__ = 'Guido Goldstein'
+__email__ = 'gst-py@a-nugget.de'
+
+import sys
+import time
+import unittest
+
+import zmq
+from zmq.eventloop.ioloop import IOLoop
+
+from broker import MDPBroker, WorkerRep, ServiceQueue, LRUQueue, LIFOQueue, RoundRobinQueue
+from broker import RequestQueue, BACKLOG_REJECT, BACKLOG_DROP_OLDEST, BACKLOG_DROP_NEWEST
+from broker import MDP_BUSY, MDP_FAILED, HB_LIVENESS, split_priority
+
+###
+
+class Test_WorkerQueues(unittest.TestCase):
+
+    def _fill(self, qcls, wids):
+        q = qcls()
+        for wid in wids:
+            q.put(wid)
+        return q
+
+    def test_01_interface_01(self):
+        """Test worker queues common interface.
+        """
+        for qcls in (ServiceQueue, LRUQueue, LIFOQueue, RoundRobinQueue):
+            q = self._fill(qcls, [b'a', b'b', b'c', b'a'])
+            self.assertEquals(3, len(q))
+            self.assertTrue(b'b' in q)
+            q.remove(b'b')
+            q.remove(b'unknown')
+            self.assertFalse(b'b' in q)
+            self.assertEquals(2, len(q))
+            got = set([q.get(), q.get()])
+            self.assertEquals(set([b'a', b'c']), got)
+            self.assertEquals(None, q.get())
+            self.assertEquals(0, len(q))
+        return
+
+    def test_02_order_01(self):
+        """Test LRU and LIFO ordering.
+        """
+        q = self._fill(LRUQueue, [b'a', b'b', b'c'])
+        self.assertEquals(b'a', q.get())
+        q.put(b'a')
+        self.assertEquals([b'b', b'c', b'a'], [q.get() for _ in range(3)])
+        q = self._fill(LIFOQueue, [b'a', b'b', b'c'])
+        self.assertEquals(b'c', q.get())
+        q.put(b'c')
+        self.assertEquals([b'c', b'b', b'a'], [q.get() for _ in range(3)])
+        return
+
+    def test_02_order_02(self):
+        """Test removed and re-added workers are not handed out twice.
+        """
+        q = self._fill(LRUQueue, [b'a', b'b'])
+        q.remove(b'a')
+        q.put(b'a')
+        self.assertEquals([b'b', b'a', None], [q.get() for _ in range(3)])
+        return
+
+    def test_02_order_03(self):
+        """Test round robin serves every worker once per round.
+        """
+        q = self._fill(RoundRobinQueue, [b'a', b'b', b'c'])
+        self.assertEquals(b'a', q.get())
+        q.put(b'a') # fast worker returns immediately
+        self.assertEquals(b'b', q.get())
+        self.assertEquals(b'c', q.get())
+        self.assertEquals(b'a', q.get())
+        self.assertEquals(None, q.get())
+        return
+#
+
+class Test_RequestQueue(unittest.TestCase):
+
+    def test_01_unbounded_01(self):
+        """Test unbounded request queue is FIFO.
+        """
+        q = RequestQueue()
+        for i in range(100):
+            self.assertEquals(None, q.put(i))
+        self.assertEquals(100, len(q))
+        self.assertEquals(range(100), [q.get() for _ in range(100)])
+        self.assertEquals(None, q.get())
+        return
+
+    def test_02_overflow_01(self):
+        """Test request queue overflow policies.
+        """
+        for policy in (BACKLOG_REJECT, BACKLOG_DROP_NEWEST):
+            q = RequestQueue(2, policy)
+            q.put(1)
+            q.put(2)
+            self.assertEquals(3, q.put(3))
+            self.assertEquals([1, 2], [q.get(), q.get()])
+        q = RequestQueue(2, BACKLOG_DROP_OLDEST)
+        q.put(1)
+        q.put(2)
+        self.assertEquals(1, q.put(3))
+        self.assertEquals([2, 3], [q.get(), q.get()])
+        return
+
+    def test_03_priority_01(self):
+        """Test higher priorities are dispatched first.
+        """
+        q = RequestQueue(aging=None)
+        q.put(1, 0)
+        q.put(2, 1)
+        q.put(3, 2)
+        q.put(4, 0)
+        q.put_front(5, 0)
+        q.put(6, 7)
+        self.assertEquals(6, len(q))
+        self.assertEquals([3, 6, 2, 5, 1, 4], [q.get() for _ in range(6)])
+        self.assertEquals(None, q.get())
+        return
+
+    def test_03_priority_02(self):
+        """Test waiting requests age to higher priorities.
+        """
+        q = RequestQueue(aging=50)
+        q.put(1, 0)
+        time.sleep(0.12)
+        q.put(2, 1)
+        self.assertEquals([1, 2], [q.get(), q.get()])
+        return
+
+    def test_03_priority_03(self):
+        """Test overflow refuses requests of the lowest priority.
+        """
+        q = RequestQueue(2, BACKLOG_REJECT, aging=None)
+        q.put(1, 0)
+        q.put(2, 0)
+        self.assertEquals(2, q.put(3, 2))
+        self.assertEquals(4, q.put(4, 0))
+        q = RequestQueue(2, BACKLOG_DROP_OLDEST, aging=None)
+        q.put(1, 1)
+        q.put(2, 0)
+        self.assertEquals(2, q.put(3, 1))
+        self.assertEquals(1, q.put(4, 1))
+        self.assertEquals(5, q.put(5, 0))
+        self.assertEquals([3, 4], [q.get(), q.get()])
+        return
+
+    def test_04_split_priority_01(self):
+        """Test parsing of the priority suffix of service names.
+        """
+        self.assertEquals((b'echo', 2), split_priority(b'echo@2'))
+        self.assertEquals((b'echo', None), split_priority(b'echo'))
+        self.assertEquals((b'a@b', None), split_priority(b'a@b'))
+        return
+#
+
+class _Stream(object):
+
+    """Stream collecting the messages sent.
+    """
+
+    def __init__(self):
+        self.sent = []
+        return
+
+    def send_multipart(self, msg):
+        self.sent.append(msg)
+        return
+#
+
+class Test_WorkerRep(unittest.TestCase):
+
+    def test_01_heartbeat_01(self):
+        """Test no heartbeat is sent to a worker after other traffic.
+        """
+        stream = _Stream()
+        wrep = WorkerRep(MDPBroker.WORKER_PROTO, b'w', b'test', stream)
+        wrep.sent_traffic = True
+        wrep.send_hb()
+        self.assertEquals([], stream.sent)
+        self.assertFalse(wrep.sent_traffic)
+        wrep.send_hb()
+        self.assertEquals([[b'w', b'', MDPBroker.WORKER_PROTO, b'\x04']], stream.sent)
+        return
+
+    def test_01_heartbeat_02(self):
+        """Test any traffic from a worker keeps it alive.
+        """
+        wrep = WorkerRep(MDPBroker.WORKER_PROTO, b'w', b'test', _Stream())
+        while wrep.is_alive():
+            wrep.send_hb()
+        wrep.on_heartbeat()
+        self.assertTrue(wrep.is_alive())
+        return
+#
+
+class Test_MDPBroker(unittest.TestCase):
+
+    """Tests of a broker talking to clients and workers on raw sockets.
+    """
+
+    endpoint = b'inproc://test-broker'
+    service = b'test'
+
+    W = MDPBroker.WORKER_PROTO
+    C = MDPBroker.CLIENT_PROTO
+
+    def setUp(self):
+        self.context = zmq.Context()
+        self.loop = IOLoop()
+        self.broker = self._create_broker()
+        self.sockets = []
+        return
+
+    def tearDown(self):
+        self.broker.shutdown()
+        for socket in self.sockets:
+            socket.close()
+        self.loop.close()
+        self.context.term()
+        return
+
+    def _create_broker(self, **kw):
+        """Helper creating the broker under test.
+        """
+        return MDPBroker(self.context, self.endpoint, ioloop=self.loop, **kw)
+
+    def _spin(self, duration=0.01):
+        """Helper running the broker loop for `duration` seconds.
+        """
+        self.loop.add_timeout(time.time() + duration, self.loop.stop)
+        self.loop.start()
+        return
+
+    def _socket(self):
+        socket = self.context.socket(zmq.XREQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(self.endpoint)
+        self.sockets.append(socket)
+        return socket
+
+    def _worker(self, service=None, capacity=1):
+        """Helper returning the socket of a registered worker.
+        """
+        socket = self._socket()
+        msg = [b'', self.W, b'\x01', service or self.service]
+        if capacity > 1:
+            msg.append(str(capacity))
+        socket.send_multipart(msg)
+        self._spin()
+        return socket
+
+    def _request(self, client, body, service=None):
+        client.send_multipart([b'', self.C, service or self.service] + body)
+        return
+
+    def _recv(self, socket, timeout=0.5):
+        """Helper returning the next message of `socket`, `None` on timeout.
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            self._spin()
+            if socket.poll(0):
+                return socket.recv_multipart()
+        return None
+
+    def _reply(self, worker, request, body):
+        """Helper answering the request received by the worker.
+
+        The reply goes to the return address and tag of the request.
+        """
+        i = request.index(b'', 1)
+        worker.send_multipart([b'', self.W, b'\x03'] + request[3:i+1] + body)
+        return
+
+    def _die(self, worker):
+        """Helper sending DISCONNECT for the worker, like a dying worker would.
+        """
+        worker.send_multipart([b'', self.W, b'\x05'])
+        self._spin()
+        return
+
+    def _mmi(self, service, body=[]):
+        """Helper returning the reply frames of an MMI query.
+        """
+        client = self._socket()
+        self._request(client, body, service)
+        return self._recv(client)[3:]
+
+    def _cache_counters(self):
+        """Helper returning the `mmi.cache` counters as dict.
+        """
+        ret = self._mmi(b'mmi.cache')
+        self.assertEquals(b'200', ret[0])
+        return dict(zip(ret[1::2], [int(v) for v in ret[2::2]]))
+
+    def test_01_request_01(self):
+        """Test a request routed to a worker and the reply back to the client.
+        """
+        worker = self._worker()
+        client = self._socket()
+        self._request(client, [b'hello'])
+        req = self._recv(worker)
+        self.assertEquals([b'', self.W, b'\x02'], req[:3])
+        self.assertEquals(b'hello', req[-1])
+        self._reply(worker, req, [b'world'])
+        self.assertEquals([b'', self.C, self.service, b'world'], self._recv(client))
+        return
+
+    def test_01_request_02(self):
+        """Test replies of unknown workers are ignored.
+        """
+        self.broker.on_reply([b'nobody'], [zmq.Frame(b'client'), zmq.Frame(b''),
+                                           zmq.Frame(b'answer')])
+        worker = self._worker()
+        worker.send_multipart([b'', self.W, b'\x03', b'client', b'', b'answer'])
+        self._spin()
+        self.assertEquals(1, len(self.broker._services[self.service].worker_q))
+        return
+
+    def test_02_priority_01(self):
+        """Test replies carry the service name sent, priority suffix included.
+        """
+        worker = self._worker()
+        client = self._socket()
+        self._request(client, [b'MDP-PRIO:2', b'a'], self.service + b'@0')
+        req = self._recv(worker)
+        self.assertEquals(b'a', req[-1])
+        self.assertEquals(b'', req[-2])
+        self._reply(worker, req, [b'b'])
+        self.assertEquals([b'', self.C, self.service + b'@0', b'b'], self._recv(client))
+        return
+
+    def test_03_disconnect_01(self):
+        """Test a worker sending an unknown command is disconnected.
+        """
+        worker = self._worker()
+        worker.send_multipart([b'', self.W, b'\x09'])
+        self.assertEquals([b'', self.W, b'\x05'], self._recv(worker))
+        self.assertEquals({}, self.broker._workers)
+        return
+
+    def test_03_liveness_01(self):
+        """Test requests and replies count as traffic and heartbeats.
+        """
+        worker = self._worker()
+        wid = self.broker._workers.keys()[0]
+        wrep = self.broker._workers[wid]
+        client = self._socket()
+        self._request(client, [b'a'])
+        req = self._recv(worker)
+        self.assertTrue(wrep.sent_traffic)
+        wrep.curr_liveness = 1
+        self._reply(worker, req, [b'A'])
+        self._spin()
+        self.assertEquals(HB_LIVENESS, wrep.curr_liveness)
+        wrep.curr_liveness = 0
+        worker.send_multipart([b'', self.W, b'\x04'])
+        self._spin()
+        self.assertTrue(wrep.is_alive())
+        return
+
+    def test_04_redeliver_01(self):
+        """Test a request of a lost worker is redelivered to another one.
+        """
+        first = self._worker()
+        second = self._worker()
+        client = self._socket()
+        self._request(client, [b'hello'])
+        req = self._recv(first)
+        self._die(first)
+        req = self._recv(second)
+        self.assertEquals(b'hello', req[-1])
+        self._reply(second, req, [b'world'])
+        self.assertEquals([b'', self.C, self.service, b'world'], self._recv(client))
+        return
+
+    def test_04_redeliver_02(self):
+        """Test a request fails after max_redeliveries lost workers.
+        """
+        first = self._worker()
+        second = self._worker()
+        client = self._socket()
+        self._request(client, [b'hello'])
+        self._recv(first)
+        self._die(first)
+        self._recv(second)
+        self._die(second)
+        self.assertEquals([b'', self.C, self.service, MDP_FAILED], self._recv(client))
+        self.assertEquals(0, len(self.broker._services[self.service].requests))
+        return
+
+    def test_04_redeliver_03(self):
+        """Test a redelivered request is queued in front of the backlog.
+        """
+        first = self._worker()
+        client = self._socket()
+        self._request(client, [b'a'])
+        self._request(client, [b'b'])
+        self._recv(first)
+        self._die(first)
+        worker = self._worker()
+        req = self._recv(worker)
+        self.assertEquals(b'a', req[-1])
+        self._reply(worker, req, [b'A'])
+        self.assertEquals(b'b', self._recv(worker)[-1])
+        return
+
+    def test_05_credit_01(self):
+        """Test a worker gets as many requests as its credit allows.
+        """
+        worker = self._worker(capacity=2)
+        client = self._socket()
+        for body in (b'a', b'b', b'c'):
+            self._request(client, [body])
+        first = self._recv(worker)
+        second = self._recv(worker)
+        self.assertEquals([b'a', b'b'], [first[-1], second[-1]])
+        self.assertNotEquals(first[-3], second[-3])
+        self.assertEquals(None, self._recv(worker, 0.1))
+        self._reply(worker, first, [b'A'])
+        self.assertEquals(b'c', self._recv(worker)[-1])
+        return
+
+    def test_05_credit_02(self):
+        """Test replies sent out of order reach their clients.
+        """
+        worker = self._worker(capacity=2)
+        one = self._socket()
+        two = self._socket()
+        self._request(one, [b'a'])
+        first = self._recv(worker)
+        self._request(two, [b'b'])
+        second = self._recv(worker)
+        self._reply(worker, second, [b'B'])
+        self._reply(worker, first, [b'A'])
+        self.assertEquals([b'', self.C, self.service, b'B'], self._recv(two))
+        self.assertEquals([b'', self.C, self.service, b'A'], self._recv(one))
+        return
+
+    def test_05_credit_03(self):
+        """Test the requests of a lost multi-slot worker are redelivered.
+        """
+        first = self._worker(capacity=2)
+        client = self._socket()
+        self._request(client, [b'a'])
+        self._request(client, [b'b'])
+        self._recv(first)
+        self._recv(first)
+        self._die(first)
+        second = self._worker(capacity=2)
+        bodies = sorted([self._recv(second)[-1], self._recv(second)[-1]])
+        self.assertEquals([b'a', b'b'], bodies)
+        return
+
+    def test_06_coalesce_01(self):
+        """Test identical requests are dispatched once and all get the reply.
+        """
+        self.broker.set_coalescing(self.service)
+        worker = self._worker()
+        clients = [self._socket() for i in range(3)]
+        for client in clients:
+            self._request(client, [b'same'])
+        req = self._recv(worker)
+        self.assertEquals(None, self._recv(worker, 0.1))
+        self._reply(worker, req, [b'answer'])
+        for client in clients:
+            self.assertEquals([b'', self.C, self.service, b'answer'], self._recv(client))
+        self.assertEquals(2, self.broker.stats(self.service)['coalesced'])
+        # the next request is dispatched again
+        self._request(clients[0], [b'same'])
+        self.assertEquals(b'same', self._recv(worker)[-1])
+        return
+
+    def test_06_coalesce_02(self):
+        """Test the failure of a coalesced request reaches all waiters.
+        """
+        self.broker._max_redeliveries = 0
+        self.broker.set_coalescing(self.service)
+        worker = self._worker()
+        clients = [self._socket() for i in range(3)]
+        for client in clients:
+            self._request(client, [b'same'])
+        self._recv(worker)
+        self._die(worker)
+        for client in clients:
+            self.assertEquals([b'', self.C, self.service, MDP_FAILED], self._recv(client))
+        self.assertEquals({}, self.broker._services[self.service].inflight)
+        return
+
+    def test_07_mmi_01(self):
+        """Test the MMI services and workers queries.
+        """
+        self._worker()
+        self._worker()
+        self._worker(b'other')
+        self.assertEquals(b'200', self._mmi(b'mmi.services')[0])
+        self.assertEquals([b'other', self.service], sorted(self._mmi(b'mmi.services')[1:]))
+        self.assertEquals([b'200', b'3'], self._mmi(b'mmi.workers'))
+        self.assertEquals([b'200', b'2', b'2', b'0'], self._mmi(b'mmi.workers', [self.service]))
+        self.assertEquals([b'404'], self._mmi(b'mmi.workers', [b'unknown']))
+        self.assertEquals([b'200'], self._mmi(b'mmi.service', [b'other']))
+        self.assertEquals([b'404'], self._mmi(b'mmi.service', [b'unknown']))
+        self.assertEquals([b'501'], self._mmi(b'mmi.unknown'))
+        return
+
+    def test_07_gc_01(self):
+        """Test a service without workers is forgotten after its grace period.
+        """
+        worker = self._worker()
+        self._die(worker)
+        self.assertTrue(self.service in self.broker._services)
+        self.assertTrue(self.service in self.broker._gc_wheel)
+        self.assertEquals([b'200'], self._mmi(b'mmi.services'))
+        self.broker.on_service_expired(self.service)
+        self.assertFalse(self.service in self.broker._services)
+        # the statistics are kept
+        self.assertNotEquals(None, self.broker.stats(self.service))
+        return
+
+    def test_07_gc_02(self):
+        """Test a service is kept while it has workers or queued requests.
+        """
+        worker = self._worker()
+        self._die(worker)
+        worker = self._worker()
+        self.assertFalse(self.service in self.broker._gc_wheel)
+        self.broker.on_service_expired(self.service)
+        self.assertTrue(self.service in self.broker._services)
+        client = self._socket()
+        self._request(client, [b'a'])
+        self._request(client, [b'b'])
+        self._recv(worker)
+        self._die(worker)
+        self.broker.on_service_expired(self.service)
+        self.assertTrue(self.service in self.broker._services)
+        self.assertTrue(self.service in self.broker._gc_wheel)
+        return
+
+    def test_07_cache_01(self):
+        """Test replies of cacheable services are answered from the cache.
+        """
+        self.broker.set_cacheable(self.service, 10000)
+        worker = self._worker()
+        client = self._socket()
+        self._request(client, [b'q'])
+        self._reply(worker, self._recv(worker), [b'A'])
+        self.assertEquals([b'', self.C, self.service, b'A'], self._recv(client))
+        self._request(client, [b'q'])
+        self.assertEquals([b'', self.C, self.service, b'A'], self._recv(client))
+        self.assertEquals(None, self._recv(worker, 0.1))
+        counters = self._cache_counters()
+        self.assertEquals(1, counters['hits'])
+        self.assertEquals(1, counters['misses'])
+        self.assertEquals(1, counters['entries'])
+        self.assertEquals(1, self.broker.stats(self.service)['cached'])
+        # other requests still go to the worker
+        self._request(client, [b'r'])
+        self.assertEquals(b'r', self._recv(worker)[-1])
+        return
+
+    def test_07_cache_02(self):
+        """Test a TTL header of 0 keeps the reply out of the cache.
+        """
+        self.broker.set_cacheable(self.service, 10000)
+        worker = self._worker()
+        client = self._socket()
+        self._request(client, [b'q'])
+        self._reply(worker, self._recv(worker), [b'MDP-TTL:0', b'A'])
+        self.assertEquals([b'', self.C, self.service, b'A'], self._recv(client))
+        self._request(client, [b'q'])
+        self.assertEquals(b'q', self._recv(worker)[-1])
+        self.assertEquals(0, self._cache_counters()['entries'])
+        return
+
+    def test_07_cache_03(self):
+        """Test a TTL header overrides the TTL of the service.
+        """
+        self.broker.set_cacheable(self.service, 0)
+        worker = self._worker()
+        client = self._socket()
+        self._request(client, [b'q'])
+        self._reply(worker, self._recv(worker), [b'MDP-TTL:10000', b'A'])
+        self.assertEquals([b'', self.C, self.service, b'A'], self._recv(client))
+        self._request(client, [b'q'])
+        self.assertEquals([b'', self.C, self.service, b'A'], self._recv(client))
+        self.assertEquals(None, self._recv(worker, 0.1))
+        return
+
+    def test_07_cache_04(self):
+        """Test disabling the cache of a service drops its replies.
+        """
+        self.broker.set_cacheable(self.service, 10000)
+        worker = self._worker()
+        client = self._socket()
+        self._request(client, [b'q'])
+        self._reply(worker, self._recv(worker), [b'A'])
+        self._recv(client)
+        self.broker.set_cacheable(self.service, None)
+        self.assertEquals(0, self._cache_counters()['entries'])
+        self._request(client, [b'q'])
+        self.assertEquals(b'q', self._recv(worker)[-1])
+        return
+
+    def test_08_backlog_01(self):
+        """Test requests beyond the backlog limit are refused with MDP_BUSY.
+        """
+        self.broker.set_backlog(self.service, 1)
+        worker = self._worker()
+        client = self._socket()
+        for body in (b'a', b'b', b'c'):
+            self._request(client, [body])
+        self.assertEquals([b'', self.C, self.service, MDP_BUSY], self._recv(client))
+        req = self._recv(worker)
+        self.assertEquals(b'a', req[-1])
+        self._reply(worker, req, [b'A'])
+        self.assertEquals(b'b', self._recv(worker)[-1])
+        return
+
+    def test_08_backlog_02(self):
+        """Test the drop policies when the backlog limit is reached.
+        """
+        self.broker.set_backlog(self.service, 1, BACKLOG_DROP_OLDEST)
+        self.broker.set_backlog(b'other', 1, BACKLOG_DROP_NEWEST)
+        worker = self._worker()
+        client = self._socket()
+        for body in (b'a', b'b', b'c'):
+            self._request(client, [body])
+        # the oldest queued request is refused
+        self.assertEquals([b'', self.C, self.service, MDP_BUSY], self._recv(client))
+        self._reply(worker, self._recv(worker), [b'A'])
+        self.assertEquals([b'', self.C, self.service, b'A'], self._recv(client))
+        self.assertEquals(b'c', self._recv(worker)[-1])
+        worker = self._worker(b'other')
+        for body in (b'a', b'b', b'c'):
+            self._request(client, [body], b'other')
+        self._reply(worker, self._recv(worker), [b'A'])
+        self.assertEquals(b'b', self._recv(worker)[-1])
+        # the newest request is dropped silently
+        self.assertEquals([b'', self.C, b'other', b'A'], self._recv(client))
+        self.assertEquals(None, self._recv(client, 0.1))
+        return
+
+    def test_09_stats_01(self):
+        """Test the mmi.stats service.
+        """
+        worker = self._worker()
+        client = self._socket()
+        for body in (b'a', b'b'):
+            self._request(client, [body])
+            self._reply(worker, self._recv(worker), [body])
+            self._recv(client)
+        ret = self._mmi(b'mmi.stats', [self.service])
+        self.assertEquals(b'200', ret[0])
+        stats = dict(zip(ret[1::2], [int(v) for v in ret[2::2]]))
+        self.assertEquals(2, stats['requests'])
+        self.assertEquals(2, stats['replies'])
+        self.assertEquals(0, stats['dropped'])
+        self.assertEquals(2, stats['service_time.count'])
+        self.assertEquals(2, stats['residence.count'])
+        self.assertTrue(stats['residence.p99'] <= stats['residence.max'])
+        self.assertEquals([b'200', b'requests', b'2', b'replies', b'2'],
+                          self._mmi(b'mmi.stats')[:5])
+        self.assertEquals([b'404'], self._mmi(b'mmi.stats', [b'unknown']))
+        return
+#
+###
+
+if __name__ == '__main__':
+    sys.argv.append('-v')
+    unittest.main()
+#
+
+### Local Variables:
+### buffer-file-coding-system: utf-8
+### mode: python
+### End:
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""Unittests for the reply cache.
+"""
+
+
+__license__ = """
+    This file is part of MDP.
+
+    MDP is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    MDP is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with MDP.  If not, see <http://www.gnu.org/licenses/>.
+"""
+__author__ = 'Guido Goldstein'
+__email__ = 'gst-py@a-nugget.de'
+
+import sys
+import time
+import unittest
+
+from cache import ReplyCache, request_key, ENTRY_OVERHEAD
+
+###
+
+class Test_ReplyCache(unittest.TestCase):
+
+    def test_01_key_01(self):
+        """Test keys depend on service and all parts.
+        """
+        k = request_key(b'svc', [b'ab', b'c'])
+        self.assertEquals(k, request_key(b'svc', [b'ab', b'c']))
+        self.assertNotEquals(k, request_key(b'svc', [b'a', b'bc']))
+        self.assertNotEquals(k, request_key(b'other', [b'ab', b'c']))
+        return
+
+    def test_02_get_01(self):
+        """Test hits and misses.
+        """
+        c = ReplyCache(1000)
+        self.assertEquals(None, c.get('a'))
+        c.put('a', [b'reply'], 1000)
+        self.assertEquals([b'reply'], c.get('a'))
+        self.assertEquals(1, c.hits)
+        self.assertEquals(1, c.misses)
+        self.assertEquals(ENTRY_OVERHEAD + 5, c.nbytes)
+        return
+
+    def test_03_ttl_01(self):
+        """Test expired entries are removed.
+        """
+        c = ReplyCache(1000)
+        c.put('a', [b'reply'], 1000)
+        self.assertEquals(None, c.get('a', time.time() + 2))
+        self.assertEquals(1, c.expirations)
+        self.assertEquals(0, len(c))
+        self.assertEquals(0, c.nbytes)
+        return
+
+    def test_03_ttl_02(self):
+        """Test stale entries are kept for the stale time.
+        """
+        c = ReplyCache(1000)
+        c.put('a', [b'reply'], 1000, stale=5000)
+        now = time.time()
+        self.assertEquals(([b'reply'], True), c.lookup('a', now))
+        self.assertEquals(([b'reply'], False), c.lookup('a', now + 2))
+        self.assertEquals(None, c.get('a', now + 2))
+        self.assertEquals(None, c.lookup('a', now + 7))
+        self.assertEquals(2, c.stale_hits)
+        return
+
+    def test_04_evict_01(self):
+        """Test the least recently used entries are evicted.
+        """
+        c = ReplyCache(3 * (ENTRY_OVERHEAD + 10))
+        for key in 'abc':
+            c.put(key, [b'x' * 10], 1000)
+        c.get('a')
+        c.put('d', [b'x' * 10], 1000)
+        self.assertEquals(None, c.get('b'))
+        self.assertEquals(1, c.evictions)
+        self.assertEquals(3, len(c))
+        c.put('e', [b'x' * 4000], 1000)
+        self.assertEquals(None, c.get('e'))
+        return
+
+    def test_04_evict_02(self):
+        """Test the entry limit.
+        """
+        c = ReplyCache(10000, max_entries=2)
+        for key in 'abc':
+            c.put(key, [b'x'], 1000)
+        self.assertEquals(2, len(c))
+        self.assertEquals(None, c.get('a'))
+        return
+
+    def test_05_purge_01(self):
+        """Test removing the entries of a service.
+        """
+        c = ReplyCache(10000)
+        c.put(request_key(b'a', [b'1']), [b'x'], 1000)
+        c.put(request_key(b'b', [b'1']), [b'x'], 1000)
+        c.purge(b'a')
+        self.assertEquals(1, len(c))
+        self.assertEquals([b'x'], c.get(request_key(b'b', [b'1'])))
+        return
+#
+###
+
+if __name__ == '__main__':
+    sys.argv.append('-v')
+    unittest.main()
+#
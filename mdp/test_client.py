@@ -26,13 +26,17 @@ __email__ = 'gst-py@a-nugget.de'
 import sys
 import time
 import unittest
+import threading
+from functools import partial
 from pprint import pprint
 
 import zmq
 from zmq.eventloop.zmqstream import ZMQStream
 from zmq.eventloop.ioloop import IOLoop, DelayedCallback
 
-from client import MDPClient, InvalidStateError
+from client import MDPClient, MDPPipelineClient, InvalidStateError
+from client import MDPSyncClient, mdp_request, mdp_request_many
+from cache import ClientCache
 
 ###
 
@@ -191,6 +195,140 @@ class Test_MDPClient(unittest.TestCase):
         self.assertEquals(b'REPLY', client.last_msg[-1])
         self.assertEquals(self.service, client.last_msg[-2])
         return
+
+    def _on_pipeline_msg(self, msg):
+        self._msgs.append(msg)
+        if len(self._msgs) < 3:
+            return
+        # answer in reverse order
+        for m in reversed(self._msgs):
+            # identity, request id, empty, protocol, service, body
+            self.broker.send_multipart(m[:5] + [b'REPLY-' + m[5]])
+        return
+
+    def test_05_pipeline_01(self):
+        """Test MDPPipelineClient matches replies to requests.
+        """
+        self._start_broker()
+        self.broker.on_recv(self._on_pipeline_msg)
+        client = MDPPipelineClient(self.context, self.endpoint, self.service)
+        replies = {}
+        def on_reply(i, msg):
+            replies[i] = msg
+            if len(replies) == 3:
+                IOLoop.instance().stop()
+            return
+        for i in range(3):
+            client.request([b'%d' % i], partial(on_reply, i))
+        IOLoop.instance().start()
+        client.shutdown()
+        self._stop_broker()
+        self.assertEquals({0: [b'REPLY-0'], 1: [b'REPLY-1'], 2: [b'REPLY-2']}, replies)
+        return
+
+    def test_05_pipeline_02(self):
+        """Test MDPPipelineClient timeout and in-flight limit.
+        """
+        client = MDPPipelineClient(self.context, self.endpoint, self.service,
+                                   max_inflight=1)
+        replies = []
+        def on_reply(msg):
+            replies.append(msg)
+            if len(replies) == 2:
+                IOLoop.instance().stop()
+            return
+        client.request([b'A'], on_reply, 20)
+        client.request([b'B'], on_reply, 20)
+        self.assertEquals(2, len(client))
+        self.assertEquals(1, len(client._inflight))
+        IOLoop.instance().start()
+        client.shutdown()
+        self.assertEquals([None, None], replies)
+        return
+
+    def _start_sync_broker(self, count, drop=0):
+        """Helper running a fake broker in a thread.
+
+        Answers `count` requests with the request body, after dropping
+        the first `drop` ones.
+        """
+        socket = self.context.socket(zmq.XREP)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.bind(self.endpoint)
+        def run():
+            for i in range(count + drop):
+                msg = socket.recv_multipart()
+                if i >= drop:
+                    socket.send_multipart(msg)
+            socket.close()
+            return
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread
+
+    def test_06_sync_01(self):
+        """Test mdp_request_many returns replies in request order.
+        """
+        thread = self._start_sync_broker(3)
+        socket = self.context.socket(zmq.XREQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(self.endpoint)
+        reqs = [(self.service, [b'%d' % i]) for i in range(3)]
+        res = mdp_request_many(socket, reqs, 2.0, max_inflight=2)
+        socket.close()
+        thread.join()
+        self.assertEquals([[self.service, b'%d' % i] for i in range(3)], res)
+        return
+
+    def test_06_sync_02(self):
+        """Test MDPSyncClient retries with a fresh socket.
+        """
+        thread = self._start_sync_broker(1, drop=1)
+        client = MDPSyncClient(self.context, self.endpoint, timeout=0.2, retries=1)
+        res = client.request(self.service, [b'X'])
+        client.shutdown()
+        thread.join()
+        self.assertEquals([self.service, b'X'], res)
+        return
+
+    def test_07_cache_01(self):
+        """Test mdp_request answers repeated requests from the cache.
+        """
+        thread = self._start_sync_broker(2)
+        cache = ClientCache()
+        cache.set_ttl(self.service, 10000)
+        socket = self.context.socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(self.endpoint)
+        res = [mdp_request(socket, self.service, [b'X'], 2.0, cache) for i in range(3)]
+        res.append(mdp_request(socket, self.service, [b'Y'], 2.0, cache))
+        socket.close()
+        thread.join()
+        self.assertEquals([[self.service, b'X']] * 3 + [[self.service, b'Y']], res)
+        self.assertEquals(2, cache.replies.hits)
+        return
+
+    def test_07_cache_02(self):
+        """Test MDPClient refreshes a stale reply in the background.
+        """
+        self._start_broker(do_reply=True)
+        cache = ClientCache()
+        cache.set_ttl(self.service, 0, stale=10000)
+        client = MyClient(self.context, self.endpoint, self.service, cache)
+        for i in range(2):
+            client.request([b'X'])
+            IOLoop.instance().start()
+            self.assertEquals([b'MDPC01', self.service, b'REPLY'], client.last_msg)
+        # the refresh reply is not passed to on_message
+        client.last_msg = None
+        DelayedCallback(IOLoop.instance().stop, 200).start()
+        IOLoop.instance().start()
+        client.shutdown()
+        self.assertEquals(None, client.last_msg)
+        self.assertEquals(2, len(self._msgs))
+        self.assertEquals(1, cache.replies.stale_hits)
+        self.assertTrue(client.can_send)
+        return
 #
 ###
 
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+"""Unittests for the coroutine helpers.
+"""
+
+
+__license__ = """
+    This file is part of MDP.
+
+    MDP is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    MDP is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with MDP.  If not, see <http://www.gnu.org/licenses/>.
+"""
+__author__ = 'Guido Goldstein'
+__email__ = 'gst-py@a-nugget.de'
+
+import sys
+import unittest
+
+from concurrent.futures import Future, CancelledError
+from zmq.eventloop.ioloop import IOLoop
+
+from coro import coroutine, Return, gather, RequestTimeout
+import client
+
+###
+
+def _done(value):
+    f = Future()
+    f.set_result(value)
+    return f
+#
+
+def _cancel(future):
+    """Helper cancelling `future` from the IOLoop.
+
+    IOLoop callbacks must not return a value.
+    """
+    future.cancel()
+    return
+#
+
+class Test_Coroutine(unittest.TestCase):
+
+    def _run(self, future):
+        """Helper running the IOLoop until `future` is done.
+        """
+        ioloop = IOLoop.instance()
+        future.add_done_callback(lambda f: ioloop.add_callback(ioloop.stop))
+        timeout = ioloop.add_timeout(ioloop.time() + 2, ioloop.stop)
+        if not future.done():
+            ioloop.start()
+        ioloop.remove_timeout(timeout)
+        self.assertTrue(future.done())
+        return future.result()
+
+    def test_01_sync_01(self):
+        """Test a coroutine waiting for completed futures only.
+        """
+        @coroutine
+        def co(a):
+            b = yield _done(a + 1)
+            raise Return(b * 2)
+        f = co(1)
+        self.assertTrue(f.done())
+        self.assertEquals(4, f.result())
+        return
+
+    def test_01_sync_02(self):
+        """Test exceptions in coroutines.
+        """
+        @coroutine
+        def co():
+            yield _done(1)
+            raise KeyError('x')
+        self.assertRaises(KeyError, co().result)
+        return
+
+    def test_02_pending_01(self):
+        """Test a coroutine resumed from the IOLoop.
+        """
+        pending = Future()
+
+        @coroutine
+        def co():
+            v = yield pending
+            w = yield [_done(v), pending]
+            raise Return(w)
+        f = co()
+        self.assertFalse(f.done())
+        IOLoop.instance().add_callback(lambda: pending.set_result(3))
+        self.assertEquals([3, 3], self._run(f))
+        return
+
+    def test_02_pending_02(self):
+        """Test exceptions of awaited futures are raised in the coroutine.
+        """
+        pending = Future()
+
+        @coroutine
+        def co():
+            try:
+                yield pending
+            except ValueError:
+                raise Return('caught')
+        f = co()
+        IOLoop.instance().add_callback(lambda: pending.set_exception(ValueError()))
+        self.assertEquals('caught', self._run(f))
+        return
+
+    def test_02_pending_03(self):
+        """Test cancelling an awaited future raises CancelledError in the coroutine.
+        """
+        pending = Future()
+
+        @coroutine
+        def co():
+            try:
+                yield pending
+            except CancelledError:
+                raise Return('cancelled')
+        f = co()
+        IOLoop.instance().add_callback(_cancel, pending)
+        self.assertEquals('cancelled', self._run(f))
+        self.assertEquals('cancelled', co().result())
+        return
+
+    def test_03_gather_01(self):
+        """Test gather with no futures.
+        """
+        self.assertEquals([], gather().result())
+        return
+
+    def test_03_gather_02(self):
+        """Test gather fails if a future is cancelled.
+        """
+        pending = Future()
+        f = gather(_done(1), pending)
+        IOLoop.instance().add_callback(_cancel, pending)
+        self.assertRaises(CancelledError, self._run, f)
+        return
+
+    def test_04_timeout_01(self):
+        """Test the request timeout is the one of the client module.
+        """
+        self.assertTrue(RequestTimeout is client.RequestTimeout)
+        return
+#
+###
+
+if __name__ == '__main__':
+    sys.argv.append('-v')
+    unittest.main()
+#
+
+### Local Variables:
+### buffer-file-coding-system: utf-8
+### mode: python
+### End:
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+"""Unittests for the peering broker.
+"""
+
+
+__license__ = """
+    This file is part of MDP.
+
+    MDP is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    MDP is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with MDP.  If not, see <http://www.gnu.org/licenses/>.
+"""
+__author__ = 'Guido Goldstein'
+__email__ = 'gst-py@a-nugget.de'
+
+import sys
+import time
+import unittest
+
+import zmq
+from zmq.eventloop.ioloop import IOLoop
+
+from peering import PeeringBroker, PEER_PREFIX, STATE_EXPIRY, STATE_INTERVAL
+
+###
+
+class Test_PeeringBroker(unittest.TestCase):
+
+    """Tests of two peering brokers driven by raw sockets.
+    """
+
+    endpoints = { b'a': (b'tcp://127.0.0.1:7782', b'tcp://127.0.0.1:7783'),
+                  b'b': (b'tcp://127.0.0.1:7784', b'tcp://127.0.0.1:7785'),
+                  }
+    service = b'test'
+
+    W = PeeringBroker.WORKER_PROTO
+    C = PeeringBroker.CLIENT_PROTO
+
+    def setUp(self):
+        self.context = zmq.Context()
+        self.loop = IOLoop()
+        self.brokers = {}
+        for name, (main_ep, state_ep) in sorted(self.endpoints.items()):
+            peers = dict((k, v) for k, v in self.endpoints.iteritems() if k != name)
+            self.brokers[name] = PeeringBroker(self.context, main_ep, name, state_ep,
+                                               peers, ioloop=self.loop)
+        self.sockets = []
+        return
+
+    def tearDown(self):
+        for broker in self.brokers.values():
+            broker.shutdown()
+        for socket in self.sockets:
+            socket.close()
+        self.loop.close()
+        self.context.term()
+        return
+
+    def _spin(self, duration=0.01):
+        """Helper running the broker loop for `duration` seconds.
+        """
+        self.loop.add_timeout(time.time() + duration, self.loop.stop)
+        self.loop.start()
+        return
+
+    def _socket(self, broker):
+        socket = self.context.socket(zmq.XREQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(self.endpoints[broker][0])
+        self.sockets.append(socket)
+        return socket
+
+    def _worker(self, broker):
+        """Helper returning the socket of a worker registered with `broker`.
+        """
+        socket = self._socket(broker)
+        socket.send_multipart([b'', self.W, b'\x01', self.service])
+        self._spin(0.05)
+        return socket
+
+    def _recv(self, socket, timeout=1.0):
+        """Helper returning the next message of `socket`, `None` on timeout.
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            self._spin()
+            if socket.poll(0):
+                return socket.recv_multipart()
+        return None
+
+    def _reply(self, worker, request, body):
+        """Helper answering the request received by the worker.
+        """
+        i = request.index(b'', 1)
+        worker.send_multipart([b'', self.W, b'\x03'] + request[3:i+1] + body)
+        return
+
+    def _publish(self, source, target, timeout=2.0):
+        """Helper publishing the state of `source` until `target` received it.
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            self.brokers[source].publish_state()
+            self._spin(0.02)
+            if source in self.brokers[target]._peer_state:
+                return
+        self.fail('state not received')
+        return
+
+    def test_01_forward_01(self):
+        """Test a request forwarded to the peer with an idle worker.
+        """
+        worker = self._worker(b'b')
+        self._publish(b'b', b'a')
+        self.assertEquals({self.service: [1, 0]}, self.brokers[b'a']._peer_state[b'b'][1])
+        client = self._socket(b'a')
+        client.send_multipart([b'', self.C, self.service + b'@0', b'hello'])
+        req = self._recv(worker)
+        self.assertEquals([b'', self.W, b'\x02', PEER_PREFIX + b'a'], req[:4])
+        self.assertEquals(b'hello', req[-1])
+        self._reply(worker, req, [b'world'])
+        self.assertEquals([b'', self.C, self.service + b'@0', b'world'], self._recv(client))
+        return
+
+    def test_01_forward_02(self):
+        """Test requests stay local while a local worker is idle.
+        """
+        local = self._worker(b'a')
+        remote = self._worker(b'b')
+        self._publish(b'b', b'a')
+        client = self._socket(b'a')
+        client.send_multipart([b'', self.C, self.service, b'hello'])
+        self.assertNotEquals(None, self._recv(local))
+        self.assertEquals(None, self._recv(remote, 0.1))
+        return
+
+    def test_02_loop_01(self):
+        """Test requests received from a peer are not forwarded again.
+        """
+        worker = self._worker(b'b')
+        busy = self._socket(b'b')
+        busy.send_multipart([b'', self.C, self.service, b'first'])
+        first = self._recv(worker)
+        # both brokers believe the other one has an idle worker
+        self.brokers[b'a']._peer_state[b'b'] = (time.time(), {self.service: [1, 0]})
+        self.brokers[b'b']._peer_state[b'a'] = (time.time(), {self.service: [1, 0]})
+        client = self._socket(b'a')
+        client.send_multipart([b'', self.C, self.service, b'hello'])
+        self._spin(0.1)
+        self.assertEquals({self.service: [1, 0]}, self.brokers[b'b']._peer_state[b'a'][1])
+        # queued at b until its worker is idle again
+        self._reply(worker, first, [b'done'])
+        req = self._recv(worker)
+        self.assertEquals(b'hello', req[-1])
+        self._reply(worker, req, [b'world'])
+        self.assertEquals([b'', self.C, self.service, b'world'], self._recv(client))
+        return
+
+    def test_03_expiry_01(self):
+        """Test the state of a silent peer is ignored.
+        """
+        broker = self.brokers[b'a']
+        expired = time.time() - STATE_EXPIRY * STATE_INTERVAL / 1000.0 - 1
+        broker._peer_state[b'b'] = (expired, {self.service: [1, 0]})
+        self.assertEquals(None, broker.choose_peer(self.service, False))
+        broker._peer_state[b'b'] = (time.time(), {self.service: [1, 0]})
+        self.assertEquals(b'b', broker.choose_peer(self.service, False))
+        self.assertEquals({self.service: [0, 0]}, broker._peer_state[b'b'][1])
+        # state of unknown brokers is dropped
+        broker.on_peer_state([b'x', self.service, b'1', b'0'])
+        self.assertFalse(b'x' in broker._peer_state)
+        return
+#
+###
+
+if __name__ == '__main__':
+    sys.argv.append('-v')
+    unittest.main()
+#
+
+### Local Variables:
+### buffer-file-coding-system: utf-8
+### mode: python
+### End:
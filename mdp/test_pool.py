@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+"""Unittests for the broker pool.
+"""
+
+
+__license__ = """
+    This file is part of MDP.
+
+    MDP is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    MDP is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with MDP.  If not, see <http://www.gnu.org/licenses/>.
+"""
+__author__ = 'Guido Goldstein'
+__email__ = 'gst-py@a-nugget.de'
+
+import sys
+import time
+import unittest
+import threading
+
+from pool import BrokerPool, POOL_ROUND_ROBIN
+
+###
+
+EPS = ['tcp://a', 'tcp://b', 'tcp://c']
+
+class Test_BrokerPool(unittest.TestCase):
+
+    def test_01_least_outstanding_01(self):
+        """Test requests go to the broker with fewest open requests.
+        """
+        pool = BrokerPool(EPS)
+        got = [pool.acquire() for _ in range(3)]
+        self.assertEquals(EPS, sorted(b.endpoint for b in got))
+        pool.release(got[1], 0.01)
+        self.assertTrue(pool.acquire() is got[1])
+        return
+
+    def test_01_round_robin_01(self):
+        """Test round robin selection.
+        """
+        pool = BrokerPool(EPS, POOL_ROUND_ROBIN)
+        got = [pool.acquire().endpoint for _ in range(6)]
+        self.assertEquals(got[:3], got[3:])
+        self.assertEquals(EPS, sorted(got[:3]))
+        return
+
+    def test_02_eject_01(self):
+        """Test a failing broker is ejected and probed after the backoff.
+        """
+        pool = BrokerPool(EPS[:2], backoff=50)
+        a = pool.acquire()
+        pool.release(a, None)
+        for _ in range(5):
+            b = pool.acquire()
+            self.assertFalse(b is a)
+            pool.release(b, 0.01)
+        time.sleep(0.06)
+        probe = pool.acquire()
+        self.assertTrue(probe is a)
+        # only a single probe
+        self.assertFalse(pool.acquire() is a)
+        pool.release(probe, 0.01)
+        self.assertEquals(0, a.ejected_until)
+        return
+
+    def test_02_eject_02(self):
+        """Test the backoff doubles while probes fail.
+        """
+        pool = BrokerPool(EPS[:1], backoff=1000)
+        a = pool.acquire()
+        pool.release(a, None)
+        first = a.ejected_until - time.time()
+        a.ejected_until = time.time()
+        pool.release(pool.acquire(), None)
+        second = a.ejected_until - time.time()
+        self.assertTrue(1.8 < second / first < 2.2, (first, second))
+        return
+
+    def test_02_eject_03(self):
+        """Test slow brokers are ejected.
+        """
+        pool = BrokerPool(EPS[:2], max_latency=100)
+        a = pool.acquire()
+        pool.release(a, 0.5)
+        self.assertTrue(a.ejected_until > time.time())
+        return
+
+    def test_03_threads_01(self):
+        """Test the pool keeps its counts when shared by threads.
+        """
+        pool = BrokerPool(EPS)
+        def run():
+            for _ in xrange(2000):
+                pool.release(pool.acquire(), 0.001)
+            return
+        threads = [threading.Thread(target=run) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals([0, 0, 0], [b.outstanding for b in pool.brokers])
+        return
+#
+###
+
+if __name__ == '__main__':
+    sys.argv.append('-v')
+    unittest.main()
+#
+
+### Local Variables:
+### buffer-file-coding-system: utf-8
+### mode: python
+### End:
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+"""Unittests for the sharded broker.
+"""
+
+
+__license__ = """
+    This file is part of MDP.
+
+    MDP is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    MDP is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with MDP.  If not, see <http://www.gnu.org/licenses/>.
+"""
+__author__ = 'Guido Goldstein'
+__email__ = 'gst-py@a-nugget.de'
+
+import sys
+import time
+import unittest
+
+import zmq
+from zmq.eventloop.ioloop import IOLoop
+
+from shard import ShardedBroker, _merge_services, _merge_workers, _merge_counts
+
+###
+
+class Test_Merge(unittest.TestCase):
+
+    def test_01_merge_01(self):
+        """Test merging the MMI replies of the shards.
+        """
+        self.assertEquals([b'a', b'b'], sorted(_merge_services([[b'a'], [b'b', b'a'], []])))
+        self.assertEquals([b'5'], _merge_workers([[b'2'], [b'3'], []]))
+        self.assertEquals([b'hits', b'3', b'misses', b'1'],
+                          _merge_counts([[b'hits', b'1', b'misses', b'1'], [b'hits', b'2']]))
+        return
+#
+
+class Test_ShardedBroker(unittest.TestCase):
+
+    """Tests of a front end with two shards, driven by raw sockets.
+    """
+
+    endpoint = b'tcp://127.0.0.1:7781'
+
+    W = ShardedBroker.WORKER_PROTO
+    C = ShardedBroker.CLIENT_PROTO
+
+    def setUp(self):
+        self.context = zmq.Context()
+        self.loop = IOLoop()
+        self.broker = None
+        self.sockets = []
+        return
+
+    def tearDown(self):
+        if self.broker:
+            self.broker.shutdown()
+        for socket in self.sockets:
+            socket.close()
+        self.loop.close()
+        self.context.term()
+        return
+
+    def _start(self, **kw):
+        """Helper starting the broker and waiting for its shards.
+
+        Messages routed to a shard before it connected are dropped.
+        """
+        self.broker = ShardedBroker(self.context, self.endpoint, 2, ioloop=self.loop, **kw)
+        for name in self._names():
+            for i in range(10):
+                if self._ask(b'mmi.service', [name], 0.5):
+                    break
+            else:
+                self.fail('shard not started')
+        return self.broker
+
+    def _spin(self, duration=0.01):
+        self.loop.add_timeout(time.time() + duration, self.loop.stop)
+        self.loop.start()
+        return
+
+    def _socket(self):
+        socket = self.context.socket(zmq.XREQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(self.endpoint)
+        self.sockets.append(socket)
+        return socket
+
+    def _recv(self, socket, timeout=2.0):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            self._spin()
+            if socket.poll(0):
+                return socket.recv_multipart()
+        return None
+
+    def _ask(self, service, body=[], timeout=2.0):
+        """Helper sending a request and returning the reply.
+        """
+        client = self._socket()
+        client.send_multipart([b'', self.C, service] + body)
+        return self._recv(client, timeout)
+
+    def _worker(self, service):
+        """Helper returning the socket of a worker registered with a shard.
+        """
+        socket = self._socket()
+        socket.send_multipart([b'', self.W, b'\x01', service])
+        return socket
+
+    def _wait_workers(self, count, timeout=5.0):
+        """Helper waiting until the shards know `count` workers.
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            reply = self._ask(b'mmi.workers')
+            if reply and reply[3:] == [b'200', str(count)]:
+                return
+            self._spin(0.05)
+        self.fail('workers did not register')
+        return
+
+    def _names(self):
+        """Helper returning two service names mapped to different shards.
+        """
+        names = {}
+        for i in range(100):
+            name = b'svc%d' % i
+            names.setdefault(self.broker.shard_for(name), name)
+        return sorted(names.values())
+
+    def _serve(self, worker, prefix):
+        """Helper answering one request of the worker.
+        """
+        req = self._recv(worker)
+        i = req.index(b'', 1)
+        worker.send_multipart([b'', self.W, b'\x03'] + req[3:i+1] + [prefix] + req[i+1:])
+        return req
+
+    def test_01_shard_for_01(self):
+        """Test services are spread over all shards.
+        """
+        self._start()
+        names = self._names()
+        self.assertEquals(2, len(names))
+        self.assertEquals(self.broker.shard_for(names[0]), self.broker.shard_for(names[0]))
+        return
+
+    def test_02_route_01(self):
+        """Test requests are routed to the shard of their service and back.
+        """
+        self._start()
+        a, b = self._names()
+        wa = self._worker(a)
+        wb = self._worker(b)
+        self._wait_workers(2)
+        self.assertEquals(2, len(self.broker._worker_shard))
+        client = self._socket()
+        client.send_multipart([b'', self.C, a, b'1'])
+        client.send_multipart([b'', self.C, b + b'@2', b'2'])
+        self._serve(wa, b'A')
+        self._serve(wb, b'B')
+        replies = [self._recv(client), self._recv(client)]
+        self.assertEquals(sorted([[b'', self.C, a, b'A', b'1'],
+                                  [b'', self.C, b + b'@2', b'B', b'2']]),
+                          sorted(replies))
+        return
+
+    def test_03_mmi_01(self):
+        """Test aggregated and routed MMI queries.
+        """
+        self._start()
+        a, b = self._names()
+        self._worker(a)
+        self._worker(b)
+        self._worker(b)
+        self._wait_workers(3)
+        reply = self._ask(b'mmi.services')
+        self.assertEquals(b'200', reply[3])
+        self.assertEquals([a, b], sorted(reply[4:]))
+        self.assertEquals([b'200', b'2', b'2', b'0'], self._ask(b'mmi.workers', [b])[3:])
+        self.assertEquals([b'200'], self._ask(b'mmi.service', [a])[3:])
+        stats = self._ask(b'mmi.stats')
+        self.assertEquals(b'200', stats[3])
+        self.assertTrue(b'requests' in stats[4::2])
+        return
+
+    def test_04_options_01(self):
+        """Test service options are applied in the shards.
+        """
+        self._start(service_options={b'svc0': {'cacheable': 10000}})
+        worker = self._worker(b'svc0')
+        self._wait_workers(1)
+        client = self._socket()
+        client.send_multipart([b'', self.C, b'svc0', b'x'])
+        self._serve(worker, b'R')
+        self.assertEquals([b'R', b'x'], self._recv(client)[3:])
+        client.send_multipart([b'', self.C, b'svc0', b'x'])
+        self.assertEquals([b'R', b'x'], self._recv(client)[3:])
+        self.assertEquals(None, self._recv(worker, 0.2))
+        self.assertRaises(ValueError, ShardedBroker, self.context, self.endpoint, 2,
+                          service_options={b'svc0': {'unknown': 1}})
+        return
+
+    def test_05_disconnect_01(self):
+        """Test the front end forgets workers disconnected by a shard.
+        """
+        self._start()
+        worker = self._worker(b'svc0')
+        self._wait_workers(1)
+        worker.send_multipart([b'', self.W, b'\x09'])
+        self.assertEquals([b'', self.W, b'\x05'], self._recv(worker))
+        self.assertEquals({}, self.broker._worker_shard)
+        return
+#
+###
+
+if __name__ == '__main__':
+    sys.argv.append('-v')
+    unittest.main()
+#
+
+### Local Variables:
+### buffer-file-coding-system: utf-8
+### mode: python
+### End:
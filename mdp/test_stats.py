@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+"""Unittests for the broker statistics.
+"""
+
+
+__license__ = """
+    This file is part of MDP.
+
+    MDP is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    MDP is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with MDP.  If not, see <http://www.gnu.org/licenses/>.
+"""
+__author__ = 'Guido Goldstein'
+__email__ = 'gst-py@a-nugget.de'
+
+import sys
+import unittest
+
+from stats import Histogram, ServiceStats
+
+###
+
+class Test_Histogram(unittest.TestCase):
+
+    def test_01_empty_01(self):
+        """Test an empty histogram.
+        """
+        h = Histogram()
+        self.assertEquals(0, h.percentile(99))
+        self.assertEquals(0, h.mean())
+        self.assertEquals(0, h.snapshot()['count'])
+        return
+
+    def test_02_exact_01(self):
+        """Test small values are counted exactly.
+        """
+        h = Histogram()
+        for v in range(1, 31):
+            h.record(v)
+        self.assertEquals(15, h.percentile(50))
+        self.assertEquals(30, h.percentile(100))
+        self.assertEquals(30, h.max)
+        self.assertEquals(15.5, h.mean())
+        return
+
+    def test_03_precision_01(self):
+        """Test the relative error of large values.
+        """
+        for v in (100, 1000, 123456, 9999999):
+            h = Histogram()
+            h.record(v)
+            h.record(v + 1000000000)
+            p = h.percentile(50)
+            self.assertTrue(v <= p <= v * 1.07, (v, p))
+        return
+
+    def test_04_overflow_01(self):
+        """Test values above the resolved range.
+        """
+        h = Histogram(max_value=1000)
+        h.record(10 ** 9)
+        h.record(-5)
+        self.assertEquals(10 ** 9, h.max)
+        self.assertEquals(0, h.percentile(50))
+        self.assertEquals(10 ** 9, h.percentile(100))
+        return
+
+    def test_04_overflow_02(self):
+        """Test the overflow bucket is apart from the largest resolved one.
+        """
+        h = Histogram(max_value=1000)
+        h.record(1000)
+        h.record(10 ** 9)
+        self.assertEquals(1023, h.percentile(50))
+        self.assertEquals(10 ** 9, h.percentile(100))
+        return
+#
+
+class Test_ServiceStats(unittest.TestCase):
+
+    def test_01_snapshot_01(self):
+        """Test snapshot of service statistics.
+        """
+        st = ServiceStats()
+        st.requests += 2
+        st.residence.record(500)
+        snap = st.snapshot()
+        self.assertEquals(2, snap['requests'])
+        self.assertEquals(0, snap['dropped'])
+        self.assertEquals(500, snap['residence']['p99'])
+        self.assertEquals(0, snap['queue_wait']['count'])
+        return
+#
+###
+
+if __name__ == '__main__':
+    sys.argv.append('-v')
+    unittest.main()
+#
+
+### Local Variables:
+### buffer-file-coding-system: utf-8
+### mode: python
+### End:
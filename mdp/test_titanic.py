@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+"""Unittests for the Titanic store.
+"""
+
+
+__license__ = """
+    This file is part of MDP.
+
+    MDP is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    MDP is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with MDP.  If not, see <http://www.gnu.org/licenses/>.
+"""
+__author__ = 'Guido Goldstein'
+__email__ = 'gst-py@a-nugget.de'
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import zmq
+
+from titanicworker import TitanicStore, TitanicDispatcher, Titanic
+from titanicworker import encode_frames, decode_frames
+from util import DeadlineManager
+
+###
+
+UUID1 = b'1' * 32
+UUID2 = b'2' * 32
+
+class Test_TitanicStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = TitanicStore(self.directory)
+        return
+
+    def tearDown(self):
+        if self.store:
+            self.store.close()
+        shutil.rmtree(self.directory)
+        return
+
+    def test_01_frames_01(self):
+        """Test encoding and decoding of message parts.
+        """
+        frames = [b'a', b'', b'bcd']
+        self.assertEquals(frames, decode_frames(encode_frames(frames)))
+        self.assertEquals([], decode_frames(encode_frames([])))
+        return
+
+    def test_02_commit_01(self):
+        """Test writes are visible and confirmed after commit only.
+        """
+        done = []
+        self.store.put_request(UUID1, b'echo', [b'x'], lambda: done.append(1))
+        self.assertEquals(None, self.store.get_request(UUID1))
+        self.assertEquals([], done)
+        self.store.commit()
+        self.assertEquals([1], done)
+        self.assertEquals((b'echo', [b'x']), self.store.get_request(UUID1))
+        return
+
+    def test_02_commit_02(self):
+        """Test a full batch commits immediately.
+        """
+        self.store.commit_batch = 2
+        done = []
+        self.store.put_request(UUID1, b'echo', [b'x'], lambda: done.append(1))
+        self.store.put_request(UUID2, b'echo', [b'y'], lambda: done.append(2))
+        self.assertEquals([1, 2], done)
+        return
+
+    def test_03_reply_01(self):
+        """Test reply states.
+        """
+        self.assertEquals((b'400', []), self.store.get_reply(UUID1))
+        self.store.put_request(UUID1, b'echo', [b'x'])
+        self.store.commit()
+        self.assertEquals((b'300', []), self.store.get_reply(UUID1))
+        self.assertEquals([UUID1], self.store.pending())
+        self.store.put_reply(UUID1, [b'y', b'z'])
+        self.store.commit()
+        self.assertEquals((b'200', [b'y', b'z']), self.store.get_reply(UUID1))
+        self.assertEquals([], self.store.pending())
+        self.store.close_request(UUID1)
+        self.store.commit()
+        self.assertEquals((b'400', []), self.store.get_reply(UUID1))
+        return
+
+    def test_04_rebuild_01(self):
+        """Test the index is rebuilt from the log.
+        """
+        self.store.put_request(UUID1, b'echo', [b'x'])
+        self.store.put_request(UUID2, b'echo', [b'y'])
+        self.store.put_reply(UUID1, [b'z'])
+        self.store.close()
+        for name in os.listdir(self.directory):
+            if name.startswith('titanic.idx'):
+                os.remove(os.path.join(self.directory, name))
+        self.store = TitanicStore(self.directory)
+        self.assertEquals((b'200', [b'z']), self.store.get_reply(UUID1))
+        self.assertEquals((b'echo', [b'y']), self.store.get_request(UUID2))
+        self.assertEquals([UUID2], self.store.pending())
+        return
+#
+
+class Test_Titanic(unittest.TestCase):
+
+    endpoint = b'tcp://127.0.0.1:7779'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.context = zmq.Context()
+        return
+
+    def tearDown(self):
+        self.context.term()
+        shutil.rmtree(self.directory)
+        return
+
+    def test_01_retry_01(self):
+        """Test shutdown cancels pending retries of the dispatcher.
+        """
+        store = TitanicStore(self.directory)
+        dispatcher = TitanicDispatcher(self.context, self.endpoint, store)
+        deadlines = DeadlineManager.instance()
+        before = len(deadlines)
+        dispatcher._on_reply(UUID1, None)
+        self.assertEquals(before + 1, len(deadlines))
+        dispatcher.shutdown()
+        self.assertEquals(before, len(deadlines))
+        dispatcher._on_reply(UUID2, None)
+        self.assertEquals(before, len(deadlines))
+        store.close()
+        return
+
+    def test_02_shutdown_01(self):
+        """Test requests committed on shutdown are not dispatched any more.
+        """
+        titanic = Titanic(self.context, self.endpoint, self.directory)
+        dispatcher = titanic.dispatcher
+        titanic.store.put_request(UUID1, b'echo', [b'x'],
+                                  lambda: dispatcher.submit(UUID1))
+        titanic.shutdown()
+        self.assertEquals({}, dispatcher._clients)
+        return
+#
+###
+
+if __name__ == '__main__':
+    sys.argv.append('-v')
+    unittest.main()
+#
+
+### Local Variables:
+### buffer-file-coding-system: utf-8
+### mode: python
+### End:
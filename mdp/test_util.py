@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+"""Unittests for the helpers in the util module.
+"""
+
+
+__license__ = """
+    This file is part of MDP.
+
+    MDP is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    MDP is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with MDP.  If not, see <http://www.gnu.org/licenses/>.
+"""
+__author__ = 'Guido Goldstein'
+__email__ = 'gst-py@a-nugget.de'
+
+import sys
+import time
+import unittest
+
+import zmq
+from zmq.eventloop.ioloop import IOLoop
+
+from util import split_address, split_frames, TimerWheel, Deadlines, DeadlineManager
+from util import BatchStream
+
+###
+
+class Test_Util(unittest.TestCase):
+
+    def test_01_split_address_01(self):
+        """Test split_address.
+        """
+        rp, msg = split_address([b'id1', b'id2', b'', b'data'])
+        self.assertEquals([b'id1', b'id2'], rp)
+        self.assertEquals([b'data'], msg)
+        return
+
+    def test_01_split_frames_01(self):
+        """Test split_frames.
+        """
+        frames = [zmq.Frame(p) for p in (b'id1', b'id2', b'', b'data')]
+        rp, i = split_frames(frames)
+        self.assertEquals([b'id1', b'id2'], rp)
+        self.assertEquals(3, i)
+        self.assertTrue(frames[i] is frames[-1])
+        return
+#
+
+class Test_TimerWheel(unittest.TestCase):
+
+    def _advance(self, wheel, n):
+        expired = []
+        for i in range(n):
+            expired.append(wheel.advance())
+        return expired
+
+    def test_01_expire_01(self):
+        """Test timers expire on the right tick.
+        """
+        wheel = TimerWheel(100, 10)
+        wheel.add(b'a', 100)
+        wheel.add(b'b', 250)
+        wheel.add(b'c', 1000)
+        self.assertEquals(3, len(wheel))
+        expired = self._advance(wheel, 10)
+        self.assertEquals([b'a'], expired[0])
+        self.assertEquals([b'b'], expired[2])
+        self.assertEquals([b'c'], expired[9])
+        self.assertEquals(0, len(wheel))
+        return
+
+    def test_01_expire_02(self):
+        """Test timers longer than one revolution.
+        """
+        wheel = TimerWheel(100, 4)
+        wheel.add(b'a', 1000)
+        expired = self._advance(wheel, 10)
+        self.assertEquals([[]] * 9 + [[b'a']], expired)
+        return
+
+    def test_02_remove_01(self):
+        """Test cancel and reschedule.
+        """
+        wheel = TimerWheel(100, 10)
+        wheel.add(b'a', 300)
+        wheel.add(b'b', 300)
+        wheel.remove(b'a')
+        wheel.remove(b'unknown')
+        wheel.add(b'b', 500)
+        self.assertFalse(b'a' in wheel)
+        expired = self._advance(wheel, 5)
+        self.assertEquals([[], [], [], [], [b'b']], expired)
+        return
+#
+
+class Test_Deadlines(unittest.TestCase):
+
+    def test_01_run_01(self):
+        """Test deadlines fire in order and only when due.
+        """
+        fired = []
+        dl = Deadlines()
+        dl.add(3.0, lambda: fired.append(3))
+        dl.add(1.0, lambda: fired.append(1))
+        dl.add(2.0, lambda: fired.append(2))
+        self.assertEquals(1.0, dl.next_deadline())
+        self.assertEquals(2, dl.run(2.0))
+        self.assertEquals([1, 2], fired)
+        self.assertEquals(1, len(dl))
+        self.assertEquals(1, dl.run(10.0))
+        self.assertEquals(None, dl.next_deadline())
+        return
+
+    def test_02_cancel_01(self):
+        """Test cancelled deadlines do not fire.
+        """
+        fired = []
+        dl = Deadlines()
+        h1 = dl.add(1.0, lambda: fired.append(1))
+        dl.add(2.0, lambda: fired.append(2))
+        dl.cancel(h1)
+        dl.cancel(h1)
+        self.assertEquals(1, len(dl))
+        self.assertEquals(2.0, dl.next_deadline())
+        dl.run(5.0)
+        self.assertEquals([2], fired)
+        return
+
+    def test_02_cancel_02(self):
+        """Test the heap is compacted when most entries are cancelled.
+        """
+        dl = Deadlines()
+        handles = [dl.add(float(i), lambda: None) for i in range(1000)]
+        for h in handles[:-1]:
+            dl.cancel(h)
+        self.assertEquals(1, len(dl))
+        self.assertTrue(len(dl._heap) < 100)
+        return
+
+class Test_DeadlineManager(unittest.TestCase):
+
+    def test_01_add_in_callback_01(self):
+        """Test a timeout added during a sweep does not delay earlier ones.
+        """
+        loop = IOLoop()
+        dm = DeadlineManager(loop)
+        fired = {}
+        start = time.time()
+        def on_a():
+            fired['a'] = time.time() - start
+            dm.add_timeout(500, lambda: None)
+            return
+        def on_b():
+            fired['b'] = time.time() - start
+            loop.stop()
+            return
+        dm.add_timeout(100, on_a)
+        dm.add_timeout(200, on_b)
+        loop.add_timeout(start + 2.0, loop.stop)
+        loop.start()
+        loop.close()
+        self.assertTrue('a' in fired)
+        self.assertTrue(0.19 < fired['b'] < 0.4, fired)
+        return
+#
+
+class Test_BatchStream(unittest.TestCase):
+
+    def setUp(self):
+        self.context = zmq.Context()
+        self.loop = IOLoop()
+        return
+
+    def tearDown(self):
+        self.loop.close()
+        self.context.term()
+        return
+
+    def _pair(self):
+        """Helper returning a connected pair of PAIR sockets.
+        """
+        a = self.context.socket(zmq.PAIR)
+        a.bind('inproc://test-batch')
+        b = self.context.socket(zmq.PAIR)
+        b.connect('inproc://test-batch')
+        return a, b
+
+    def test_01_recv_01(self):
+        """Test at most `batch` messages are handled per readable event.
+        """
+        a, b = self._pair()
+        stream = BatchStream(a, self.loop, 2)
+        received = []
+        stream.on_recv(received.append)
+        for i in range(5):
+            b.send_multipart([str(i), b'x'])
+        a.poll(1000)
+        stream._handle_recv(None, IOLoop.READ)
+        self.assertEquals([[b'0', b'x'], [b'1', b'x']], received)
+        stream._handle_recv(None, IOLoop.READ)
+        stream._handle_recv(None, IOLoop.READ)
+        stream._handle_recv(None, IOLoop.READ)
+        self.assertEquals(5, len(received))
+        stream.send_multipart([b'reply'])
+        self.assertEquals([b'reply'], b.recv_multipart())
+        stream.close()
+        b.close()
+        return
+
+    def test_01_recv_02(self):
+        """Test messages left over from a capped batch are handled.
+        """
+        a, b = self._pair()
+        stream = BatchStream(a, self.loop, 2)
+        received = []
+        stream.on_recv(received.append)
+        for i in range(5):
+            b.send_multipart([str(i), b'x'])
+        self.loop.add_timeout(time.time() + 0.1, self.loop.stop)
+        self.loop.start()
+        self.assertEquals([[str(i), b'x'] for i in range(5)], received)
+        stream.close()
+        b.close()
+        return
+
+    def test_02_dropped_01(self):
+        """Test messages which cannot be sent are dropped and counted.
+        """
+        socket = self.context.socket(zmq.PUSH)
+        socket.setsockopt(zmq.LINGER, 0)
+        stream = BatchStream(socket, self.loop)
+        stream.send_multipart([b'lost'])
+        stream.send_multipart([b'lost'])
+        self.assertEquals(2, stream.dropped)
+        stream.close()
+        return
+#
+###
+
+if __name__ == '__main__':
+    sys.argv.append('-v')
+    unittest.main()
+#
+
+### Local Variables:
+### buffer-file-coding-system: utf-8
+### mode: python
+### End:
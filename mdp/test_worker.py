@@ -28,11 +28,14 @@ import time
 import unittest
 from pprint import pprint
 
+from concurrent.futures import ThreadPoolExecutor
+
 import zmq
 from zmq.eventloop.zmqstream import ZMQStream
 from zmq.eventloop.ioloop import IOLoop, DelayedCallback, PeriodicCallback
 
-from worker import MDPWorker, ConnectionNotReadyError, MissingHeartbeat
+from worker import MDPWorker, MDPAsyncWorker, MDPExecutorWorker
+from worker import ConnectionNotReadyError, MissingHeartbeat
 
 ###
 
@@ -40,6 +43,20 @@ _do_print = True
 
 ###
 
+def _echo(msg):
+    return [b'ECHO'] + msg
+#
+
+def _nothing(msg):
+    return None
+#
+
+class NoneWorker(MDPAsyncWorker):
+
+    def handle(self, msg):
+        return None
+#
+
 class MyWorker(MDPWorker):
 
     HB_LIVENESS = 10
@@ -79,15 +96,16 @@ class Test_MDPWorker(unittest.TestCase):
         if _do_print:
             print 'broker received:',
             pprint(msg)
-        self.target = msg.pop(0)
-        if msg[1] == chr(1): # ready
+        self._msgs.append(msg)
+        # worker id, empty, protocol, command, ...
+        self.target = msg[0]
+        if msg[3] == chr(1): # ready
             print 'READY'
-            self.target = msg[0]
             return
-        if msg[1] == chr(4): # ready
+        if msg[3] == chr(4): # heartbeat
             print 'HB'
             return
-        if msg[1] == chr(3): # reply
+        if msg[3] == chr(3): # reply
             IOLoop.instance().stop()
             return
         return
@@ -117,13 +135,13 @@ class Test_MDPWorker(unittest.TestCase):
 
     def _tick(self):
         if self.broker and self.target:
-            msg = [self.target, b'MPDW01', chr(4)]
+            msg = [self.target, b'', b'MDPW01', chr(4)]
             self.broker.send_multipart(msg)
         return
 
     def send_req(self):
         data = ['AA', 'bb']
-        msg = [self.target, b'MPDW01', chr(2), self.target, b''] + data
+        msg = [self.target, b'', b'MDPW01', chr(2), b'client', b''] + data
         print 'borker sending:',
         pprint(msg)
         self.broker.send_multipart(msg)
@@ -142,6 +160,108 @@ class Test_MDPWorker(unittest.TestCase):
         IOLoop.instance().start()
         worker.shutdown()
         self._stop_broker()
+        self.assertEquals([b'REPLY', b'AA', b'bb'], self._msgs[-1][6:])
+        return
+
+    def _spin(self, duration=0.1):
+        """Helper running the IOLoop for `duration` seconds.
+        """
+        ioloop = IOLoop.instance()
+        ioloop.add_timeout(time.time() + duration, ioloop.stop)
+        ioloop.start()
+        return
+
+    def _heartbeats(self):
+        return len([m for m in self._msgs if m[3] == chr(4)])
+
+    def test_02_heartbeat_01(self):
+        """Test MDPWorker sends no heartbeat after other traffic.
+        """
+        self._start_broker()
+        self.broker.ticker.stop()
+        worker = MyWorker(self.context, self.endpoint, self.service)
+        worker.ticker.stop()
+        self._spin()
+        # READY was sent during this interval
+        worker._tick()
+        self._spin()
+        self.assertEquals(0, self._heartbeats())
+        worker._tick()
+        self._spin()
+        self.assertEquals(1, self._heartbeats())
+        worker.envelope = [b'', worker._proto_version, b'\x03', b'client', b'']
+        worker.reply([b'x'])
+        worker._tick()
+        self._spin()
+        self.assertEquals(1, self._heartbeats())
+        worker.shutdown()
+        return
+
+    def test_03_executor_01(self):
+        """Test MDPExecutorWorker announces its capacity and runs requests.
+        """
+        self._start_broker()
+        executor = ThreadPoolExecutor(2)
+        worker = MDPExecutorWorker(self.context, self.endpoint, self.service,
+                                   executor, 2, _echo)
+        deadline = time.time() + 2
+        while time.time() < deadline and not self._msgs:
+            self._spin(0.05)
+        self.assertEquals([b'', b'MDPW01', chr(1), self.service, b'2'], self._msgs[0][1:])
+        for tag in (b'1', b'2'):
+            self.broker.send_multipart([self.target, b'', b'MDPW01', chr(2),
+                                        b'client', tag, b'', tag])
+        deadline = time.time() + 2
+        replies = []
+        while time.time() < deadline and len(replies) < 2:
+            self._spin(0.05)
+            replies = sorted(m[4:] for m in self._msgs if m[3] == chr(3))
+        self.assertEquals([[b'client', b'1', b'', b'ECHO', b'1'],
+                           [b'client', b'2', b'', b'ECHO', b'2']], replies)
+        worker.shutdown()
+        executor.shutdown()
+        return
+
+    def test_03_executor_02(self):
+        """Test MDPExecutorWorker answers 500 when the handler returns None.
+        """
+        self._start_broker()
+        executor = ThreadPoolExecutor(1)
+        worker = MDPExecutorWorker(self.context, self.endpoint, self.service,
+                                   executor, 1, _nothing)
+        deadline = time.time() + 2
+        while time.time() < deadline and not self._msgs:
+            self._spin(0.05)
+        self.assertEquals([b'', b'MDPW01', chr(1), self.service], self._msgs[0][1:])
+        self.broker.send_multipart([self.target, b'', b'MDPW01', chr(2),
+                                    b'client', b'', b'x'])
+        deadline = time.time() + 2
+        replies = []
+        while time.time() < deadline and not replies:
+            self._spin(0.05)
+            replies = [m[4:] for m in self._msgs if m[3] == chr(3)]
+        self.assertEquals([[b'client', b'', b'500']], replies)
+        worker.shutdown()
+        executor.shutdown()
+        return
+
+    def test_04_async_01(self):
+        """Test MDPAsyncWorker answers 500 when handle returns None.
+        """
+        self._start_broker()
+        worker = NoneWorker(self.context, self.endpoint, self.service, 1)
+        deadline = time.time() + 2
+        while time.time() < deadline and not self._msgs:
+            self._spin(0.05)
+        self.broker.send_multipart([self.target, b'', b'MDPW01', chr(2),
+                                    b'client', b'', b'x'])
+        deadline = time.time() + 2
+        replies = []
+        while time.time() < deadline and not replies:
+            self._spin(0.05)
+            replies = [m[4:] for m in self._msgs if m[3] == chr(3)]
+        self.assertEquals([[b'client', b'', b'500']], replies)
+        worker.shutdown()
         return
 #
 ###
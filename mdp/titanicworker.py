@@ -1,5 +1,33 @@
 # -*- coding: utf-8 -*-
 
+"""Module implementing the Titanic service for disconnected reliability.
+
+For the Titanic specification see: http://rfc.zeromq.org/spec:9
+
+Three services are offered on a MDP broker:
+
+  titanic.request
+    Frame 0 is the service name, the remaining frames are the request.
+    The request is stored durably and `200` plus the request UUID is
+    returned.
+
+  titanic.reply
+    Frame 0 is a request UUID. Returns `200` plus the reply, `300` if
+    the reply is pending or `400` if the request is unknown.
+
+  titanic.close
+    Frame 0 is a request UUID. The request and its reply are discarded.
+    Returns `200`.
+
+Stored requests are passed on to their service by a dispatcher and the
+replies are stored.
+
+All data is kept in an append-only log. Writes are made durable with
+group commit: they are collected for a few milliseconds and synced to
+disk with one `fsync`. Requests are only confirmed after their sync.
+An index file maps request UUIDs to log positions for O(1) lookups.
+"""
+
 __license__ = """
     This file is part of MDP.
 
@@ -19,40 +47,470 @@ __license__ = """
 __author__ = 'Guido Goldstein'
 __email__ = 'gst-py@a-nugget.de'
 
+import os
+import sys
+import struct
+import anydbm
+from whichdb import whichdb
+from uuid import uuid4
+from functools import partial
+
 import zmq
-from zmq.eventloop.ioloop import IOLoop
+from zmq.eventloop.ioloop import IOLoop, DelayedCallback
 
 from worker import MDPWorker
-from client import MDPClient
+from client import MDPPipelineClient
+from util import DeadlineManager
+
+###
+
+REC_REQUEST = b'Q'  #: log record holding a request
+REC_REPLY = b'R'    #: log record holding a reply
+REC_CLOSE = b'C'    #: log record marking a request as closed
+
+_REC_HEADER = struct.Struct('!cI32s')  # type, payload length, uuid
+_FRAME_HEADER = struct.Struct('!I')
 
 ###
-class TitanicClient(MDPClient):
 
+def encode_frames(frames):
+    """Returns the message parts packed into one string.
     """
+    parts = []
+    for f in frames:
+        parts.append(_FRAME_HEADER.pack(len(f)))
+        parts.append(f)
+    return b''.join(parts)
+#
+
+def decode_frames(data):
+    """Returns the list of message parts packed by :func:`encode_frames`.
+    """
+    frames = []
+    pos = 0
+    size = _FRAME_HEADER.size
+    while pos < len(data):
+        (n,) = _FRAME_HEADER.unpack_from(data, pos)
+        pos += size
+        frames.append(data[pos:pos+n])
+        pos += n
+    return frames
+#
+###
+
+class TitanicStore(object):
+
+    """Durable storage for Titanic requests and replies.
+
+    Records are appended to `titanic.log` in `directory`. Writes are
+    buffered and made durable by :func:`commit`, which runs at most
+    `commit_delay` milliseconds after the first uncommitted write, or as
+    soon as `commit_batch` writes are waiting. The callbacks given to
+    the write methods are called after the commit.
+
+    The index `titanic.idx` maps each open request UUID to the log
+    positions of its request and reply. It is only updated after a
+    commit, so it never points to data which is not durable. If the
+    index is missing it is rebuilt from the log.
+
+    :param directory:     directory holding the log and the index.
+    :type directory:      str
+    :param commit_delay:  maximum time in ms writes wait for their commit.
+    :type commit_delay:   int
+    :param commit_batch:  number of writes triggering an immediate commit.
+    :type commit_batch:   int
+    """
+
+    def __init__(self, directory, commit_delay=2, commit_batch=256):
+        """Initialize the store.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.commit_delay = commit_delay
+        self.commit_batch = commit_batch
+        log_name = os.path.join(directory, 'titanic.log')
+        idx_name = os.path.join(directory, 'titanic.idx')
+        rebuild = whichdb(idx_name) is None and os.path.exists(log_name)
+        self._log = open(log_name, 'ab')
+        self._reader = open(log_name, 'rb')
+        self._log_size = self._log.tell()
+        self._index = anydbm.open(idx_name, 'c')
+        # (uuid, kind, offset, length) of written but not committed records
+        self._uncommitted = []
+        self._callbacks = []
+        self._commit_cb = None
+        if rebuild:
+            self.rebuild_index()
+        return
+
+    def close(self):
+        """Commit outstanding writes and close all files.
+        """
+        self.commit()
+        self._index.close()
+        self._log.close()
+        self._reader.close()
+        return
+
+    def _append(self, kind, uuid, payload, callback):
+        """Helper appending a record to the log.
+        """
+        header = _REC_HEADER.pack(kind, len(payload), uuid)
+        self._log.write(header)
+        self._log.write(payload)
+        offset = self._log_size + len(header)
+        self._log_size = offset + len(payload)
+        self._uncommitted.append((uuid, kind, offset, len(payload)))
+        if callback:
+            self._callbacks.append(callback)
+        if len(self._uncommitted) >= self.commit_batch:
+            self.commit()
+        elif self._commit_cb is None:
+            self._commit_cb = DelayedCallback(self.commit, self.commit_delay)
+            self._commit_cb.start()
+        return
+
+    def commit(self):
+        """Make all writes durable, update the index and call the callbacks.
+        """
+        if self._commit_cb:
+            self._commit_cb.stop()
+            self._commit_cb = None
+        if not self._uncommitted:
+            return
+        self._log.flush()
+        os.fsync(self._log.fileno())
+        for uuid, kind, offset, length in self._uncommitted:
+            self._index_record(uuid, kind, offset, length)
+        self._uncommitted = []
+        if hasattr(self._index, 'sync'):
+            self._index.sync()
+        callbacks = self._callbacks
+        self._callbacks = []
+        for callback in callbacks:
+            callback()
+        return
+
+    def _index_record(self, uuid, kind, offset, length):
+        """Helper updating the index entry of `uuid` for a log record.
+
+        Index entries are "request offset, request length, reply offset,
+        reply length", the reply position being -1 while pending.
+        """
+        if kind == REC_REQUEST:
+            self._index[uuid] = b'%d %d -1 -1' % (offset, length)
+        elif kind == REC_REPLY:
+            entry = self._index.get(uuid)
+            if entry is not None:
+                req = entry.split()[:2]
+                self._index[uuid] = b'%s %s %d %d' % (req[0], req[1], offset, length)
+        elif kind == REC_CLOSE:
+            if uuid in self._index:
+                del self._index[uuid]
+        return
+
+    def rebuild_index(self):
+        """Recreate the index by scanning the whole log.
+
+        A truncated record at the end of the log, left by a crash, is
+        ignored.
+        """
+        reader = self._reader
+        reader.seek(0)
+        pos = 0
+        size = _REC_HEADER.size
+        while True:
+            header = reader.read(size)
+            if len(header) < size:
+                break
+            kind, length, uuid = _REC_HEADER.unpack(header)
+            reader.seek(length, os.SEEK_CUR)
+            if pos + size + length > self._log_size:
+                break
+            self._index_record(uuid, kind, pos + size, length)
+            pos += size + length
+        if hasattr(self._index, 'sync'):
+            self._index.sync()
+        return
+
+    def _read(self, offset, length):
+        """Helper reading a record payload from the log.
+        """
+        self._reader.seek(offset)
+        return self._reader.read(length)
+
+    def put_request(self, uuid, service, msg, callback=None):
+        """Store a request.
+
+        :param uuid:      the request UUID.
+        :type uuid:       str
+        :param service:   the service the request is for.
+        :type service:    str
+        :param msg:       the request message parts.
+        :type msg:        list of str
+        :param callback:  called without arguments once the request is durable.
+        :type callback:   callable
+        """
+        self._append(REC_REQUEST, uuid, encode_frames([service] + msg), callback)
+        return
+
+    def put_reply(self, uuid, msg, callback=None):
+        """Store the reply to a request.
+        """
+        self._append(REC_REPLY, uuid, encode_frames(msg), callback)
+        return
+
+    def close_request(self, uuid, callback=None):
+        """Discard a request and its reply.
+        """
+        self._append(REC_CLOSE, uuid, b'', callback)
+        return
+
+    def get_request(self, uuid):
+        """Returns 2-tuple of service and request parts, or `None` if unknown.
+        """
+        entry = self._index.get(uuid)
+        if entry is None:
+            return None
+        offset, length = entry.split()[:2]
+        frames = decode_frames(self._read(int(offset), int(length)))
+        return (frames[0], frames[1:])
+
+    def get_reply(self, uuid):
+        """Returns the Titanic status and the reply parts of a request.
+
+        The status is `200` with the reply parts, `300` while the reply
+        is pending or `400` if the request is unknown.
+
+        :rtype: tuple of str and list of str
+        """
+        entry = self._index.get(uuid)
+        if entry is None:
+            return (b'400', [])
+        offset, length = [int(v) for v in entry.split()[2:]]
+        if offset < 0:
+            return (b'300', [])
+        return (b'200', decode_frames(self._read(offset, length)))
+
+    def pending(self):
+        """Returns the UUIDs of all requests still waiting for a reply.
+
+        Scans the whole index, meant to be used on startup only.
+        """
+        return [uuid for uuid in self._index.keys()
+                if self._index[uuid].endswith(b' -1 -1')]
+#
+###
+
+class TitanicDispatcher(object):
+
+    """Passes stored requests on to their services and stores the replies.
+
+    Uses one :class:`MDPPipelineClient` per service. Requests without
+    reply in time are retried after `retry` milliseconds.
+
+    After :func:`shutdown` nothing is sent any more, pending retries are
+    cancelled.
+
+    :param context:   the ZeroMQ context to create the sockets in.
+    :type context:    zmq.Context
+    :param endpoint:  the broker endpoint.
+    :type endpoint:   str
+    :param store:     the store holding the requests.
+    :type store:      TitanicStore
+    :param timeout:   time in ms to wait for a reply.
+    :type timeout:    int
+    :param retry:     time in ms to wait before a request is sent again.
+    :type retry:      int
     """
 
-    def on_message(self, msg):
-        pass
+    def __init__(self, context, endpoint, store, timeout=5000, retry=1000):
+        """Initialize the dispatcher.
+        """
+        self.context = context
+        self.endpoint = endpoint
+        self.store = store
+        self.timeout = timeout
+        self.retry = retry
+        self._clients = {}
+        # maps uuid -> DeadlineManager handle of the pending retry
+        self._retries = {}
+        self._closed = False
+        return
+
+    def shutdown(self):
+        """Cancel pending retries and shutdown the clients of all services.
+
+        Requests in flight stay pending in the store.
+        """
+        self._closed = True
+        deadlines = DeadlineManager.instance()
+        for handle in self._retries.itervalues():
+            deadlines.cancel(handle)
+        self._retries = {}
+        for client in self._clients.itervalues():
+            client.shutdown()
+        self._clients = {}
+        return
+
+    def submit(self, uuid):
+        """Send the stored request `uuid` to its service.
+        """
+        self._retries.pop(uuid, None)
+        if self._closed:
+            return
+        req = self.store.get_request(uuid)
+        if req is None:
+            # closed meanwhile
+            return
+        service, msg = req
+        client = self._clients.get(service)
+        if client is None:
+            client = MDPPipelineClient(self.context, self.endpoint, service)
+            self._clients[service] = client
+        client.request(msg, partial(self._on_reply, uuid), self.timeout)
+        return
+
+    def _on_reply(self, uuid, msg):
+        """Helper called with the reply to a request or `None` on timeout.
+        """
+        if msg is None:
+            if not self._closed:
+                self._retries[uuid] = DeadlineManager.instance().add_timeout(
+                    self.retry, partial(self.submit, uuid))
+            return
+        self.store.put_reply(uuid, msg)
+        return
 #
 
 class TitanicWorker(MDPWorker):
 
+    """Base class for the workers of the Titanic services.
+
+    :param context:    the ZeroMQ context to create the socket in.
+    :type context:     zmq.Context
+    :param endpoint:   the broker endpoint.
+    :type endpoint:    str
+    :param service:    the service to offer.
+    :type service:     str
+    :param store:      the store to use.
+    :type store:       TitanicStore
+    :param capacity:   number of requests accepted concurrently.
+    :type capacity:    int
+    """
+
     HB_INTERVAL = 1000
     HB_LIVENESS = 3
 
-    count = 0
+    def __init__(self, context, endpoint, service, store, capacity=1):
+        self.store = store
+        MDPWorker.__init__(self, context, endpoint, service, capacity)
+        return
+#
+
+class TitanicRequestWorker(TitanicWorker):
+
+    """Worker for `titanic.request`.
+
+    Accepts many requests concurrently, so their writes share commits.
+    """
+
+    def __init__(self, context, endpoint, store, dispatcher, capacity=256):
+        self.dispatcher = dispatcher
+        TitanicWorker.__init__(self, context, endpoint, b'titanic.request', store, capacity)
+        return
 
     def on_request(self, msg):
-        self.count = self.count + 1
-        answer = ['REPLY'] + msg
-        self.reply(answer)
+        uuid = uuid4().hex
+        done = partial(self._on_stored, self.envelope, self.generation, uuid)
+        self.store.put_request(uuid, msg[0], msg[1:], done)
+        return
+
+    def _on_stored(self, envelope, generation, uuid):
+        """Helper called when the request is durable.
+        """
+        if self.stream and generation == self.generation:
+            self.reply([b'200', uuid], envelope)
+        self.dispatcher.submit(uuid)
+        return
+#
+
+class TitanicReplyWorker(TitanicWorker):
+
+    """Worker for `titanic.reply`.
+    """
+
+    def __init__(self, context, endpoint, store):
+        TitanicWorker.__init__(self, context, endpoint, b'titanic.reply', store)
+        return
+
+    def on_request(self, msg):
+        status, reply = self.store.get_reply(msg[0])
+        self.reply([status] + reply)
+        return
+#
+
+class TitanicCloseWorker(TitanicWorker):
+
+    """Worker for `titanic.close`.
+    """
+
+    def __init__(self, context, endpoint, store):
+        TitanicWorker.__init__(self, context, endpoint, b'titanic.close', store)
+        return
+
+    def on_request(self, msg):
+        self.store.close_request(msg[0])
+        self.reply([b'200'])
+        return
+#
+###
+
+class Titanic(object):
+
+    """The complete Titanic service: store, workers and dispatcher.
+
+    Requests found pending in the store on startup are dispatched again.
+
+    :param context:    the ZeroMQ context to create the sockets in.
+    :type context:     zmq.Context
+    :param endpoint:   the broker endpoint.
+    :type endpoint:    str
+    :param directory:  directory holding the stored data.
+    :type directory:   str
+    """
+
+    def __init__(self, context, endpoint, directory):
+        self.store = TitanicStore(directory)
+        self.dispatcher = TitanicDispatcher(context, endpoint, self.store)
+        self.workers = [
+            TitanicRequestWorker(context, endpoint, self.store, self.dispatcher),
+            TitanicReplyWorker(context, endpoint, self.store),
+            TitanicCloseWorker(context, endpoint, self.store),
+            ]
+        for uuid in self.store.pending():
+            self.dispatcher.submit(uuid)
+        return
+
+    def shutdown(self):
+        """Shutdown the workers, close the store and stop the dispatcher.
+        """
+        for worker in self.workers:
+            worker.shutdown()
+        self.workers = []
+        # closing the store commits, its callbacks still submit requests
+        self.store.close()
+        self.dispatcher.shutdown()
         return
 #
 ###
 
 if __name__ == '__main__':
+    directory = sys.argv[1] if len(sys.argv) > 1 else 'titanic-data'
     context = zmq.Context()
+    titanic = Titanic(context, "tcp://127.0.0.1:5555", directory)
     IOLoop.instance().start()
+    titanic.shutdown()
 
 ### Local Variables:
 ### buffer-file-coding-system: utf-8
@@ -31,6 +31,13 @@ __license__ = """
 __author__ = 'Guido Goldstein'
 __email__ = 'gst-py@a-nugget.de'
 
+import time
+import struct
+import hashlib
+from heapq import heappush, heappop, heapify
+
+import zmq
+from zmq.eventloop.ioloop import IOLoop
 
 ###
 
@@ -55,6 +62,413 @@ def split_address(msg):
             break
     return (ret_ids, msg[i+1:])
 #
+
+def split_frames(frames):
+    """Zero-copy variant of :func:`split_address` for `zmq.Frame` parts.
+
+    Only the return Id frames are copied into strings. Returns 2-tuple
+    with the return Id as list of str and the index of the first frame
+    after the empty delimiter.
+    """
+    ret_ids = []
+    for i, p in enumerate(frames):
+        if p:
+            ret_ids.append(p.bytes)
+        else:
+            break
+    return (ret_ids, i+1)
+#
+
+def frames_digest(frames):
+    """Returns the SHA-1 digest of the message parts `frames`.
+
+    Every part is hashed with its length in front, so messages only
+    have the same digest if their parts are the same.
+
+    :param frames:  the message parts.
+    :type frames:   list of str or zmq.Frame
+
+    :rtype: str
+    """
+    digest = hashlib.sha1()
+    for frame in frames:
+        digest.update(struct.pack('!I', len(frame)))
+        digest.update(getattr(frame, 'buffer', frame))
+    return digest.digest()
+#
+
+class TimerWheel(object):
+
+    """Hashed timing wheel.
+
+    Keeps any number of timers in `nslots` buckets, each covering
+    `tick` time units. :func:`advance` has to be called once per tick
+    and only visits the timers hashed into the current bucket. Adding
+    and removing a timer is O(1).
+
+    Timers longer than one revolution of the wheel are supported, but
+    are visited once per revolution until they expire. Size the wheel
+    so that the usual delay fits into one revolution.
+
+    :param tick:     the duration of one tick.
+    :type tick:      int
+    :param nslots:   number of buckets.
+    :type nslots:    int
+    """
+
+    def __init__(self, tick, nslots):
+        """Initialize wheel instance.
+        """
+        self.tick = tick
+        self._slots = [{} for _ in xrange(nslots)]
+        self._pos = 0
+        # maps key -> index of the bucket the key is stored in
+        self._where = {}
+        return
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def __len__(self):
+        return len(self._where)
+
+    def add(self, key, delay):
+        """Schedule timer `key` to expire after `delay` time units.
+
+        An already scheduled timer for `key` is replaced.
+
+        :param key:      hashable timer id.
+        :param delay:    time until expiry (in the unit of `tick`).
+        :type delay:     int
+        """
+        self.remove(key)
+        nslots = len(self._slots)
+        ticks = max(1, -(-delay // self.tick))
+        idx = (self._pos + ticks) % nslots
+        self._slots[idx][key] = (ticks - 1) // nslots
+        self._where[key] = idx
+        return
+
+    def remove(self, key):
+        """Cancel timer `key`.
+
+        Does nothing if `key` is not scheduled.
+        """
+        idx = self._where.pop(key, None)
+        if idx is not None:
+            del self._slots[idx][key]
+        return
+
+    def advance(self):
+        """Advance the wheel by one tick.
+
+        :rtype: list of the keys of all expired timers.
+        """
+        self._pos = (self._pos + 1) % len(self._slots)
+        slot = self._slots[self._pos]
+        expired = []
+        for key, rounds in slot.items():
+            if rounds:
+                slot[key] = rounds - 1
+            else:
+                expired.append(key)
+        for key in expired:
+            del slot[key]
+            del self._where[key]
+        return expired
+#
+
+class Deadlines(object):
+
+    """Collection of deadlines kept in a lazily cleaned heap.
+
+    :func:`add` returns a handle which is passed to :func:`cancel`.
+    Cancelling is O(1): the entry is only marked and dropped when it
+    reaches the top of the heap. :func:`run` fires all due deadlines in
+    one sweep.
+
+    Deadlines are absolute times as returned by :func:`time.time`.
+    """
+
+    def __init__(self):
+        """Initialize instance.
+        """
+        # entries are [deadline, seq, callback], callback is None when cancelled
+        self._heap = []
+        self._seq = 0
+        self._count = 0
+        return
+
+    def __len__(self):
+        return self._count
+
+    def add(self, deadline, callback):
+        """Add a deadline.
+
+        :param deadline:  absolute time of expiry.
+        :type deadline:   float
+        :param callback:  called without arguments on expiry.
+        :type callback:   callable
+
+        :rtype: handle for :func:`cancel`
+        """
+        self._seq += 1
+        entry = [deadline, self._seq, callback]
+        heappush(self._heap, entry)
+        self._count += 1
+        return entry
+
+    def cancel(self, handle):
+        """Cancel the deadline given by `handle`.
+
+        Does nothing if the deadline already expired or was cancelled.
+        """
+        if handle[2] is None:
+            return
+        handle[2] = None
+        self._count -= 1
+        if len(self._heap) > 2 * self._count + 64:
+            self._heap = [e for e in self._heap if e[2] is not None]
+            heapify(self._heap)
+        return
+
+    def next_deadline(self):
+        """Returns the earliest deadline or `None` if there is none.
+        """
+        heap = self._heap
+        while heap and heap[0][2] is None:
+            heappop(heap)
+        if heap:
+            return heap[0][0]
+        return None
+
+    def run(self, now=None):
+        """Fire the callbacks of all deadlines up to `now`.
+
+        :param now:   the current time, defaults to :func:`time.time`.
+        :type now:    float
+
+        :rtype: int, the number of callbacks fired.
+        """
+        if now is None:
+            now = time.time()
+        heap = self._heap
+        fired = 0
+        while heap and heap[0][0] <= now:
+            entry = heappop(heap)
+            callback = entry[2]
+            if callback is None:
+                continue
+            entry[2] = None
+            self._count -= 1
+            fired += 1
+            callback()
+        return fired
+#
+
+class DeadlineManager(Deadlines):
+
+    """Deadlines driven by an IOLoop.
+
+    A single IOLoop timeout is kept for the earliest deadline. When it
+    fires, all deadlines due by then are handled in one sweep. The
+    timeout is scheduled `resolution` seconds late, so deadlines close
+    to each other are batched.
+
+    Use :func:`instance` to share one manager between all users of the
+    global IOLoop.
+
+    :param ioloop:      the IOLoop to use, defaults to the global one.
+    :type ioloop:       IOLoop
+    :param resolution:  maximum delay in seconds added to batch deadlines.
+    :type resolution:   float
+    """
+
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        """Returns the global manager using the global IOLoop.
+        """
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, ioloop=None, resolution=0.005):
+        """Initialize instance.
+        """
+        Deadlines.__init__(self)
+        self.ioloop = ioloop or IOLoop.instance()
+        self.resolution = resolution
+        self._timeout = None
+        self._scheduled = None
+        return
+
+    def add_timeout(self, timeout, callback):
+        """Call `callback` after `timeout` milliseconds.
+
+        :param timeout:   the time to wait in milliseconds.
+        :type timeout:    int
+        :param callback:  called without arguments on expiry.
+        :type callback:   callable
+
+        :rtype: handle for :func:`cancel`
+        """
+        deadline = time.time() + timeout / 1000.0
+        handle = self.add(deadline, callback)
+        if self._scheduled is None or deadline + self.resolution < self._scheduled:
+            self._schedule(deadline)
+        return handle
+
+    def _schedule(self, deadline):
+        """Helper (re)scheduling the IOLoop timeout.
+        """
+        if self._timeout is not None:
+            self.ioloop.remove_timeout(self._timeout)
+            self._timeout = None
+            self._scheduled = None
+        if deadline is None:
+            return
+        self._scheduled = deadline + self.resolution
+        self._timeout = self.ioloop.add_timeout(self._scheduled, self._on_timeout)
+        return
+
+    def _on_timeout(self):
+        """Helper called by the IOLoop.
+        """
+        self._timeout = None
+        self._scheduled = None
+        self.run()
+        # callbacks may have scheduled a later timeout for a deadline
+        # they added, while earlier ones are still waiting
+        self._schedule(self.next_deadline())
+        return
+#
+
+class BatchStream(object):
+
+    """Minimal replacement for ZMQStream built for throughput.
+
+    Each time the IOLoop reports the socket readable, up to `batch`
+    messages are received and passed to the callback. Capping the batch
+    keeps one busy socket from starving the others in the same loop.
+
+    An IOLoop polling the file descriptor of the socket sees edge-triggered
+    events: messages left over from a capped batch, or noticed by zmq
+    while sending, are not reported again. So pending messages are
+    checked with `zmq.EVENTS` and handled from an IOLoop callback in the
+    next loop iteration.
+
+    Messages are sent right away without blocking, instead of being
+    queued until the loop reports the socket writable. Replies produced
+    while a batch is handled therefore go out within that batch. This
+    is only suitable for sockets which never block on send, like XREP.
+
+    Only the parts of the ZMQStream API used by the broker are provided.
+
+    :param socket:   the socket to wrap.
+    :type socket:    zmq.Socket
+    :param ioloop:   the IOLoop to use, defaults to the global one.
+    :type ioloop:    IOLoop
+    :param batch:    maximum number of messages handled per loop iteration.
+    :type batch:     int
+
+    :ivar dropped:   number of messages dropped because they could not be
+                     sent right away.
+    """
+
+    def __init__(self, socket, ioloop=None, batch=64):
+        """Initialize instance.
+        """
+        self.socket = socket
+        self.io_loop = ioloop or IOLoop.instance()
+        self.batch = batch
+        self.dropped = 0
+        self._callback = None
+        self._copy = True
+        self._recv_scheduled = False
+        return
+
+    def on_recv(self, callback, copy=True):
+        """Register `callback` to be called with each received message.
+
+        Passing `None` stops receiving.
+        """
+        if callback is None and self._callback is not None:
+            self.io_loop.remove_handler(self.socket)
+        elif callback is not None and self._callback is None:
+            self.io_loop.add_handler(self.socket, self._handle_recv, IOLoop.READ)
+        self._callback = callback
+        self._copy = copy
+        return
+
+    def send_multipart(self, msg):
+        """Send the message parts without blocking.
+
+        Messages which cannot be sent right away are dropped, like an
+        XREP socket drops messages to peers over their high-water mark,
+        and counted in :attr:`dropped`.
+        """
+        try:
+            self.socket.send_multipart(msg, zmq.NOBLOCK)
+        except zmq.ZMQError, e:
+            if e.errno != zmq.EAGAIN:
+                raise
+            self.dropped += 1
+        self._schedule_recv()
+        return
+
+    def _handle_recv(self, fd, events):
+        """Helper called by the IOLoop when the socket is readable.
+        """
+        recv = self.socket.recv_multipart
+        copy = self._copy
+        for _ in xrange(self.batch):
+            if self._callback is None:
+                return
+            try:
+                msg = recv(zmq.NOBLOCK, copy=copy)
+            except zmq.ZMQError, e:
+                if e.errno == zmq.EAGAIN:
+                    return
+                raise
+            self._callback(msg)
+        # batch is full, there may be more
+        self._schedule_recv()
+        return
+
+    def _schedule_recv(self):
+        """Helper scheduling :func:`_handle_recv` if messages are pending.
+        """
+        if self._recv_scheduled or self._callback is None:
+            return
+        if self.socket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            self._recv_scheduled = True
+            self.io_loop.add_callback(self._on_scheduled_recv)
+        return
+
+    def _on_scheduled_recv(self):
+        """Helper called by the IOLoop for messages found pending.
+        """
+        self._recv_scheduled = False
+        if self.socket is not None:
+            self._handle_recv(None, IOLoop.READ)
+        return
+
+    def closed(self):
+        return self.socket is None
+
+    def close(self):
+        """Stop receiving and close the socket.
+        """
+        if self.socket is None:
+            return
+        self.on_recv(None)
+        if not self.socket.closed:
+            self.socket.close()
+        self.socket = None
+        return
+#
 ###
 
 ### Local Variables:
@@ -29,6 +29,7 @@ __email__ = 'gst-py@a-nugget.de'
 import sys
 import time
 from exceptions import UserWarning
+from functools import partial
 from pprint import pprint
 
 import zmq
@@ -60,6 +61,11 @@ class MDPWorker(object):
     Provides a send method with optional timeout parameter.
 
     Will use a timeout to indicate a broker failure.
+
+    A worker may announce a `capacity` above 1 to have the broker send up
+    to that many requests before the first one is answered. Such a
+    worker has to keep the :attr:`envelope` of each request it wants to
+    answer later and pass it to :func:`reply`.
     """
 
     _proto_version = b'MDPW01'
@@ -68,20 +74,26 @@ class MDPWorker(object):
     HB_INTERVAL = 1000  # in milliseconds
     HB_LIVENESS = 3    # HBs to miss before connection counts as dead
 
-    def __init__(self, context, endpoint, service):
+    def __init__(self, context, endpoint, service, capacity=1):
         """Initialize the MDPWorker.
 
         context is the zmq context to create the socket from.
         service is a byte-string with the service name.
+        capacity is the number of requests processed concurrently.
         """
         self.context = context
         self.endpoint = endpoint
         self.service = service
+        self.capacity = capacity
+        self.envelope = None
+        # counts connections, envelopes are only valid for one of them
+        self.generation = 0
         self.stream = None
         self._tmo = None
         self.need_handshake = True
         self.ticker = None
         self._delayed_cb = None
+        self._sent_traffic = False
         self._create_stream()
         return
 
@@ -90,6 +102,7 @@ class MDPWorker(object):
         """
         socket = self.context.socket(zmq.XREQ)
         ioloop = IOLoop.instance()
+        self.generation += 1
         self.stream = ZMQStream(socket, ioloop)
         self.stream.on_recv(self._on_message)
         self.stream.socket.setsockopt(zmq.LINGER, 0)
@@ -103,16 +116,25 @@ class MDPWorker(object):
         """Helper method to prepare and send the workers READY message.
         """
         ready_msg = [ b'', self._proto_version, chr(1), self.service ]
+        if self.capacity > 1:
+            ready_msg.append(str(self.capacity))
         self.stream.send_multipart(ready_msg)
         self.curr_liveness = self.HB_LIVENESS
+        self._sent_traffic = True
         return
 
     def _tick(self):
         """Method called every HB_INTERVAL milliseconds.
+
+        A heartbeat is only sent if nothing else was sent to the broker
+        during the last interval.
         """
         self.curr_liveness -= 1
 ##         print '%.3f tick - %d' % (time.time(), self.curr_liveness)
-        self.send_hb()
+        if self._sent_traffic:
+            self._sent_traffic = False
+        else:
+            self.send_hb()
         if self.curr_liveness >= 0:
             return
         print '%.3f lost connection' % time.time()
@@ -148,21 +170,27 @@ class MDPWorker(object):
         self.connected = False
         return
 
-    def reply(self, msg):
+    def reply(self, msg, envelope=None):
         """Send the given message.
 
         msg can either be a byte-string or a list of byte-strings.
+
+        envelope is the :attr:`envelope` of the request to answer. It
+        defaults to the one of the request received last.
         """
 ##         if self.need_handshake:
 ##             raise ConnectionNotReadyError()
         # prepare full message
-        to_send = self.envelope
-        self.envelope = None
+        if envelope is None:
+            envelope = self.envelope
+            self.envelope = None
+        to_send = envelope[:]
         if isinstance(msg, list):
             to_send.extend(msg)
         else:
             to_send.append(msg)
         self.stream.send_multipart(to_send)
+        self._sent_traffic = True
         return
 
     def _on_message(self, msg):
@@ -205,6 +233,159 @@ class MDPWorker(object):
         pass
 #
 
+class MDPAsyncWorker(MDPWorker):
+
+    """MDP worker processing many requests concurrently.
+
+    Each request is passed to :func:`handle`, which returns either the
+    answer or a future of it, e.g. the result of a function decorated
+    with :func:`mdp.coro.coroutine`. The IOLoop keeps running while
+    futures are pending, so heartbeats and further requests are handled
+    in the meantime. Once a future is done its result is sent back with
+    the envelope of its request.
+
+    Any object with `add_done_callback` and `result` methods like
+    :class:`concurrent.futures.Future` is accepted as future. Futures
+    may be completed in other threads.
+
+    If :func:`handle` raises, the future fails or the answer is `None`,
+    :func:`on_handler_error` is called.
+
+    :param context:  the ZeroMQ context to create the socket in.
+    :type context:   zmq.Context
+    :param endpoint: the broker endpoint to connect to.
+    :type endpoint:  str
+    :param service:  the service to offer.
+    :type service:   str
+    :param capacity: number of requests accepted concurrently.
+    :type capacity:  int
+    """
+
+    def __init__(self, context, endpoint, service, capacity=100):
+        """Initialize the MDPAsyncWorker.
+        """
+        MDPWorker.__init__(self, context, endpoint, service, capacity)
+        return
+
+    def on_request(self, msg):
+        """Pass the request to :func:`handle` and reply once it is done.
+        """
+        envelope = self.envelope
+        try:
+            answer = self.handle(msg)
+        except Exception, e:
+            self.on_handler_error(envelope, e)
+            return
+        if not hasattr(answer, 'add_done_callback'):
+            self._on_answer(envelope, answer)
+            return
+        done = partial(self._on_done, envelope, self.generation)
+        ioloop = IOLoop.instance()
+        answer.add_done_callback(lambda f: ioloop.add_callback(partial(done, f)))
+        return
+
+    def _on_done(self, envelope, generation, future):
+        """Helper called in the IOLoop when a request has been processed.
+
+        Results for requests received on a previous connection are
+        dropped; the broker has redelivered those requests already.
+        """
+        if not self.stream or generation != self.generation:
+            return
+        try:
+            answer = future.result()
+        except Exception, e:
+            self.on_handler_error(envelope, e)
+            return
+        self._on_answer(envelope, answer)
+        return
+
+    def _on_answer(self, envelope, answer):
+        """Helper sending `answer` with `envelope`.
+
+        An answer of `None` is reported as handler error.
+        """
+        if answer is None:
+            exc = TypeError('request handler returned None')
+            self.on_handler_error(envelope, exc)
+            return
+        self.reply(answer, envelope)
+        return
+
+    def handle(self, msg):
+        """Process a request.
+
+        Returns the answer, a byte-string or a list of byte-strings, or
+        a future of it.
+
+        Must be overloaded!
+        """
+        pass
+
+    def on_handler_error(self, envelope, exc):
+        """Public method called when the request handler raised `exc`.
+
+        Prints the error and replies `500`, so the broker does not
+        consider the request to be still in process.
+        """
+        print 'request handler failed: %r' % exc
+        self.reply([b'500'], envelope)
+        return
+#
+
+class MDPExecutorWorker(MDPAsyncWorker):
+
+    """MDP worker running requests in a :mod:`concurrent.futures` executor.
+
+    Requests are handed to `handler` in the executor, so the IOLoop stays
+    free for heartbeats and further requests while they are processed.
+    Replies are passed back to the IOLoop and sent with the envelope of
+    their request.
+
+    The handler is called with the list of request parts and must return
+    a byte-string or a list of byte-strings. For a process pool it must be
+    picklable, i.e. a module level function. With a thread pool it may be
+    omitted and :func:`handle_request` overloaded instead.
+
+    If the handler raises or returns `None`, :func:`on_handler_error` is
+    called.
+
+    :param context:  the ZeroMQ context to create the socket in.
+    :type context:   zmq.Context
+    :param endpoint: the broker endpoint to connect to.
+    :type endpoint:  str
+    :param service:  the service to offer.
+    :type service:   str
+    :param executor: the executor to run requests in.
+    :type executor:  concurrent.futures.Executor
+    :param capacity: number of requests accepted concurrently, usually
+                     the number of executor workers.
+    :type capacity:  int
+    :param handler:  callable processing a request.
+    :type handler:   callable
+    """
+
+    def __init__(self, context, endpoint, service, executor, capacity, handler=None):
+        """Initialize the MDPExecutorWorker.
+        """
+        self.executor = executor
+        self.handler = handler or self.handle_request
+        MDPAsyncWorker.__init__(self, context, endpoint, service, capacity)
+        return
+
+    def handle(self, msg):
+        """Submit the request to the executor.
+        """
+        return self.executor.submit(self.handler, msg)
+
+    def handle_request(self, msg):
+        """Default request handler, run in the executor.
+
+        Must be overloaded if no handler is given!
+        """
+        pass
+#
+
 ### Local Variables:
 ### buffer-file-coding-system: utf-8
 ### mode: python
@@ -31,6 +31,9 @@ from setuptools import setup
 setup(
     name        = 'mdp',
     package_dir = {'mdp': 'mdp'},
-    packages    = ['mdp'],
+    packages    = ['mdp', 'mdp.bench'],
+    entry_points = {
+        'console_scripts': ['mdp-bench = mdp.bench.roundtrip:main'],
+        },
     zip_safe    = False
 )